@@ -0,0 +1,6 @@
+from server.asgi import create_asgi_server
+from main import server
+
+#ASGI entry point, e.g. 'uvicorn asgi:application --host 0.0.0.0 --port 4242'
+#(needs 'pip install uvicorn aiosqlite', or aiomysql instead of aiosqlite for MySQL)
+application = create_asgi_server(server)
@@ -0,0 +1,202 @@
+"""
+Concurrency benchmark: how many slow clients can the server handle at once, and how does that affect
+everyone else? Compares the threaded WSGI server (like main.py) with the ASGI server (asgi.py).
+
+For every number of connections, this opens that many sniffers which upload one discovery each,
+but trickle the request body over --duration seconds (like a sniffer on a bad mobile connection).
+At the same time, a client keeps requesting a viewport (GET /maps/<id>/aps) and measures the latency.
+Reported are the uploads that succeeded, the viewport latencies and the peak number of server threads.
+
+Usage (from the project directory, needs 'pip install uvicorn aiosqlite'):
+    python benchmarks/concurrency.py [--connections 50 200 1000] [--duration 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+#executed in a separate process for every server mode
+SERVER = """
+import sys
+sys.path.insert(0, {root!r})
+from server import create_server
+from server.config import DevelopmentConfig
+
+class BenchConfig(DevelopmentConfig):
+    DEBUG = False
+    SQLALCHEMY_DATABASE_URI = {uri!r}
+    RATELIMIT_ENABLED = False
+
+app = create_server(BenchConfig)
+if {mode!r} == 'threaded':
+    app.run(port={port}, threaded=True)
+else:
+    import uvicorn
+    from server.asgi import create_asgi_server
+    uvicorn.run(create_asgi_server(app), port={port}, log_level='error', backlog=4096)
+"""
+
+
+def setup_db(uri):
+    """
+    Create the DB with a sniffer and a map with some discoveries; returns (token, map id)
+    """
+    from werkzeug.security import generate_password_hash
+    from server import create_server, db
+    from server.config import DevelopmentConfig
+    from server.login import generate_token
+    from server.models import Sniffer, WardrivingMap, AccessPoint, Discovery
+    from datetime import datetime
+
+    class BenchConfig(DevelopmentConfig):
+        SQLALCHEMY_DATABASE_URI = uri
+
+    app = create_server(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        sniffer = Sniffer(public_id=str(uuid.uuid4()), name='bench', password=generate_password_hash('bench'))
+        map = WardrivingMap(title='bench')
+        db.session.add_all([sniffer, map])
+        db.session.commit()
+        for i in range(200):
+            discovery = Discovery(access_point_mac=i + 1, channel=6, encryption=3, signal_strength=-60, ssid=f'net{i}',
+                                  timestamp=datetime(2021, 9, 1), gps_lat=49.5 + i * 1e-4, gps_lon=11.0,
+                                  sniffer_id=sniffer.id, map_id=map.id)
+            ap = AccessPoint(mac=i + 1)
+            ap.update(discovery)
+            db.session.add_all([ap, discovery])
+        db.session.commit()
+        return generate_token(sniffer), map.id
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_threads(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                return int(line.split()[1])
+    return 0
+
+
+async def http(port, method, path, token, body=b'', duration=0):
+    """
+    Minimal HTTP/1.1 client; the body is sent in pieces over 'duration' seconds. Returns the status code.
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write((f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+                      f'x-access-token: {token}\r\nContent-Type: application/json\r\n'
+                      f'Content-Length: {len(body)}\r\n\r\n').encode())
+        pieces = 10 if duration else 1
+        step = -(-len(body) // pieces) if body else 0
+        for i in range(pieces):
+            writer.write(body[i * step:(i + 1) * step])
+            await writer.drain()
+            if duration:
+                await asyncio.sleep(duration / pieces)
+        response = await reader.read()
+        return int(response.split(b' ', 2)[1])
+    finally:
+        writer.close()
+
+
+async def run_load(port, pid, token, map_id, connections, duration):
+    async def upload(i):
+        body = json.dumps({'access_point_mac': 10 ** 6 + i, 'channel': 1, 'encryption': 0, 'signal_strength': -70,
+                           'ssid': 'slow', 'timestamp': '2021-09-01T12:00:00', 'gps_lat': 49.6,
+                           'gps_lon': 11.1}).encode()
+        try:
+            return await asyncio.wait_for(http(port, 'POST', f'/maps/{map_id}', token, body, duration), duration + 30)
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            return None
+
+    uploads = [asyncio.ensure_future(upload(i)) for i in range(connections)]
+    latencies, failed_probes, threads = [], 0, 0
+    viewport = f'/maps/{map_id}/aps?lat1=49&lat2=50&lon1=10&lon2=12'
+    while not all(u.done() for u in uploads):
+        threads = max(threads, server_threads(pid))
+        started = time.perf_counter()
+        try:
+            status = await asyncio.wait_for(http(port, 'GET', viewport, token), 10)
+            if status != 200:
+                failed_probes += 1
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            failed_probes += 1
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.05)
+
+    results = [u.result() for u in uploads]
+    return {'uploads_ok': sum(1 for r in results if r in (200, 202)),
+            'uploads_failed': sum(1 for r in results if r not in (200, 202)),
+            'probe_p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+            'probe_max_ms': max(latencies) * 1000 if latencies else None,
+            'probes_failed': failed_probes, 'server_threads': threads}
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('Server did not start.')
+
+
+def bench(mode, uri, token, map_id, connections, duration):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, '-c', SERVER.format(root=ROOT, uri=uri, mode=mode, port=port)],
+                            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        return asyncio.run(run_load(port, proc.pid, token, map_id, connections, duration))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument('--duration', type=float, default=5, help='seconds every upload takes')
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'asgi'])
+    args = parser.parse_args()
+
+    #every connection needs a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        uri = f'sqlite:///{tmp}/bench.db'
+        token, map_id = setup_db(uri)
+        print(f'{"mode":<10}{"conns":>7}{"uploads ok":>12}{"failed":>8}{"probe p50":>11}{"probe max":>11}{"threads":>9}')
+        for connections in args.connections:
+            for mode in args.modes:
+                r = bench(mode, uri, token, map_id, connections, args.duration)
+                print(f'{mode:<10}{connections:>7}{r["uploads_ok"]:>12}{r["uploads_failed"]:>8}'
+                      f'{r["probe_p50_ms"]:>9.1f}ms{r["probe_max_ms"]:>9.1f}ms{r["server_threads"]:>9}')
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Scale benchmark: how do the read endpoints behave on large maps?
+For every size, this generates a synthetic map with that many discoveries (see server/synthetic.py) in a
+fresh SQLite DB, then requests every endpoint --requests times at random places of the map and reports the
+load time, the latency percentiles and the peak memory (RSS) of the process.
+
+Every size runs in a new process, so the memory of one size doesn't hide the one of the next. The data only
+depends on the seed and the size, so results of different commits are comparable: with --output, they are
+appended as JSON lines together with the current git commit, e.g. to compare a change with its parent.
+
+Usage (from the project directory; 10M rows need a few GB of disk and memory):
+    python benchmarks/scale.py [--sizes 10000 1000000 10000000] [--requests 20] [--output results.ndjson]
+                               [--backend sql|columnar]   (storage of the read endpoints, see server/storage.py)
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+#endpoint -> function(dataset, map id, rng) returning the path of a request
+ENDPOINTS = {
+    'viewport': lambda d, m, rng: '/maps/{}/aps?lat1={}&lat2={}&lon1={}&lon2={}'.format(m, *_bbox(d, rng, 500)),
+    'ap': lambda d, m, rng: f'/aps/{_ap(d, rng)}',
+    'near': lambda d, m, rng: '/aps/near?lat={}&lon={}&radius=200'.format(*_point(d, rng)),
+    'search': lambda d, m, rng: f'/aps/search?q={_ssid_part(d, rng)}&mode=prefix',
+    'stats': lambda d, m, rng: f'/maps/{m}/stats',
+    'heatmap': lambda d, m, rng: '/maps/{}/heatmap?format=json&bbox={},{},{},{}'.format(m, *_heatmap_bbox(d, rng)),
+    'sniffers': lambda d, m, rng: f'/maps/{m}/sniffers',
+}
+
+
+def _random_ap(dataset, rng):
+    return dataset.loaded[rng.integers(len(dataset.loaded))]
+
+
+def _point(dataset, rng):
+    i = _random_ap(dataset, rng)
+    return float(dataset.lat[i]), float(dataset.lon[i])
+
+
+def _bbox(dataset, rng, meters):
+    from server.synthetic import METERS_PER_DEGREE
+    lat, lon = _point(dataset, rng)
+    dlat = meters / METERS_PER_DEGREE
+    return lat - dlat, lat + dlat, lon - 1.5 * dlat, lon + 1.5 * dlat
+
+
+def _heatmap_bbox(dataset, rng):
+    lat1, lat2, lon1, lon2 = _bbox(dataset, rng, 2000)
+    return lat1, lon1, lat2, lon2
+
+
+def _ap(dataset, rng):
+    return int(dataset.mac[_random_ap(dataset, rng)])
+
+
+def _ssid_part(dataset, rng):
+    ssid = None
+    while not ssid:
+        ssid = dataset.ssid[_random_ap(dataset, rng)]
+    return ssid[:4]
+
+
+def peak_rss_mb():
+    #ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(size, requests, seed, backend='sql'):
+    """
+    Generate and benchmark one size (in its own process)
+    """
+    import numpy as np
+    from werkzeug.security import generate_password_hash
+    from server import create_server, db, synthetic
+    from server.config import DevelopmentConfig
+    from server.login import generate_token
+    from server.models import User, Sniffer, WardrivingMap
+
+    tmp = tempfile.mkdtemp()
+    try:
+        class BenchConfig(DevelopmentConfig):
+            DEBUG = False
+            SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp}/bench.db'
+            RATELIMIT_ENABLED = False
+            #the latencies are reported anyway
+            PROFILING_SLOW_THRESHOLD = None
+            STORAGE_BACKEND = backend
+            STORAGE_DIRECTORY = f'{tmp}/columnar'
+
+        app = create_server(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            admin = User(public_id=str(uuid.uuid4()), name='bench', password=generate_password_hash('bench'), admin=True)
+            sniffers = [Sniffer(public_id=str(uuid.uuid4()), name=f'bench{i}', password=generate_password_hash('bench'))
+                        for i in range(5)]
+            map = WardrivingMap(title=f'bench {size}')
+            db.session.add_all([admin, map] + sniffers)
+            db.session.commit()
+            token, map_id, sniffer_ids = generate_token(admin), map.id, [s.id for s in sniffers]
+
+            started = time.perf_counter()
+            dataset, timings = synthetic.load(db.engine, map_id, sniffer_ids, size, seed=seed)
+            if backend == 'columnar':
+                from server.cli import _rebuild_columnar
+                columnar_started = time.perf_counter()
+                _rebuild_columnar(map_id, 100000)
+                timings['columnar'] = time.perf_counter() - columnar_started
+            result = {'size': size, 'backend': backend, 'aps': len(dataset.loaded), 'load_s': round(time.perf_counter() - started, 2),
+                      'load_phases_s': {phase: round(seconds, 2) for phase, seconds in timings.items()},
+                      'db_mb': round(os.path.getsize(f'{tmp}/bench.db') / 2 ** 20, 1),
+                      'rss_after_load_mb': round(peak_rss_mb(), 1), 'endpoints': {}}
+
+        client = app.test_client()
+        headers = {'x-access-token': token}
+        for name, path in ENDPOINTS.items():
+            #the same requests for every commit
+            rng = np.random.default_rng([seed, size])
+            latencies = []
+            for _ in range(requests):
+                request_started = time.perf_counter()
+                response = client.get(path(dataset, map_id, rng), headers=headers)
+                latencies.append(time.perf_counter() - request_started)
+                if response.status_code != 200:
+                    raise RuntimeError(f'{name}: {response.status_code} {response.get_data(as_text=True)[:200]}')
+            latencies.sort()
+            result['endpoints'][name] = {'p50_ms': round(statistics.median(latencies) * 1000, 2),
+                                         'p95_ms': round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 2),
+                                         'max_ms': round(latencies[-1] * 1000, 2)}
+        result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        return result
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000])
+    parser.add_argument('--requests', type=int, default=20, help='requests per endpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='append the results to this file (JSON lines)')
+    parser.add_argument('--backend', choices=['sql', 'columnar'], default='sql',
+                        help='storage of the read endpoints (columnar needs duckdb)')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    for size in args.sizes:
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+            result = executor.submit(run, size, args.requests, args.seed, args.backend).result()
+
+        print(f'{size} discoveries ({args.backend}), {result["aps"]} APs: loaded in {result["load_s"]}s, DB {result["db_mb"]} MB, '
+              f'peak RSS {result["peak_rss_mb"]} MB')
+        print(f'  {"endpoint":<10}{"p50":>10}{"p95":>10}{"max":>10}')
+        for name, r in result['endpoints'].items():
+            print(f'  {name:<10}{r["p50_ms"]:>8.1f}ms{r["p95_ms"]:>8.1f}ms{r["max_ms"]:>8.1f}ms')
+
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(dict(result, commit=commit, seed=args.seed, requests=args.requests,
+                                        time=datetime.utcnow().isoformat())) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Startup benchmark: how long does it take until a fresh process has created the server
+(cold start, e.g. of a gunicorn worker or a test run), and how long does the first request
+that needs the marshmallow schemas take?
+Every measurement runs in a new python process, so nothing is cached between them.
+
+Usage (from the project directory):
+    python benchmarks/startup.py [--runs 5] [--importtime 15]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#executed in a fresh interpreter; prints the timings [s] of the different phases
+PROBE = """
+import time
+t0 = time.perf_counter()
+from server import create_server
+from server.config import DevelopmentConfig
+t1 = time.perf_counter()
+
+class BenchConfig(DevelopmentConfig):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    PRELOAD_SCHEMAS = {preload}
+
+app = create_server(BenchConfig)
+t2 = time.perf_counter()
+
+from server.endpoints.schemas import load_schemas
+load_schemas()
+t3 = time.perf_counter()
+print(t1 - t0, t2 - t1, t3 - t2)
+"""
+
+
+def probe(preload):
+    out = subprocess.run([sys.executable, '-c', PROBE.format(preload=preload)], cwd=ROOT,
+                         check=True, capture_output=True, text=True).stdout
+    return [float(x) for x in out.split()]
+
+
+def importtime(top):
+    """
+    Parse the output of 'python -X importtime' and return the modules with the highest cumulative import time
+    """
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE.format(preload=True)], cwd=ROOT,
+                         check=True, capture_output=True, text=True).stderr
+    entries = []
+    for line in err.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)', line)
+        if match:
+            entries.append((int(match.group(2)), match.group(4)))
+    return sorted(entries, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--importtime', type=int, default=15, help='number of modules to show (0 to skip)')
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'imports':>12}{'create_server':>16}{'first use':>12}{'total':>12}   (median of {args.runs} runs, ms)")
+    for mode, preload in (('lazy', False), ('preload', True)):
+        runs = [probe(preload) for _ in range(args.runs)]
+        phases = [statistics.median(run[i] for run in runs) * 1000 for i in range(3)]
+        print(f"{mode:<10}{phases[0]:>12.1f}{phases[1]:>16.1f}{phases[2]:>12.1f}{sum(phases):>12.1f}")
+
+    if args.importtime:
+        print(f'\nslowest imports (cumulative, us):')
+        for cumulative, module in importtime(args.importtime):
+            print(f'{cumulative:>10}  {module}')
+
+
+if __name__ == '__main__':
+    main()
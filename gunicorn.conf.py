@@ -0,0 +1,30 @@
+#configuration for running the server with gunicorn:
+#   gunicorn -c gunicorn.conf.py
+#(remember to switch main.py to the ProductionConfig first)
+import multiprocessing
+
+wsgi_app = 'main:server'
+bind = '0.0.0.0:4242'
+workers = multiprocessing.cpu_count() * 2 + 1
+
+#create the app (including the marshmallow schemas, see PRELOAD_SCHEMAS) once in the master process,
+#the workers are then forked from it and start much faster
+preload_app = True
+
+
+def post_fork(server, worker):
+    #connections must not be shared between processes, so every worker opens its own
+    from main import server as app
+    from server import db
+    with app.app_context():
+        db.engine.dispose()
+
+
+def when_ready(server):
+    #the writer processes of the sharded ingest (see server/sharding.py) are started once in the master,
+    #the workers forked afterwards hand the discoveries over to them
+    from main import server as app
+    from server.sharding import shards
+    if shards.enabled:
+        with app.app_context():
+            shards.start()
@@ -1,13 +1,23 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_cors import CORS
 
 from server.config import ProductionConfig
+from server.sharding import shards
+from server.replicas import RoutingSQLAlchemy, replicas
+from server.oui import oui_registry
+from server.archive import archive
+from server.writebehind import ap_buffer
+from server.acl import acl
+from server.storage import storage
+from server.ratelimit import limiter
+from server.passwords import passwords
+from server.profiling import profiler
 
 import uuid
 
-db = SQLAlchemy()
+#RoutingSQLAlchemy behaves like the usual flask_sqlalchemy.SQLAlchemy but can send reads to replicas
+db = RoutingSQLAlchemy()
 ma = Marshmallow()
 
 
@@ -18,8 +28,25 @@ def create_server(config_class=ProductionConfig):
     db.init_app(app)
     #order matters here: SQLAlchemy has to be initialized before Marshmallow
     ma.init_app(app)
+    #the profiler's hooks run first and last, so its timings cover all the others
+    profiler.init_app(app)
+    #rejecting requests is cheap, so the limiter runs before all other request hooks
+    limiter.init_app(app)
+    replicas.init_app(app)
+    passwords.init_app(app)
+
+    shards.init_app(app)
+    oui_registry.init_app(app)
+    archive.init_app(app)
+    ap_buffer.init_app(app)
+    acl.init_app(app)
+    storage.init_app(app)
 
     CORS(app) 
+
+    #compress API payloads and accept compressed discovery uploads
+    from server.compression import init_compression
+    init_compression(app)
     
     #add endpoints
     from server.endpoints.system import system
@@ -27,6 +54,7 @@ def create_server(config_class=ProductionConfig):
     from server.endpoints.users import users
     from server.endpoints.maps import maps
     from server.endpoints.access_point import aps
+    from server.endpoints.uploads import uploads
      
 
     app.register_blueprint(system)
@@ -34,6 +62,16 @@ def create_server(config_class=ProductionConfig):
     app.register_blueprint(users)
     app.register_blueprint(maps)
     app.register_blueprint(aps)
+    app.register_blueprint(uploads)
+
+    #command line tools, e.g. 'flask data import'
+    from server.cli import data_cli
+    app.cli.add_command(data_cli)
+
+    #build the marshmallow schemas now instead of on first use (see server/endpoints/schemas.py)
+    if app.config['PRELOAD_SCHEMAS']:
+        from server.endpoints.schemas import load_schemas
+        load_schemas()
     
 
     return app
\ No newline at end of file
@@ -0,0 +1,229 @@
+import time
+from threading import Lock
+
+from flask import g, has_app_context
+from sqlalchemy import and_, or_, false, select
+
+from server.cache import LRUCache
+
+
+"""
+Map sharing (MAP_ACL_ENABLED): without it, every logged in user can read every map. With it, admins still see
+everything, but other users only see
+- the maps shared with them (MapAccess), optionally only within a bounding box (geofence)
+- the maps they contributed to as sniffers (participate_in), completely unless a grant sets a geofence
+- the APs found on these maps (those on a geofenced map only if the AP is located within the fence)
+
+Checking every row in python would make the big reads (viewports, AP lists) much slower, so the visibility of
+a user is turned into SQL predicates which are added to the existing queries, e.g. for the discoveries:
+
+    map_id IN (<maps visible completely>) OR (map_id = <fenced map> AND gps_lat BETWEEN .. AND gps_lon BETWEEN ..)
+
+The visible maps of a user and the predicates built from them are cached (MAP_ACL_CACHE_TTL), so a request
+doesn't even have to query the grants. Changing the grants clears the cache of this process; other processes
+notice it when their entries expire.
+"""
+
+
+def _intersect(a, b):
+    """
+    Intersection of two bounding boxes (lat_min, lon_min, lat_max, lon_max), None if they don't overlap
+    """
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    return box if box[0] <= box[2] and box[1] <= box[3] else None
+
+
+class Visibility():
+    """
+    What one user may read.
+    maps: None (everything) or {map id: None (the whole map) or bbox of its geofence}
+    """
+    def __init__(self, maps=None):
+        self.maps = maps
+        #predicates are built once per table and reused by all requests of the user
+        self._predicates = {}
+
+    @property
+    def unrestricted(self):
+        return self.maps is None
+
+    def can_see(self, map_id):
+        try:
+            return self.maps is None or int(map_id) in self.maps
+        except (TypeError, ValueError):
+            return False
+
+    def map_ids(self):
+        return None if self.maps is None else list(self.maps)
+
+    def fence(self, map_id):
+        return None if self.maps is None else self.maps.get(int(map_id))
+
+    def bboxes(self, map_id, bbox=None):
+        """
+        The areas of the map to read instead of bbox (None: the whole map): [] if none of it is visible
+        """
+        fence = self.fence(map_id)
+        if fence is None:
+            return [bbox]
+        if bbox is None:
+            return [fence]
+        clipped = _intersect(bbox, fence)
+        return [clipped] if clipped else []
+
+    def contains(self, map_id, lat, lon):
+        """
+        Is a single point of this map visible? (for the few rows that don't come from SQL, e.g. shards)
+        """
+        if not self.can_see(map_id):
+            return False
+        fence = self.fence(map_id)
+        return fence is None or (fence[0] <= lat <= fence[2] and fence[1] <= lon <= fence[3])
+
+    def _predicate(self, key, build):
+        predicate = self._predicates.get(key)
+        if predicate is None:
+            predicate = self._predicates[key] = build()
+        return predicate
+
+    def discovery_filter(self, table=None):
+        """
+        Predicate for the rows of the discovery table (or any table with map_id, gps_lat and gps_lon), None if
+        everything is visible
+        """
+        if self.maps is None:
+            return None
+        from server.models import Discovery
+        table = Discovery.__table__ if table is None else table
+
+        def build():
+            whole = [id for id, fence in self.maps.items() if fence is None]
+            clauses = [table.c.map_id.in_(whole)] if whole else []
+            clauses += [and_(table.c.map_id == id, table.c.gps_lat.between(fence[0], fence[2]),
+                             table.c.gps_lon.between(fence[1], fence[3]))
+                        for id, fence in self.maps.items() if fence is not None]
+            return or_(*clauses) if clauses else false()
+        return self._predicate(table, build)
+
+    def ap_filter(self):
+        """
+        Predicate for the access_point table, None if everything is visible.
+        The APs of a map are known from the contribution counters (one row per AP and sniffer), so this doesn't
+        have to look at the discoveries; the subqueries are evaluated once per query, not per AP.
+        """
+        if self.maps is None:
+            return None
+        from server.models import AccessPoint, ContributedAP
+        ap, contributed = AccessPoint.__table__, ContributedAP.__table__
+
+        def build():
+            whole = [id for id, fence in self.maps.items() if fence is None]
+            clauses = [ap.c.mac.in_(select(contributed.c.mac).where(contributed.c.map_id.in_(whole)))] if whole else []
+            clauses += [and_(ap.c.gps_lat.between(fence[0], fence[2]), ap.c.gps_lon.between(fence[1], fence[3]),
+                             ap.c.mac.in_(select(contributed.c.mac).where(contributed.c.map_id == id)))
+                        for id, fence in self.maps.items() if fence is not None]
+            return or_(*clauses) if clauses else false()
+        return self._predicate('access_point', build)
+
+    def map_filter(self, column):
+        """
+        Predicate for a map_id column (e.g. of the change log), None if everything is visible
+        """
+        if self.maps is None:
+            return None
+        return self._predicate(column, lambda: column.in_(list(self.maps)) if self.maps else false())
+
+
+#admins and everyone while the ACL is disabled
+EVERYTHING = Visibility()
+
+
+class MapACL():
+    """
+    Extension object computing and caching what the users may see (used just like 'db')
+    """
+    def __init__(self):
+        self.enabled = False
+        self._cache = LRUCache(0)
+        self._lock = Lock()
+        #increased whenever grants change, so entries computed before are not used anymore
+        self._generation = 0
+
+    def init_app(self, app):
+        self.enabled = app.config['MAP_ACL_ENABLED']
+        self.ttl = app.config['MAP_ACL_CACHE_TTL']
+        self._cache = LRUCache(app.config['MAP_ACL_CACHE_SIZE'])
+        app.extensions['acl'] = self
+
+    def visibility(self, user=None):
+        """
+        Visibility of the user (default: the current user of the request)
+        """
+        if user is None:
+            user = g.get('current_user') if has_app_context() else None
+        if not self.enabled or user is None or user.admin:
+            return EVERYTHING
+
+        now = time.monotonic()
+        cached = self._cache.get(user.id)
+        if cached is not None:
+            expires, generation, visibility = cached
+            if expires > now and generation == self._generation:
+                return visibility
+
+        generation = self._generation
+        visibility = Visibility(self._load(user.id))
+        self._cache.put(user.id, (now + self.ttl, generation, visibility))
+        return visibility
+
+    def _load(self, user_id):
+        from server import db
+        from server.models import MapAccess, participate_in
+
+        maps = {}
+        for map_id, lat_min, lon_min, lat_max, lon_max in db.session.query(
+                MapAccess.map_id, MapAccess.lat_min, MapAccess.lon_min, MapAccess.lat_max, MapAccess.lon_max) \
+                .filter(MapAccess.user_id == user_id):
+            maps[map_id] = (lat_min, lon_min, lat_max, lon_max) if lat_min is not None else None
+        #sniffers see everything on the maps they contributed to, unless a grant restricts them to a fence
+        for map_id, in db.session.query(participate_in.c.map_id).filter(participate_in.c.sniffer_id == user_id):
+            maps.setdefault(map_id, None)
+        return maps
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+        self._cache.clear()
+
+    def grant(self, map_id, user_id, bbox=None):
+        """
+        Share the map with the user (replaces an earlier grant); bbox: (lat_min, lon_min, lat_max, lon_max) or None
+        """
+        from server import db
+        from server.models import MapAccess
+
+        access = MapAccess.query.get((map_id, user_id)) or MapAccess(map_id=map_id, user_id=user_id)
+        access.lat_min, access.lon_min, access.lat_max, access.lon_max = bbox if bbox else (None,) * 4
+        db.session.add(access)
+        db.session.commit()
+        #only after the commit, so nobody caches the old grants again in between
+        self.invalidate()
+        return access
+
+    def revoke(self, map_id, user_id):
+        """
+        Returns False if the map had not been shared with the user
+        """
+        from server import db
+        from server.models import MapAccess
+
+        access = MapAccess.query.get((map_id, user_id))
+        if access is None:
+            return False
+        db.session.delete(access)
+        db.session.commit()
+        self.invalidate()
+        return True
+
+
+acl = MapACL()
@@ -0,0 +1,356 @@
+import json
+import math
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, bindparam, case, and_
+
+from server import gps
+from server.ingest import insert_ignore
+from server.models import Discovery, AccessPoint, AnomalyFinding, APPosition, AnalysisCursor, Encryption
+
+
+"""
+Background job looking for suspicious APs, e.g. for security teams hunting evil twins
+(flask data anomalies, e.g. from cron; the findings are served by GET /maps/<id>/alerts):
+- evil_twin: another AP nearby (ANOMALY_TWIN_RADIUS) announces the same SSID with a different encryption,
+  e.g. an open hotspot named like the WPA2 network of a cafe
+- ssid_clone: same SSID nearby with the same encryption, but on another channel and from another vendor (OUI)
+- displaced: an AP is seen further than ANOMALY_DISPLACEMENT away from its usual position (the mean of at least
+  ANOMALY_MIN_SIGHTINGS earlier sightings, see APPosition, including those earlier in the same chunk),
+  e.g. a spoofed MAC or a mobile hotspot
+
+Every run continues after the last discovery the previous run processed (AnalysisCursor) and reads the new ones
+in chunks of ANOMALY_CHUNK_SIZE, so the memory needed doesn't depend on the size of the maps. Within a chunk,
+everything is done with numpy arrays: the SSIDs of the chunk are grouped (sorted codes), the APs of the directory
+with these SSIDs are fetched tile by tile (using the index on gps_lat/gps_lon), and the discoveries are paired
+with the APs of the same SSID via searchsorted, in slices of at most ANOMALY_MAX_PAIRS pairs.
+Each chunk is processed in one transaction together with moving the cursor, so a crash doesn't count anything
+twice, and concurrent runs wait for each other (the cursor row is locked).
+
+NOTE: only the discovery table is analysed, not the discoveries of sharded maps (SHARDING_ENABLED) or of maps
+that were finalized before the job saw them.
+"""
+
+CURSOR = 'anomalies'
+
+#size of the tiles [degrees] in which the APs with the SSIDs of a chunk are looked up
+TILE = 0.05
+
+#SSIDs per lookup query
+SSID_BATCH = 500
+
+EVIL_TWIN, SSID_CLONE, DISPLACED = AnomalyFinding.EVIL_TWIN, AnomalyFinding.SSID_CLONE, AnomalyFinding.DISPLACED
+SEVERITIES = ['low', 'medium', 'high']
+
+
+def _is_randomized(mac):
+    #locally administered MACs (e.g. of phone hotspots) are not bound to a place anyway
+    return bool((mac >> 40) & 0x02)
+
+
+def _groups(keys, by):
+    """
+    Indices of the rows with equal keys (list of arrays), group by group, each ordered by 'by'
+    """
+    if not len(by):
+        return []
+    #lexsort: the last array is the primary key
+    order = np.lexsort([by] + keys[::-1])
+    new = np.zeros(len(order), dtype=bool)
+    new[0] = True
+    for key in keys:
+        key = key[order]
+        new[1:] |= key[1:] != key[:-1]
+    return np.split(order, np.flatnonzero(new)[1:])
+
+
+class AnomalyDetector():
+    """
+    twin_radius, displacement: [m]
+    """
+    def __init__(self, twin_radius=500, displacement=2000, min_sightings=3, chunk_size=10000, max_pairs=1000000):
+        self.twin_radius = twin_radius
+        self.displacement = displacement
+        self.min_sightings = min_sightings
+        self.chunk_size = chunk_size
+        self.max_pairs = max_pairs
+
+    @classmethod
+    def from_config(cls, config, **overrides):
+        settings = dict(twin_radius=config['ANOMALY_TWIN_RADIUS'], displacement=config['ANOMALY_DISPLACEMENT'],
+                        min_sightings=config['ANOMALY_MIN_SIGHTINGS'], chunk_size=config['ANOMALY_CHUNK_SIZE'],
+                        max_pairs=config['ANOMALY_MAX_PAIRS'])
+        settings.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**settings)
+
+    def run(self, engine, progress=None):
+        """
+        Analyse all discoveries added since the last run.
+        Returns {'discoveries': number processed, kind: number of sightings of this kind, ...}
+        """
+        stats = {'discoveries': 0, EVIL_TWIN: 0, SSID_CLONE: 0, DISPLACED: 0}
+        while True:
+            with engine.begin() as conn:
+                last_id = self._lock_cursor(conn)
+                chunk = self._read_chunk(conn, last_id)
+                if chunk is None:
+                    break
+                findings = self._twins(conn, chunk) + self._displaced(conn, chunk)
+                self._store(conn, findings)
+                conn.execute(AnalysisCursor.__table__.update().where(AnalysisCursor.__table__.c.name == CURSOR)
+                             .values(last_id=int(chunk['id'][-1])))
+
+            stats['discoveries'] += len(chunk['id'])
+            for finding in findings:
+                stats[finding['kind']] += finding['count']
+            if progress:
+                progress(stats['discoveries'])
+        return stats
+
+    def reset(self, engine):
+        """
+        Forget everything, so the next run analyses all discoveries again
+        """
+        with engine.begin() as conn:
+            for model in (AnomalyFinding, APPosition, AnalysisCursor):
+                conn.execute(model.__table__.delete())
+
+    def _lock_cursor(self, conn):
+        table = AnalysisCursor.__table__
+        insert_ignore(conn, table, [{'name': CURSOR, 'last_id': 0}])
+        #FOR UPDATE: a second run waits until this chunk is committed (SQLite locks the whole DB anyway)
+        return conn.execute(select(table.c.last_id).where(table.c.name == CURSOR).with_for_update()).scalar()
+
+    def _read_chunk(self, conn, last_id):
+        """
+        The next discoveries after last_id as numpy arrays (None if there are none)
+        """
+        #NOTE: ids are assigned when inserting, but transactions can commit out of order, so a discovery
+        #committed long after the ones with higher ids could be skipped (only likely with long upload transactions)
+        t = Discovery.__table__
+        rows = conn.execute(select(t.c.id, t.c.map_id, t.c.access_point_mac, t.c.ssid, t.c.encryption, t.c.channel,
+                                   t.c.gps_lat, t.c.gps_lon, t.c.timestamp)
+                            .where(t.c.id > last_id).order_by(t.c.id).limit(self.chunk_size)).all()
+        if not rows:
+            return None
+        id, map_id, mac, ssid, encryption, channel, lat, lon, timestamp = zip(*rows)
+        return {'id': np.array(id, dtype=np.int64), 'map_id': np.array(map_id, dtype=np.int64),
+                'mac': np.array(mac, dtype=np.int64), 'ssid': np.array(ssid, dtype=object),
+                'encryption': np.array(encryption, dtype=np.int64), 'channel': np.array(channel, dtype=np.int64),
+                'lat': np.array(lat, dtype=np.float64), 'lon': np.array(lon, dtype=np.float64),
+                'timestamp': np.array(timestamp, dtype='datetime64[us]')}
+
+    ################################## evil twins ##################################################
+
+    def _candidates(self, conn, ssids, lat_min, lon_min, lat_max, lon_max):
+        """
+        The APs of the directory with one of these SSIDs within the box, as numpy arrays
+        """
+        t = AccessPoint.__table__
+        rows = []
+        for i in range(0, len(ssids), SSID_BATCH):
+            rows += conn.execute(select(t.c.mac, t.c.last_ssid, t.c.last_encryption, t.c.last_channel,
+                                        t.c.gps_lat, t.c.gps_lon)
+                                 .where(t.c.last_ssid.in_(ssids[i:i + SSID_BATCH]),
+                                        t.c.gps_lat.between(lat_min, lat_max),
+                                        t.c.gps_lon.between(lon_min, lon_max))).all()
+        mac, ssid, encryption, channel, lat, lon = zip(*rows) if rows else ([],) * 6
+        return {'mac': np.array(mac, dtype=np.int64), 'ssid': np.array(ssid, dtype=object),
+                'encryption': np.array(encryption, dtype=np.int64), 'channel': np.array(channel, dtype=np.int64),
+                'lat': np.array(lat, dtype=np.float64), 'lon': np.array(lon, dtype=np.float64)}
+
+    def _twins(self, conn, chunk):
+        #only the latest discovery of every AP per map matters for the comparison (and hidden SSIDs can't be compared)
+        named = np.flatnonzero(np.array([bool(s) for s in chunk['ssid']], dtype=bool))
+        if not len(named):
+            return []
+        order = named[np.lexsort((chunk['id'][named], chunk['mac'][named], chunk['map_id'][named]))]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (chunk['map_id'][order[1:]] != chunk['map_id'][order[:-1]]) | \
+                    (chunk['mac'][order[1:]] != chunk['mac'][order[:-1]])
+        latest = order[last]
+
+        #group the discoveries into tiles, so every lookup only covers a small area around them
+        tile_lat = np.floor(chunk['lat'][latest] / TILE).astype(np.int64)
+        tile_lon = np.floor(chunk['lon'][latest] / TILE).astype(np.int64)
+        tiles, tile_of = np.unique(np.stack([tile_lat, tile_lon], axis=1), axis=0, return_inverse=True)
+        tile_of = tile_of.reshape(-1)
+        margin_lat = self.twin_radius / 1000 / 111.0 * 1.01
+
+        findings = []
+        for t, (y, x) in enumerate(tiles):
+            members = latest[tile_of == t]
+            lat_min, lat_max = y * TILE - margin_lat, (y + 1) * TILE + margin_lat
+            margin_lon = margin_lat / max(math.cos(math.radians(max(abs(lat_min), abs(lat_max)))), 0.01)
+            lon_min, lon_max = x * TILE - margin_lon, (x + 1) * TILE + margin_lon
+
+            #group by SSID: codes of the tile's SSIDs, the candidates sorted by code
+            ssids, codes = np.unique(chunk['ssid'][members], return_inverse=True)
+            candidates = self._candidates(conn, list(ssids), lat_min, lon_min, lat_max, lon_max)
+            if not len(candidates['mac']):
+                continue
+            index = {ssid: i for i, ssid in enumerate(ssids)}
+            candidate_codes = np.array([index[s] for s in candidates['ssid']], dtype=np.int64)
+            by_code = np.argsort(candidate_codes, kind='stable')
+            sorted_codes = candidate_codes[by_code]
+            starts = np.searchsorted(sorted_codes, codes, 'left')
+            counts = np.searchsorted(sorted_codes, codes, 'right') - starts
+            findings += self._compare(chunk, members, starts, counts, by_code, candidates)
+        return findings
+
+    def _compare(self, chunk, members, starts, counts, by_code, candidates):
+        """
+        Pair every discovery with the candidates of its SSID (at most max_pairs at a time)
+        """
+        findings = []
+        ends = np.cumsum(counts)
+        begin = 0
+        while begin < len(members):
+            offset = ends[begin] - counts[begin]
+            end = max(int(np.searchsorted(ends, offset + self.max_pairs, 'right')), begin + 1)
+            repeats = counts[begin:end]
+            d = np.repeat(np.arange(begin, end), repeats)
+            #position of each pair within the candidates of its discovery
+            within = np.arange(len(d)) - np.repeat(ends[begin:end] - repeats - offset, repeats)
+            c = by_code[starts[d] + within]
+            begin = end
+
+            i = members[d]
+            distance = gps.distance_simple_pairs(chunk['lat'][i], chunk['lon'][i],
+                                                 candidates['lat'][c], candidates['lon'][c]) * 1000
+            near = (chunk['mac'][i] != candidates['mac'][c]) & (distance <= self.twin_radius)
+            i, c, distance = i[near], c[near], distance[near]
+
+            encryption, other_encryption = chunk['encryption'][i], candidates['encryption'][c]
+            twin = encryption != other_encryption
+            clone = ~twin & (chunk['channel'][i] != candidates['channel'][c]) & \
+                (chunk['mac'][i] >> 24 != candidates['mac'][c] >> 24)
+            #downgrade from WPA/WPA2 to open or WEP is what an attacker would use
+            weak = np.minimum(encryption, other_encryption) <= Encryption.WEP
+            strong = np.maximum(encryption, other_encryption) >= Encryption.WPA
+
+            flagged = np.flatnonzero(twin | clone)
+            i, c, distance, twin = i[flagged], c[flagged], distance[flagged], twin[flagged]
+            severity = np.where(twin, np.where(weak[flagged] & strong[flagged], 2, 1), 0)
+            mac, other = chunk['mac'][i], candidates['mac'][c]
+            #one row per pair, no matter which of the two was discovered
+            first, second = np.minimum(mac, other), np.maximum(mac, other)
+            for rows in _groups([chunk['map_id'][i], twin, first, second], chunk['timestamp'][i]):
+                k = rows[-1]
+                a = (int(mac[k]), int(chunk['encryption'][i[k]]), int(chunk['channel'][i[k]]))
+                b = (int(other[k]), int(candidates['encryption'][c[k]]), int(candidates['channel'][c[k]]))
+                a, b = sorted([a, b])
+                findings.append(self._finding(chunk, i[rows], EVIL_TWIN if twin[k] else SSID_CLONE, a[0], b[0],
+                                              SEVERITIES[severity[k]], distance[rows],
+                                              {'encryption': [a[1], b[1]], 'channel': [a[2], b[2]]}))
+        return findings
+
+    ################################## displaced APs ###############################################
+
+    def _displaced(self, conn, chunk):
+        t = APPosition.__table__
+        macs, inverse = np.unique(chunk['mac'], return_inverse=True)
+        known = {}
+        for i in range(0, len(macs), SSID_BATCH):
+            known.update((row.mac, row) for row in conn.execute(
+                select(t.c.mac, t.c.sightings, t.c.gps_lat, t.c.gps_lon)
+                .where(t.c.mac.in_([int(mac) for mac in macs[i:i + SSID_BATCH]]))))
+        sightings = np.array([known[m].sightings if m in known else 0 for m in macs.tolist()], dtype=np.int64)
+        usual_lat = np.array([known[m].gps_lat if m in known else 0 for m in macs.tolist()], dtype=np.float64)
+        usual_lon = np.array([known[m].gps_lon if m in known else 0 for m in macs.tolist()], dtype=np.float64)
+
+        #every sighting is compared with the usual position at its time: the chunk is walked through in time order
+        #per AP, and the sightings which are not displaced move the usual position (running mean) for the next ones,
+        #so an AP first seen in this chunk can be displaced within it as well
+        count, mean_lat, mean_lon = sightings.copy(), usual_lat.copy(), usual_lon.copy()
+        n = len(chunk['mac'])
+        distance, displaced = np.zeros(n), np.zeros(n, dtype=bool)
+        #the usual position each sighting was compared with (for the details of the findings)
+        seen_lat, seen_lon, seen_count = np.zeros(n), np.zeros(n), np.zeros(n, dtype=np.int64)
+        lat, lon = chunk['lat'].tolist(), chunk['lon'].tolist()
+        for i in np.lexsort((chunk['id'], chunk['timestamp'], inverse)).tolist():
+            m = inverse[i]
+            seen_lat[i], seen_lon[i], seen_count[i] = mean_lat[m], mean_lon[m], count[m]
+            if count[m] >= self.min_sightings:
+                distance[i] = gps.distance_simple(gps.Point(lat[i], lon[i]), gps.Point(mean_lat[m], mean_lon[m])) * 1000
+                if distance[i] > self.displacement:
+                    displaced[i] = True
+                    continue
+            count[m] += 1
+            mean_lat[m] += (lat[i] - mean_lat[m]) / count[m]
+            mean_lon[m] += (lon[i] - mean_lon[m]) / count[m]
+
+        findings = []
+        flagged = np.flatnonzero(displaced)
+        for rows in _groups([chunk['map_id'][flagged], chunk['mac'][flagged]], chunk['timestamp'][flagged]):
+            k = flagged[rows[-1]]
+            mac = int(chunk['mac'][k])
+            findings.append(self._finding(chunk, flagged[rows], DISPLACED, mac, 0,
+                                          SEVERITIES[0 if _is_randomized(mac) else 1], distance[flagged[rows]],
+                                          {'usual_position': [float(seen_lat[k]), float(seen_lon[k])],
+                                           'sightings': int(seen_count[k])}))
+
+        changed = np.flatnonzero(count > sightings)
+        rows = [{'mac': int(macs[m]), 'sightings': int(count[m]), 'gps_lat': float(mean_lat[m]),
+                 'gps_lon': float(mean_lon[m])} for m in changed]
+        new = [row for row in rows if row['mac'] not in known]
+        existing = [{'b_mac': row['mac'], 'sightings': row['sightings'], 'gps_lat': row['gps_lat'],
+                     'gps_lon': row['gps_lon']} for row in rows if row['mac'] in known]
+        if new:
+            conn.execute(t.insert(), new)
+        if existing:
+            conn.execute(t.update().where(t.c.mac == bindparam('b_mac')), existing)
+        return findings
+
+    ################################## storing #####################################################
+
+    def _finding(self, chunk, rows, kind, mac, other_mac, severity, distances, details):
+        """
+        One finding from several sightings (rows of the chunk ordered by time): described by the latest one
+        """
+        i = rows[-1]
+        return {'map_id': int(chunk['map_id'][i]), 'kind': kind, 'mac': mac, 'other_mac': other_mac,
+                'ssid': chunk['ssid'][i], 'severity': severity, 'distance': round(float(distances.max()), 1),
+                'details': json.dumps(details), 'gps_lat': float(chunk['lat'][i]), 'gps_lon': float(chunk['lon'][i]),
+                'first_seen': chunk['timestamp'][rows[0]].astype(datetime),
+                'last_seen': chunk['timestamp'][i].astype(datetime), 'count': len(rows)}
+
+    def _store(self, conn, findings):
+        """
+        Add the findings of a chunk to the existing rows (one row per map, kind and AP or pair)
+        """
+        if not findings:
+            return
+        t = AnomalyFinding.__table__
+        rows = {}
+        for f in findings:
+            key = (f['map_id'], f['kind'], f['mac'], f['other_mac'])
+            row = rows.get(key)
+            if row is None:
+                rows[key] = dict(f)
+                continue
+            #the same pair found in different tiles or slices
+            row['count'] += f['count']
+            row['distance'] = max(row['distance'], f['distance'])
+            row['first_seen'] = min(row['first_seen'], f['first_seen'])
+            if f['last_seen'] >= row['last_seen']:
+                row.update({k: f[k] for k in ('ssid', 'severity', 'details', 'gps_lat', 'gps_lon', 'last_seen')})
+
+        columns = [c.name for c in t.columns]
+        insert_ignore(conn, t, [dict({c: row[c] for c in columns}, count=0) for row in rows.values()])
+        #relative update, so rows which already existed are only extended
+        first, last, distance = bindparam('b_first_seen'), bindparam('b_last_seen'), bindparam('b_distance')
+        newer = t.c.last_seen <= last
+        conn.execute(t.update().where(and_(t.c.map_id == bindparam('b_map_id'), t.c.kind == bindparam('b_kind'),
+                                           t.c.mac == bindparam('b_mac'), t.c.other_mac == bindparam('b_other_mac')))
+                     .values(count=t.c.count + bindparam('b_count'),
+                             first_seen=case((t.c.first_seen > first, first), else_=t.c.first_seen),
+                             distance=case((t.c.distance < distance, distance), else_=t.c.distance),
+                             ssid=case((newer, bindparam('b_ssid')), else_=t.c.ssid),
+                             severity=case((newer, bindparam('b_severity')), else_=t.c.severity),
+                             details=case((newer, bindparam('b_details')), else_=t.c.details),
+                             gps_lat=case((newer, bindparam('b_gps_lat')), else_=t.c.gps_lat),
+                             gps_lon=case((newer, bindparam('b_gps_lon')), else_=t.c.gps_lon),
+                             last_seen=case((newer, last), else_=t.c.last_seen)),
+                     [{f'b_{c}': row[c] for c in columns} for row in rows.values()])
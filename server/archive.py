@@ -0,0 +1,300 @@
+import json
+import os
+import shutil
+from datetime import datetime
+from threading import Lock
+
+import numpy as np
+from sqlalchemy import select
+
+from server.cache import LRUCache
+
+
+"""
+Archive of finalized maps:
+a finished map is never written again, so its discoveries don't have to stay in the discovery table, where they
+make every index used by the live ingest bigger. Finalizing a map moves its discoveries into a read-only,
+columnar archive next to the DB (ARCHIVE_DIRECTORY/map_<id>/):
+
+- every column is a .npy file with the smallest sufficient data type
+- strings (ssid, client_discovery_id) are dictionary encoded: the file only contains numbers which point into a
+  list of the distinct values (stored in meta.json), SSIDs repeat a lot within a map
+- the rows are sorted by latitude, so a bounding box query only has to look at a small slice of the columns
+
+The columns are opened as memory-mapped files, so only the parts actually needed are read from disk and the OS
+shares the pages between all worker processes. Reactivating a map moves the discoveries back into the DB.
+Every process keeps its open archives (ARCHIVE_CACHE_SIZE), but checks before every read that the archive
+hasn't been removed or replaced by another process in the meantime (one stat of its meta.json).
+
+NOTE: in sharded mode (see server/sharding.py), the discoveries in the shard of a map already are in a separate file,
+so only the discoveries in the main DB are archived.
+"""
+
+#column -> data type in the archive; None means dictionary encoded string
+ARCHIVE_COLUMNS = {
+    'id': np.int64,
+    'access_point_mac': np.int64,
+    'channel': np.int16,
+    'encryption': np.int8,
+    'signal_strength': np.int16,
+    'ssid': None,
+    'timestamp': 'datetime64[us]',
+    'gps_lat': np.float64,
+    'gps_lon': np.float64,
+    'client_discovery_id': None,
+    'sniffer_id': np.int32,
+}
+
+#code of missing strings (NULL)
+NO_STRING = -1
+#ids per DELETE statement when the archived discoveries are removed from the discovery table
+DELETE_CHUNK = 10000
+
+
+class ArchivedDiscovery():
+    """
+    Read-only stand-in for a Discovery model object whose row is stored in an archive.
+    It has the same attributes, so it can be dumped with the usual marshmallow schemas.
+    """
+    def __init__(self, values, map_id, sniffer=None):
+        for column, value in values.items():
+            setattr(self, column, value)
+        self.map_id = map_id
+        self.sniffer = sniffer
+
+
+class _OpenArchive():
+    """
+    The memory-mapped columns of one archive
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.columns = {column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r')
+                        for column in ARCHIVE_COLUMNS}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def select(self, bbox=None):
+        """
+        Indices of the rows within bbox (lat_min, lon_min, lat_max, lon_max), or of all rows
+        """
+        if not bbox:
+            return np.arange(len(self))
+        lat = self.columns['gps_lat']
+        #the rows are sorted by latitude: binary search instead of reading the whole column
+        first, last = np.searchsorted(lat, bbox[0], side='left'), np.searchsorted(lat, bbox[2], side='right')
+        lon = np.asarray(self.columns['gps_lon'][first:last])
+        return first + np.flatnonzero((lon >= bbox[1]) & (lon <= bbox[3]))
+
+    def value(self, column, codes):
+        strings = self.meta['strings'][column]
+        return [None if code == NO_STRING else strings[code] for code in codes.tolist()]
+
+    def rows(self, indices):
+        """
+        The rows at these indices as dicts with python values (like the rows of the discovery table)
+        """
+        values = {}
+        for column, dtype in ARCHIVE_COLUMNS.items():
+            data = self.columns[column][indices]
+            if dtype is None:
+                values[column] = self.value(column, data)
+            elif column == 'timestamp':
+                values[column] = data.astype(object).tolist()
+            else:
+                values[column] = data.tolist()
+        return [dict(zip(values, row)) for row in zip(*values.values())]
+
+
+class MapArchive():
+    """
+    Extension object (used just like 'db') to finalize, read and reactivate archived maps
+    """
+    def __init__(self):
+        self._open = LRUCache(0)
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.directory = os.path.join(app.root_path, app.config['ARCHIVE_DIRECTORY'])
+        self.reactivate_on_write = app.config['ARCHIVE_REACTIVATE_ON_WRITE']
+        self._open = LRUCache(app.config['ARCHIVE_CACHE_SIZE'])
+        app.extensions['archive'] = self
+
+    def path(self, map_id):
+        return os.path.join(self.directory, f'map_{int(map_id)}')
+
+    def _get(self, map_id):
+        #another process may have reactivated the map (or finalized it again) since it was opened here, so the
+        #cached columns are only used as long as the archive still has the same meta.json
+        try:
+            stat = os.stat(os.path.join(self.path(map_id), 'meta.json'))
+        except FileNotFoundError:
+            return None
+        version = (stat.st_ino, stat.st_mtime_ns)
+        archive = self._open.get(int(map_id))
+        if archive is None or archive.version != version:
+            try:
+                archive = _OpenArchive(self.path(map_id))
+            except FileNotFoundError:
+                return None
+            archive.version = version
+            self._open.put(int(map_id), archive)
+        return archive
+
+    ################################## finalize and reactivate ###########################################
+
+    def _write(self, map_id, rows):
+        """
+        Write the rows (dicts of the discovery table) as archive. The files are first written to a temporary
+        directory which is then renamed, so an archive is either complete or not there at all.
+        """
+        rows = sorted(rows, key=lambda row: row['gps_lat'])
+        tmp = self.path(map_id) + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        strings = {}
+        for column, dtype in ARCHIVE_COLUMNS.items():
+            values = [row[column] for row in rows]
+            if dtype is None:
+                distinct = sorted({v for v in values if v is not None})
+                code = {v: i for i, v in enumerate(distinct)}
+                strings[column] = distinct
+                data = np.array([NO_STRING if v is None else code[v] for v in values],
+                                dtype=np.int32 if len(distinct) > 30000 else np.int16)
+            else:
+                data = np.array(values, dtype=dtype)
+            np.save(os.path.join(tmp, column + '.npy'), data)
+
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'map_id': int(map_id), 'rows': len(rows), 'strings': strings,
+                       'created': datetime.utcnow().isoformat()}, f)
+        os.replace(tmp, self.path(map_id))
+
+    def finalize(self, map):
+        """
+        Move all discoveries of the map (WardrivingMap object) into its archive and mark it as archived.
+        Returns the number of archived discoveries.
+        """
+        from server import db
+        from server.models import Discovery
+        table = Discovery.__table__
+
+        with self._lock:
+            rows = [dict(row._mapping) for row in db.session.execute(
+                select(*[table.c[column] for column in ARCHIVE_COLUMNS]).where(table.c.map_id == map.id))]
+            self._write(map.id, rows)
+            try:
+                #only the archived rows: discoveries added since the select above (by a request which found the map
+                #still writable) stay in the discovery table, where they are read together with the archive
+                ids = [row['id'] for row in rows]
+                for i in range(0, len(ids), DELETE_CHUNK):
+                    db.session.execute(table.delete().where(table.c.map_id == map.id,
+                                                            table.c.id.in_(ids[i:i + DELETE_CHUNK])))
+                map.archived = True
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                shutil.rmtree(self.path(map.id), ignore_errors=True)
+                raise
+            self._open.clear()
+        return len(rows)
+
+    def reactivate(self, map):
+        """
+        Move the discoveries of an archived map back into the discovery table, so it can be written to again.
+        Returns the number of restored discoveries.
+        """
+        from server import db
+        from server.models import Discovery
+
+        with self._lock:
+            archive = self._get(map.id)
+            rows = archive.rows(np.arange(len(archive))) if archive is not None else []
+            for row in rows:
+                row['map_id'] = map.id
+            if rows:
+                db.session.execute(Discovery.__table__.insert(), rows)
+            map.archived = False
+            db.session.commit()
+
+            self._open.clear()
+            shutil.rmtree(self.path(map.id), ignore_errors=True)
+        return len(rows)
+
+    def ensure_writable(self, map):
+        """
+        Called before new discoveries are added to a map: reactivates it if it is archived (and ARCHIVE_REACTIVATE_ON_WRITE).
+        Returns False if the map is archived and stays that way.
+        """
+        if not map.archived:
+            return True
+        if not self.reactivate_on_write:
+            return False
+        self.reactivate(map)
+        return True
+
+    def delete(self, map_id):
+        with self._lock:
+            self._open.clear()
+            shutil.rmtree(self.path(map_id), ignore_errors=True)
+
+    ################################## reads ###############################################################
+
+    def map_ids(self):
+        """
+        Ids of all maps with an archive
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[4:]) for name in names if name.startswith('map_') and name[4:].isdigit())
+
+    def rows(self, map_id=None, bbox=None, **filters):
+        """
+        The archived discoveries of a map (of all archived maps if map_id is None) as dicts with their map_id.
+        bbox: (lat_min, lon_min, lat_max, lon_max)
+        filters: equality conditions on numeric columns, e.g. access_point_mac=... or sniffer_id=...
+        """
+        rows = []
+        for id in (self.map_ids() if map_id is None else [map_id]):
+            archive = self._get(id)
+            if archive is None:
+                continue
+            indices = archive.select(bbox)
+            for column, value in filters.items():
+                indices = indices[np.asarray(archive.columns[column][indices]) == value]
+            rows += [dict(row, map_id=int(id)) for row in archive.rows(indices)]
+        return rows
+
+    def discoveries(self, map_id=None, bbox=None, **filters):
+        """
+        Like rows(), but returns ArchivedDiscovery objects which can be dumped like Discovery objects
+        """
+        rows = self.rows(map_id, bbox, **filters)
+        if not rows:
+            return []
+
+        #resolve the sniffers with one query instead of one per discovery
+        from server.models import Sniffer
+        sniffers = {s.id: s for s in Sniffer.query.filter(Sniffer.id.in_({row['sniffer_id'] for row in rows})).all()}
+        return [ArchivedDiscovery(row, row['map_id'], sniffers.get(row['sniffer_id'])) for row in rows]
+
+    def columns(self, map_id, columns, bbox=None, **filters):
+        """
+        Numpy arrays of the given (numeric) columns of the archived discoveries, e.g. for heatmaps.
+        filters: equality conditions on numeric columns, e.g. access_point_mac=...
+        """
+        archive = self._get(map_id)
+        if archive is None:
+            return [np.array([]) for _ in columns]
+        indices = archive.select(bbox)
+        for column, value in filters.items():
+            indices = indices[np.asarray(archive.columns[column][indices]) == value]
+        return [np.asarray(archive.columns[column][indices]) for column in columns]
+
+
+archive = MapArchive()
@@ -0,0 +1,465 @@
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import jwt
+from marshmallow import ValidationError
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from werkzeug.exceptions import NotFound
+from werkzeug.http import parse_accept_header
+
+#SQLAlchemy's asyncio extension needs greenlet, and the async DB drivers (aiosqlite/aiomysql) are optional,
+#so only fail once the ASGI server is actually created
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+except ImportError:
+    create_async_engine = None
+
+from server import db
+from server.compression import available_encodings, compress, get_decompressor, BodyTooLarge, DECOMPRESSION_ERRORS
+from server.models import User, WardrivingMap
+from server.ratelimit import limiter
+from server.sharding import shards
+from server.archive import archive
+from server.ingest import store_discovery, RESPONSES
+from server.acl import acl, EVERYTHING
+from server.storage import storage, viewport_bbox
+
+
+"""
+ASGI serving mode (see asgi.py in the project directory), e.g.:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 4242
+
+Slow sniffer uploads and big viewport downloads don't tie up a thread here: the ingest route
+(POST /maps/<id>) and the viewport route (GET /maps/<id>/aps) receive and send their bodies on the event loop.
+Login, rate limits and the map lookup use async DB access (SQLAlchemy asyncio with aiosqlite or aiomysql); the
+discovery itself is stored by the same code as in the Flask route (server/ingest.py) on the async connection, and
+the viewport is read by the same code as in the Flask route (server/storage.py) in the thread pool.
+All other routes are passed on to the usual Flask app, which runs in a thread pool (ASGI_WSGI_THREADS), so the URLs,
+auth and responses are the same as with the WSGI server.
+
+NOTE: the async routes always use the primary DB (no read replicas) and don't support CORS preflight
+requests themselves (OPTIONS requests are answered by the Flask app).
+"""
+
+#async drivers used for the (sync) drivers of SQLALCHEMY_DATABASE_URI
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'mysql': 'mysql+aiomysql', 'postgresql': 'postgresql+asyncpg'}
+
+
+def async_database_uri(app):
+    """
+    The URI of the app's DB with an async driver (unless ASYNC_DATABASE_URI is set explicitly)
+    """
+    if app.config['ASYNC_DATABASE_URI']:
+        return app.config['ASYNC_DATABASE_URI']
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'There is no async driver for <{backend}>, please set ASYNC_DATABASE_URI.')
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    #Flask-SQLAlchemy interprets relative SQLite paths relative to the app, so we have to do the same
+    if backend == 'sqlite' and url.database and url.database != ':memory:' and not os.path.isabs(url.database):
+        url = url.set(database=os.path.join(app.root_path, url.database))
+    return str(url)
+
+
+class Response():
+    def __init__(self, body, status=200, headers=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+
+
+class AsyncServer():
+    """
+    ASGI application serving the I/O bound routes asynchronously and everything else with the Flask app
+    """
+    #(method, path regex, handler name, Flask endpoint name used for the rate limits)
+    ROUTES = [('POST', re.compile(r'^/maps/([^/]+)$'), 'add_discovery', 'maps.add_discovery'),
+              ('GET', re.compile(r'^/maps/([^/]+)/aps$'), 'get_aps', 'maps.get_aps')]
+
+    def __init__(self, app):
+        if create_async_engine is None:
+            raise RuntimeError('The ASGI server needs SQLAlchemy with asyncio support (greenlet).')
+        self.app = app
+        self.config = app.config
+        self.database_uri = async_database_uri(app)
+        self.engine = None
+        self.session = None
+        #SQLite allows only one writer at a time, so the async routes queue up here instead of failing
+        #with 'database is locked' when many uploads arrive at once
+        self._serialize_writes = make_url(self.database_uri).get_backend_name() == 'sqlite'
+        self._write_lock = None
+        self.executor = ThreadPoolExecutor(app.config['ASGI_WSGI_THREADS'], thread_name_prefix='wsgi')
+
+    async def _startup(self):
+        if self.engine is None:
+            #a bounded pool: thousands of open connections would cost more than waiting for a free one
+            #(every aiosqlite connection even has its own thread)
+            self.engine = create_async_engine(self.database_uri, poolclass=AsyncAdaptedQueuePool,
+                                              pool_size=self.config['ASYNC_POOL_SIZE'], max_overflow=0)
+            self._write_lock = asyncio.Lock() if self._serialize_writes else None
+            self.session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+            #the ingest route runs without an app context, so the writers of the sharded ingest can't be started
+            #by the first discovery (nothing happens if the gunicorn master already started them)
+            if shards.enabled:
+                with self.app.app_context():
+                    shards.start()
+
+    async def _shutdown(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+        self.executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise RuntimeError(f'Unsupported ASGI scope <{scope["type"]}>.')
+
+        for method, pattern, handler, endpoint in self.ROUTES:
+            match = pattern.match(scope['path'])
+            if match and scope['method'] == method:
+                await self._startup()
+                response = await getattr(self, handler)(_Request(scope, receive), endpoint, *match.groups())
+                return await self._send(scope, send, response)
+        await self._call_wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self._startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self._shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    ################################## responses ######################################################
+
+    def _json(self, data, status=200, **headers):
+        #same format as Flask's jsonify
+        body = json.dumps(data, separators=(',', ':'), sort_keys=self.config['JSON_SORT_KEYS']) + '\n'
+        return Response(body.encode(), status, dict(headers, **{'Content-Type': 'application/json'}))
+
+    async def _send(self, scope, send, response):
+        headers = dict(response.headers)
+        request_headers = _headers(scope)
+        body = response.body
+
+        #compress the response like the Flask app does (see server/compression.py)
+        if self.config['COMPRESS_ENABLED']:
+            headers['Vary'] = 'Accept-Encoding'
+            encoding = parse_accept_header(request_headers.get('accept-encoding')).best_match(available_encodings())
+            if encoding and len(body) >= self.config['COMPRESS_MIN_SIZE']:
+                #compressing large bodies takes a while, so don't block the event loop
+                body = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, compress, body, encoding, self.config['COMPRESS_LEVEL'])
+                headers['Content-Encoding'] = encoding
+        if 'origin' in request_headers:
+            headers['Access-Control-Allow-Origin'] = '*'
+        headers['Content-Length'] = str(len(body))
+
+        await send({'type': 'http.response.start', 'status': response.status,
+                    'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    ################################## auth and admission ##############################################
+
+    async def _current_user(self, session, request):
+        """
+        Same semantics as @login_required: returns (user, None) or (None, error response)
+        """
+        token = request.headers.get('x-access-token')
+        if not token:
+            return None, self._json({'message': 'Token is missing!'}, 401)
+        try:
+            data = jwt.decode(token, self.config['SECRET_KEY'], algorithms=["HS256"])
+            if data.get('type', 'access') != 'access':
+                raise Exception()
+            user = (await session.execute(select(User).filter_by(public_id=data['public_id']))).scalars().first()
+            if not user:
+                raise Exception()
+        except:
+            return None, self._json({'message': 'Token is invalid!'}, 401)
+        return user, None
+
+    async def _admit(self, user, endpoint):
+        """
+        Apply the same rate limits as the Flask app (see server/ratelimit.py)
+        """
+        if not limiter.enabled:
+            return None
+        #the redis store does blocking network I/O
+        wait = await asyncio.get_running_loop().run_in_executor(self.executor, limiter.take, 'user:' + user.public_id, endpoint)
+        if wait > 0:
+            limiter.count_rejection('rate', endpoint)
+            return self._json({'message': 'Too many requests, please try again later.', 'reason': 'rate'}, 429,
+                              **{'Retry-After': str(max(1, math.ceil(wait)))})
+        return None
+
+    def _not_found(self):
+        #same output as the 404 handler of the Flask app
+        return self._json({'message': 'Not found.', 'error': str(NotFound())}, 404)
+
+    ################################## routes ##########################################################
+
+    async def _authorize(self, request, endpoint, map_id):
+        """
+        Login, rate limit and map lookup of the map routes. Returns (user, map, None) or (.., .., error response),
+        where map is a row with the id and the archived flag of the map.
+        Uses its own short session, so no DB connection is held while a slow client sends its body.
+        """
+        async with self.session() as session:
+            user, error = await self._current_user(session, request)
+            if error:
+                return None, None, error
+            error = await self._admit(user, endpoint)
+            if error:
+                return None, None, error
+            map = (await session.execute(
+                select(WardrivingMap.id, WardrivingMap.archived).filter_by(id=map_id))).first()
+            if map is None:
+                return None, None, self._not_found()
+        #maps that aren't shared with the user don't exist for them (see server/acl.py)
+        if not (await self._visibility(user)).can_see(map.id):
+            return None, None, self._not_found()
+        return user, map, None
+
+    async def _visibility(self, user):
+        if not acl.enabled or user.admin:
+            return EVERYTHING
+        #usually cached, otherwise the grants are loaded by the sync code in a thread
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._load_visibility, user)
+
+    def _load_visibility(self, user):
+        with self.app.app_context():
+            return acl.visibility(user)
+
+    async def add_discovery(self, request, endpoint, map_id):
+        """
+        Async version of POST /maps/<id> (see server/endpoints/maps.py)
+        """
+        from server.endpoints.schemas import discovery_input_schema
+
+        user, map, error = await self._authorize(request, endpoint, map_id)
+        if error:
+            return error
+        map_id = map.id
+
+        body, error = await self._read_body(request)
+        if error:
+            return error
+        try:
+            discovery = discovery_input_schema.load(json.loads(body))
+        except ValidationError as e:
+            return self._json(e.messages, 400)
+        except ValueError:
+            return self._json({'message': 'Bad Request.', 'error': 'Failed to decode JSON object.'}, 400)
+
+        #reactivating a finalized map moves all its discoveries, which is done by the sync code in a thread
+        if map.archived and not await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._ensure_writable, map_id):
+            return self._json({'message': 'Map has been finalized, reactivate it to add discoveries.'}, 409)
+
+        if shards.enabled:
+            #nothing is written to the DB here: the duplicate check reads the shard file and the queue of the writer
+            #may be full for a while, so the sharded ingest runs in the thread pool
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._submit, map_id, discovery, user.id)
+        else:
+            #the same code as the Flask route, with the async connection underneath (see server/ingest.py); the
+            #columnar copy (storage.add()) and the write-behind only buffer, their threads write the files/the DB
+            async with self._write_lock or _no_lock(), self.session() as session:
+                result = await session.run_sync(store_discovery, map_id, discovery, user.id)
+        message, status = RESPONSES[result]
+        return self._json({'message': message}, status)
+
+    async def get_aps(self, request, endpoint, map_id):
+        """
+        Async version of GET /maps/<id>/aps (see server/endpoints/maps.py)
+        """
+        user, map, error = await self._authorize(request, endpoint, map_id)
+        if error:
+            return error
+        map_id = map.id
+
+        try:
+            bbox = viewport_bbox(request.args)
+        except ValueError:
+            return self._json({'message': 'Please provide lat and lon values'}, 400)
+        visibility = await self._visibility(user)
+
+        #the same code as the Flask route; the DB, shards, archives or the columnar copy are read in the thread pool
+        return self._json({'discoveries': await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._viewport, visibility, map_id, bbox)})
+
+    def _viewport(self, visibility, map_id, bbox):
+        from server.endpoints.schemas import discoveries_schema
+        with self.app.app_context():
+            return discoveries_schema.dump(storage.viewport(visibility, map_id, bbox))
+
+    def _submit(self, map_id, discovery, sniffer_id):
+        with self.app.app_context():
+            return store_discovery(db.session, map_id, discovery, sniffer_id)
+
+    def _ensure_writable(self, map_id):
+        with self.app.app_context():
+            return archive.ensure_writable(WardrivingMap.query.get(map_id))
+
+    async def _read_body(self, request):
+        """
+        Read the request body without blocking and inflate it if it was sent compressed
+        """
+        encoding = request.headers.get('content-encoding', '').strip().lower()
+        max_size = self.config['DECOMPRESS_MAX_SIZE']
+        decompressor = None
+        if encoding and encoding != 'identity':
+            decompressor = get_decompressor(encoding, max_size)
+            if decompressor is None:
+                return None, self._json({'message': f'Unsupported Content-Encoding <{encoding}>.'}, 415)
+
+        body = bytearray()
+        try:
+            async for chunk in request.stream():
+                if decompressor:
+                    body += decompressor.decompress(chunk)
+                else:
+                    body += chunk
+                    if len(body) > max_size:
+                        raise BodyTooLarge()
+            if decompressor:
+                decompressor.finish()
+        except BodyTooLarge:
+            return None, self._json({'message': 'Request body is too large.'}, 413)
+        except DECOMPRESSION_ERRORS:
+            return None, self._json({'message': 'Request body could not be decompressed.'}, 400)
+        return bytes(body), None
+
+    ################################## everything else: the Flask app ################################
+
+    def _environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin-1'),
+            #WSGI wants the raw bytes of the path as latin-1 string
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == 'content-type':
+                key = 'CONTENT_TYPE'
+            elif name == 'content-length':
+                key = 'CONTENT_LENGTH'
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+    async def _call_wsgi(self, scope, receive, send):
+        body = bytearray()
+        async for chunk in _Request(scope, receive).stream():
+            body += chunk
+        environ = self._environ(scope, io.BytesIO(bytes(body)))
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            #runs in the thread pool; every chunk of the response is sent as soon as it's produced
+            started = {}
+
+            def start_response(status, headers, exc_info=None):
+                started['status'] = int(status.split(' ', 1)[0])
+                started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+            def send_start():
+                send_from_thread({'type': 'http.response.start', 'status': started['status'],
+                                  'headers': started['headers']})
+
+            iterable = self.app(environ, start_response)
+            try:
+                first = True
+                for chunk in iterable:
+                    if not chunk:
+                        continue
+                    if first:
+                        send_start()
+                        first = False
+                    send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if first:
+                    send_start()
+                send_from_thread({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+
+        await loop.run_in_executor(self.executor, run)
+
+
+class _Request():
+    """
+    The parts of an ASGI request the async routes need
+    """
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.headers = _headers(scope)
+
+    @property
+    def args(self):
+        return dict(parse_qsl(self.scope['query_string'].decode('latin-1')))
+
+    async def stream(self):
+        while True:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                return
+            yield message.get('body', b'')
+            if not message.get('more_body'):
+                return
+
+
+@contextlib.asynccontextmanager
+async def _no_lock():
+    yield
+
+
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+
+def create_asgi_server(app):
+    """
+    Wrap a Flask app created with create_server() into the ASGI application
+    """
+    return AsyncServer(app)
@@ -0,0 +1,486 @@
+import csv
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select
+
+from server import db
+from server.storage import storage, STORAGE_COLUMNS
+from server.ingest import update_access_points, update_contributions
+from server.models import AccessPoint, Discovery, Sniffer, WardrivingMap, SSIDTrigram, APChange, MapContribution, ContributedAP
+
+
+"""
+Bulk import and export of whole databases, e.g. to migrate to another instance or to load dumps of other tools:
+
+    flask data export discoveries.ndjson [--format csv|ndjson] [--table discovery|access_point] [--map ID]
+    flask data import discoveries.ndjson [--format csv|ndjson|wigle] [--map ID] [--sniffer NAME] [--workers N]
+    flask data contributions [--map ID]   (recount the contributions of the sniffers, e.g. after an upgrade)
+    flask data synthetic [--discoveries N] [--aps N] [--sniffers N] [--seed S] [--map ID]   (scale test data)
+    flask data anomalies [--chunk-size N] [--reset]   (look for evil twins etc. in the new discoveries, e.g. from cron)
+    flask data columnar [--rebuild] [--compact] [--map ID]   (maintain the columnar copy, see server/storage.py)
+
+(set FLASK_APP=main:server first). Files are streamed in both directions, lines are parsed in parallel by a
+process pool and rows are written in chunks with executemany (SQLAlchemy core) instead of ORM objects.
+The csv/ndjson formats are the ones written by the export; 'wigle' is the WigleWifi CSV format, which
+Kismet can write as well (kismetdb_to_wiglecsv).
+"""
+
+data_cli = AppGroup('data', help='Bulk import/export of discoveries and access points.')
+
+DISCOVERY_COLUMNS = ['id', 'access_point_mac', 'channel', 'encryption', 'signal_strength', 'ssid', 'timestamp',
+                     'gps_lat', 'gps_lon', 'client_discovery_id', 'sniffer_id', 'map_id']
+_INT_COLUMNS = {'id', 'access_point_mac', 'channel', 'encryption', 'signal_strength', 'sniffer_id', 'map_id', 'mac',
+                'oui', 'last_encryption', 'last_channel'}
+_FLOAT_COLUMNS = {'gps_lat', 'gps_lon'}
+
+
+def _report(action, rows, started):
+    seconds = max(time.perf_counter() - started, 1e-9)
+    click.echo(f'{action} {rows} rows in {seconds:.1f}s ({rows / seconds:.0f} rows/s)', err=True)
+
+
+################################## export #######################################################
+
+def _to_json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+@data_cli.command('export')
+@click.argument('output', type=click.File('w'))
+@click.option('--format', 'format', type=click.Choice(['csv', 'ndjson']), default='ndjson')
+@click.option('--table', type=click.Choice(['discovery', 'access_point']), default='discovery')
+@click.option('--map', 'map_id', type=int, help='Only export the discoveries of this map.')
+@click.option('--chunk-size', type=int, default=10000, show_default=True)
+def export_command(output, format, table, map_id, chunk_size):
+    """Stream a table to OUTPUT ('-' for stdout)."""
+    table = Discovery.__table__ if table == 'discovery' else AccessPoint.__table__
+    stmt = select(table)
+    if map_id is not None:
+        if table is not Discovery.__table__:
+            raise click.UsageError('--map can only be used when exporting discoveries.')
+        stmt = stmt.where(table.c.map_id == map_id)
+
+    started = time.perf_counter()
+    rows = 0
+    columns = [c.name for c in table.columns]
+    writer = csv.writer(output) if format == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+
+    def write(part):
+        if writer:
+            writer.writerows([[_to_json_value(v) for v in row] for row in part])
+        else:
+            output.write(''.join(json.dumps(dict(zip(columns, map(_to_json_value, row)))) + '\n' for row in part))
+
+    with db.engine.connect() as conn:
+        #stream the result instead of loading the whole table into memory
+        result = conn.execution_options(stream_results=True).execute(stmt)
+        for part in result.partitions(chunk_size):
+            write(part)
+            rows += len(part)
+    if table is Discovery.__table__:
+        #the discoveries stored in shards and in the archives of finalized maps, one map at a time
+        for part in _other_rows(map_id):
+            write([[row[column] for column in columns] for row in part])
+            rows += len(part)
+
+    _report('exported', rows, started)
+
+
+def _other_rows(map_id=None):
+    """
+    The discoveries of a map (or of all maps) which are not in the discovery table (shards, archives) as dicts
+    with the columns of the discovery table, one list per shard/archive
+    """
+    from server.sharding import shards, SHARD_COLUMNS, to_global_id
+    from server.archive import archive
+
+    for id in (shards.map_ids() if map_id is None else [map_id]):
+        yield [dict(zip(['id'] + SHARD_COLUMNS, row), id=to_global_id(id, row[0]))
+               for row in shards.rows(['id'] + SHARD_COLUMNS, id)]
+    for id in (archive.map_ids() if map_id is None else [map_id]):
+        yield archive.rows(id)
+
+
+################################## import #######################################################
+
+def _convert(row):
+    """
+    Convert the values of a csv/ndjson row (strings) into the types of the discovery table
+    """
+    out = {}
+    for column in DISCOVERY_COLUMNS:
+        value = row.get(column)
+        if value == '' or value is None:
+            out[column] = None
+        elif column in _INT_COLUMNS:
+            out[column] = int(value)
+        elif column in _FLOAT_COLUMNS:
+            out[column] = float(value)
+        else:
+            out[column] = value
+    #store timestamps in a normalized format
+    out['timestamp'] = datetime.fromisoformat(out['timestamp']).isoformat()
+    return out
+
+
+def _wigle_encryption(auth_mode):
+    auth_mode = auth_mode.upper()
+    if 'WPA2' in auth_mode or 'RSN' in auth_mode or 'WPA3' in auth_mode:
+        return 3
+    if 'WPA' in auth_mode:
+        return 2
+    if 'WEP' in auth_mode:
+        return 1
+    return 0
+
+
+def _parse_wigle(row):
+    #only WiFi networks are relevant (WigleWifi files also contain bluetooth and cell towers)
+    if row.get('Type', 'WIFI') != 'WIFI':
+        return None
+    return {'id': None,
+            'access_point_mac': int(row['MAC'].replace(':', '').replace('-', ''), 16),
+            'channel': int(row['Channel'] or 0),
+            'encryption': _wigle_encryption(row.get('AuthMode', '')),
+            'signal_strength': int(row['RSSI']),
+            'ssid': row['SSID'] or None,
+            'timestamp': datetime.fromisoformat(row['FirstSeen']).isoformat(),
+            'gps_lat': float(row['CurrentLatitude']),
+            'gps_lon': float(row['CurrentLongitude']),
+            'client_discovery_id': None, 'sniffer_id': None, 'map_id': None}
+
+
+def parse_chunk(format, header, lines):
+    """
+    Parse a chunk of lines (runs in the worker processes). Returns (rows, number of skipped lines).
+    """
+    if format == 'ndjson':
+        records = (json.loads(line) for line in lines if line.strip())
+    else:
+        records = csv.DictReader(io.StringIO(''.join(lines)), fieldnames=header)
+
+    rows, skipped = [], 0
+    for record in records:
+        try:
+            row = _parse_wigle(record) if format == 'wigle' else _convert(record)
+        except (KeyError, ValueError, TypeError):
+            row = None
+        if row is None:
+            skipped += 1
+        else:
+            rows.append(row)
+    return rows, skipped
+
+
+def _read_chunks(f, chunk_size):
+    while True:
+        lines = list(islice(f, chunk_size))
+        if not lines:
+            return
+        yield lines
+
+
+def _parallel(executor, fn, chunks, workers):
+    """
+    Like executor.map, but only keeps a few chunks in flight, so huge files are never read into memory at once
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(fn, chunk))
+        if len(pending) >= workers * 2:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _secondary_indexes():
+    """
+    All (non-primary key) indexes of the tables an import writes to
+    """
+    return [index for model in (Discovery, AccessPoint, SSIDTrigram, APChange) for index in model.__table__.indexes]
+
+
+@data_cli.command('import')
+@click.argument('input', type=click.File('r'))
+@click.option('--format', 'format', type=click.Choice(['csv', 'ndjson', 'wigle']), default='ndjson')
+@click.option('--map', 'map_id', type=int, help='Add all discoveries to this map (required for wigle files).')
+@click.option('--sniffer', 'sniffer_name', help='Name of the sniffer the discoveries belong to (required for wigle files).')
+@click.option('--workers', type=int, default=None, help='Number of parser processes (default: one per core).')
+@click.option('--chunk-size', type=int, default=10000, show_default=True)
+@click.option('--keep-ids', is_flag=True, help='Keep the discovery ids of the file (only for csv/ndjson).')
+@click.option('--defer-indexes/--no-defer-indexes', default=True,
+              help='Drop the secondary indexes during the import and build them afterwards.')
+def import_command(input, format, map_id, sniffer_name, workers, chunk_size, keep_ids, defer_indexes):
+    """Load discoveries from INPUT ('-' for stdin) and update the access points accordingly."""
+    sniffer_id = None
+    if sniffer_name:
+        sniffer = Sniffer.query.filter_by(name=sniffer_name).first()
+        if not sniffer:
+            raise click.UsageError(f'There is no sniffer named {sniffer_name}.')
+        sniffer_id = sniffer.id
+    if map_id is not None and not WardrivingMap.query.get(map_id):
+        raise click.UsageError(f'There is no map with id {map_id}.')
+    if format == 'wigle' and (map_id is None or sniffer_id is None):
+        raise click.UsageError('Importing wigle files requires --map and --sniffer.')
+
+    header = None
+    if format == 'wigle':
+        #the first line contains information about the app that created the file, the second one the columns
+        input.readline()
+    if format != 'ndjson':
+        header = next(csv.reader([input.readline()]))
+
+    indexes = _secondary_indexes() if defer_indexes else []
+    for index in indexes:
+        index.drop(db.engine)
+
+    started = time.perf_counter()
+    rows, skipped = 0, 0
+    mirror_maps = set()
+    discovery_table = Discovery.__table__
+    try:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as executor:
+            chunks = _read_chunks(input, chunk_size)
+            for parsed, n_skipped in _parallel(executor, _ParseJob(format, header), chunks, workers):
+                skipped += n_skipped
+                if not parsed:
+                    continue
+                for row in parsed:
+                    if map_id is not None:
+                        row['map_id'] = map_id
+                    if sniffer_id is not None:
+                        row['sniffer_id'] = sniffer_id
+                    if not keep_ids:
+                        row.pop('id', None)
+
+                #the APs have to exist before their discoveries (foreign key)
+                update_access_points(db.engine, parsed)
+                with db.engine.begin() as conn:
+                    conn.execute(discovery_table.insert(),
+                                 [dict(row, timestamp=datetime.fromisoformat(row['timestamp'])) for row in parsed])
+                    update_contributions(conn, parsed)
+                if storage.columnar is not None and any(row.get('id') is None for row in parsed):
+                    #the new ids are only known to the DB: copy the imported discoveries afterwards
+                    mirror_maps.update(row['map_id'] for row in parsed)
+                else:
+                    storage.add([{column: row.get(column) for column in STORAGE_COLUMNS} for row in parsed])
+                rows += len(parsed)
+                click.echo(f'{rows} rows ...', err=True)
+    finally:
+        #build the indexes in one go after the load, which is much faster than maintaining them row by row
+        if indexes:
+            index_started = time.perf_counter()
+            for index in indexes:
+                index.create(db.engine)
+            click.echo(f'built {len(indexes)} indexes in {time.perf_counter() - index_started:.1f}s', err=True)
+
+    _report('imported', rows, started)
+    if skipped:
+        click.echo(f'skipped {skipped} invalid lines', err=True)
+    for id in sorted(mirror_maps):
+        _rebuild_columnar(id, chunk_size)
+
+
+class _ParseJob():
+    """
+    Picklable callable for the process pool (lambdas can't be sent to other processes)
+    """
+    def __init__(self, format, header):
+        self.format = format
+        self.header = header
+
+    def __call__(self, lines):
+        return parse_chunk(self.format, self.header, lines)
+
+
+################################## contributions ################################################
+
+@data_cli.command('contributions')
+@click.option('--map', 'map_id', type=int, help='Only recount the contributions to this map.')
+@click.option('--chunk-size', type=int, default=10000, show_default=True)
+def contributions_command(map_id, chunk_size):
+    """Recount the contribution counters of all sniffers from the stored discoveries."""
+    from server.sharding import shards
+    from server.archive import archive
+
+    columns = ['map_id', 'sniffer_id', 'access_point_mac', 'timestamp']
+    table = Discovery.__table__
+    map_ids = [map_id] if map_id is not None else [id for id, in db.session.query(WardrivingMap.id)]
+    started = time.perf_counter()
+    rows = 0
+    for id in map_ids:
+        with db.engine.begin() as conn:
+            for model in (MapContribution, ContributedAP):
+                conn.execute(model.__table__.delete().where(model.__table__.c.map_id == id))
+
+            #page through the discoveries by id, so the same connection can write the counters in between
+            last = None
+            while True:
+                stmt = select(table.c.id, *[table.c[c] for c in columns]).where(table.c.map_id == id)
+                if last is not None:
+                    stmt = stmt.where(table.c.id > last)
+                part = conn.execute(stmt.order_by(table.c.id).limit(chunk_size)).all()
+                if not part:
+                    break
+                last = part[-1][0]
+                update_contributions(conn, [dict(zip(columns, row[1:])) for row in part])
+                rows += len(part)
+
+            #discoveries stored in the shard or the archive of the map
+            other = [dict(zip(columns, row)) for row in shards.rows(columns, id)] + archive.rows(id)
+            update_contributions(conn, [dict(row, map_id=id) for row in other])
+            rows += len(other)
+
+    _report('counted', rows, started)
+
+
+################################## synthetic data ###############################################
+
+@data_cli.command('synthetic')
+@click.option('--discoveries', type=int, default=10000, show_default=True)
+@click.option('--aps', type=int, default=None, help='Number of APs (default: one per 20 discoveries).')
+@click.option('--sniffers', type=int, default=5, show_default=True)
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('--map', 'map_id', type=int, help='Add the discoveries to this map (default: a new map).')
+@click.option('--chunk-size', type=int, default=10000, show_default=True)
+@click.option('--defer-indexes/--no-defer-indexes', default=True,
+              help='Drop the secondary indexes during the load and build them afterwards.')
+def synthetic_command(discoveries, aps, sniffers, seed, map_id, chunk_size, defer_indexes):
+    """Fill a map with a deterministic synthetic dataset (see server/synthetic.py) for scale tests."""
+    import uuid
+    from server import synthetic
+    from server.passwords import passwords
+
+    if map_id is None:
+        map = WardrivingMap(title=f'synthetic (seed {seed}, {discoveries} discoveries)')
+        db.session.add(map)
+    else:
+        map = WardrivingMap.query.get(map_id)
+        if not map:
+            raise click.UsageError(f'There is no map with id {map_id}.')
+    #the sniffers get random passwords, nobody is supposed to log in with them
+    sniffer_objects = []
+    for i in range(sniffers):
+        name = f'synthetic-{seed}-{i}'
+        sniffer = Sniffer.query.filter_by(name=name).first()
+        if not sniffer:
+            sniffer = Sniffer(public_id=str(uuid.uuid4()), name=name, password=passwords.generate(uuid.uuid4().hex))
+            db.session.add(sniffer)
+        sniffer_objects.append(sniffer)
+    db.session.commit()
+    map_id, sniffer_ids = map.id, [s.id for s in sniffer_objects]
+
+    indexes = _secondary_indexes() if defer_indexes else []
+    for index in indexes:
+        index.drop(db.engine)
+    started = time.perf_counter()
+    try:
+        dataset, timings = synthetic.load(db.engine, map_id, sniffer_ids, discoveries, aps, seed, chunk_size,
+                                          progress=lambda rows: click.echo(f'{rows} rows ...', err=True))
+    finally:
+        if indexes:
+            index_started = time.perf_counter()
+            for index in indexes:
+                index.create(db.engine)
+            click.echo(f'built {len(indexes)} indexes in {time.perf_counter() - index_started:.1f}s', err=True)
+
+    click.echo(' '.join(f'{phase}={seconds:.1f}s' for phase, seconds in timings.items()), err=True)
+    _report(f'generated map {map_id}:', discoveries, started)
+    if storage.columnar is not None:
+        _rebuild_columnar(map_id, chunk_size)
+
+
+################################## anomaly detection ############################################
+
+@data_cli.command('anomalies')
+@click.option('--chunk-size', type=int, default=None, help='Discoveries per transaction (default: ANOMALY_CHUNK_SIZE).')
+@click.option('--reset', is_flag=True, help='Delete all findings and analyse all discoveries again.')
+def anomalies_command(chunk_size, reset):
+    """Analyse the discoveries added since the last run for evil twins and displaced APs (see server/anomalies.py)."""
+    from flask import current_app
+    from server.anomalies import AnomalyDetector
+
+    detector = AnomalyDetector.from_config(current_app.config, chunk_size=chunk_size)
+    if reset:
+        detector.reset(db.engine)
+    started = time.perf_counter()
+    stats = detector.run(db.engine, progress=lambda rows: click.echo(f'{rows} rows ...', err=True))
+    click.echo(' '.join(f'{kind}={count}' for kind, count in stats.items() if kind != 'discoveries'), err=True)
+    _report('analysed', stats['discoveries'], started)
+
+
+################################## columnar storage #############################################
+
+def _map_rows(map_id, chunk_size):
+    """
+    All discoveries of a map (DB, shard and archive) as rows of the columnar storage, in chunks
+    """
+    from server.sharding import shards, SHARD_COLUMNS, to_global_id
+    from server.archive import archive
+
+    table = Discovery.__table__
+    columns = [table.c[column] for column in STORAGE_COLUMNS]
+    last = None
+    while True:
+        stmt = select(*columns).where(table.c.map_id == map_id)
+        if last is not None:
+            stmt = stmt.where(table.c.id > last)
+        part = [dict(row._mapping) for row in db.session.execute(stmt.order_by(table.c.id).limit(chunk_size))]
+        if not part:
+            break
+        last = part[-1]['id']
+        yield part
+
+    shard_rows = [dict(zip(['id'] + SHARD_COLUMNS, row)) for row in shards.rows(['id'] + SHARD_COLUMNS, map_id)]
+    yield [dict(row, id=to_global_id(map_id, row['id'])) for row in shard_rows]
+    yield [dict(row, map_id=map_id) for row in archive.rows(map_id)]
+
+
+def _rebuild_columnar(map_id, chunk_size):
+    started = time.perf_counter()
+    rows = 0
+
+    def chunks():
+        nonlocal rows
+        for part in _map_rows(map_id, chunk_size):
+            rows += len(part)
+            yield part
+    storage.columnar.rebuild(map_id, chunks())
+    storage.columnar.compact(map_id)
+    _report(f'copied map {map_id}:', rows, started)
+
+
+@data_cli.command('columnar')
+@click.option('--rebuild', is_flag=True, help='Copy all discoveries from the DB again.')
+@click.option('--compact', is_flag=True, help='Merge the files of each map into one.')
+@click.option('--map', 'map_id', type=int, help='Only this map.')
+@click.option('--chunk-size', type=int, default=100000, show_default=True)
+def columnar_command(rebuild, compact, map_id, chunk_size):
+    """Maintain the columnar copy of the discoveries (STORAGE_BACKEND = 'columnar', see server/storage.py)."""
+    if storage.columnar is None:
+        raise click.UsageError("The columnar storage is not enabled (STORAGE_BACKEND = 'columnar').")
+    if not (rebuild or compact):
+        raise click.UsageError('Please choose --rebuild and/or --compact.')
+
+    map_ids = [map_id] if map_id is not None else [id for id, in db.session.query(WardrivingMap.id).order_by(WardrivingMap.id)]
+    for id in map_ids:
+        if rebuild:
+            #also compacts the copy
+            _rebuild_columnar(id, chunk_size)
+        elif compact:
+            merged = storage.columnar.compact(id)
+            if merged:
+                click.echo(f'map {id}: merged {merged} files', err=True)
+
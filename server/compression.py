@@ -0,0 +1,268 @@
+import hashlib
+import io
+import json
+import re
+import zlib
+
+from flask import request, current_app as app
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import get_input_stream
+
+from server.cache import LRUCache
+
+#brotli and zstandard are optional: if they are not installed, we simply don't offer these encodings
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+"""
+Compression of HTTP payloads in both directions:
+- responses are compressed with the best encoding the client accepts (br, zstd or gzip)
+- discoveries uploaded by sniffers may be sent gzip- or zstd-compressed (Content-Encoding header)
+"""
+
+#size of the chunks in which request bodies are read and decompressed
+CHUNK_SIZE = 64 * 1024
+
+#zstandard can't limit the output of a single call like zlib, but a zstd block (at most 128 KiB) needs at least
+#4 bytes of input, so we only feed it as much input as the remaining size allows
+ZSTD_MAX_RATIO = 32 * 1024
+
+#errors that can be raised when a client sends a corrupt or truncated compressed body
+DECOMPRESSION_ERRORS = (zlib.error, EOFError, zstandard.ZstdError) if zstandard else (zlib.error, EOFError)
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def available_encodings():
+    """
+    All encodings this server can produce, ordered by preference
+    (used to break ties when the client accepts multiple encodings with the same quality)
+    """
+    encodings = []
+    if brotli:
+        encodings.append('br')
+    if zstandard:
+        encodings.append('zstd')
+    encodings.append('gzip')
+    return encodings
+
+
+class _Compressor():
+    """
+    Uniform wrapper around the incremental compressors of the different libraries,
+    so a streamed response can be compressed chunk by chunk
+    """
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            #brotli uses 'quality' from 0-11 instead of a level; map our level (1-9) roughly onto it
+            self._obj = brotli.Compressor(quality=min(11, level))
+        elif encoding == 'zstd':
+            self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            #wbits=31 means: deflate with a gzip header and trailer
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._obj.process(data)
+        return self._obj.compress(data)
+
+    def flush(self):
+        if self.encoding == 'br':
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def compress(data, encoding, level):
+    """
+    Compress a complete body at once
+    """
+    compressor = _Compressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_stream(iterable, encoding, level):
+    """
+    Generator compressing a streamed response without buffering it completely
+    """
+    compressor = _Compressor(encoding, level)
+    for chunk in iterable:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def _is_cacheable(response):
+    if request.method != 'GET' or response.status_code != 200:
+        return False
+    return not response.cache_control.no_store
+
+
+def compress_response(response):
+    """
+    after_request hook: negotiate Accept-Encoding and compress the response body if it is worth it
+    """
+    config = app.config
+    if not config['COMPRESS_ENABLED']:
+        return response
+
+    #responses that must not or cannot be compressed
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in config['COMPRESS_MIMETYPES']):
+        return response
+
+    #the response differs depending on this header, so caches in between have to know that
+    response.vary.add('Accept-Encoding')
+
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if not encoding:
+        return response
+    level = config['COMPRESS_LEVEL']
+
+    #don't load the entire body into memory, but compress it while it is sent
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding, level)
+        response.headers['Content-Encoding'] = encoding
+        response.headers.pop('Content-Length', None)
+        return response
+
+    data = response.get_data()
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    if _is_cacheable(response):
+        key = (encoding, level, hashlib.sha1(data).digest())
+        compressed = app.extensions['compression_cache'].get(key)
+        if compressed is None:
+            compressed = compress(data, encoding, level)
+            app.extensions['compression_cache'].put(key, compressed)
+    else:
+        compressed = compress(data, encoding, level)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class _Decompressor():
+    """
+    Uniform wrapper around the incremental decompressors of the different libraries, which never inflates
+    (much) more than max_size bytes, no matter how well the body compresses ('zip bombs')
+    """
+    def __init__(self, encoding, max_size):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.size = 0
+        if encoding == 'zstd':
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            #wbits=47 automatically detects a zlib or gzip header
+            self._obj = zlib.decompressobj(47)
+
+    def decompress(self, data):
+        """
+        Inflate the next chunk of the body, raises BodyTooLarge as soon as max_size is exceeded
+        """
+        out = []
+        while data:
+            if self.encoding == 'zstd':
+                step = max(16, (self.max_size + 1 - self.size) // ZSTD_MAX_RATIO)
+                chunk, data = self._obj.decompress(data[:step]), data[step:]
+            else:
+                #at most what is left of max_size (+1 to notice that it is exceeded), the rest of the input is kept
+                chunk = self._obj.decompress(data, self.max_size + 1 - self.size)
+                data = self._obj.unconsumed_tail
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                raise BodyTooLarge()
+            out.append(chunk)
+        return b''.join(out)
+
+    def finish(self):
+        """
+        Check that the whole compressed stream was received (raises EOFError if it was truncated)
+        """
+        if not self._obj.eof:
+            raise EOFError('Compressed body is incomplete.')
+
+
+def get_decompressor(encoding, max_size):
+    """
+    Incremental decompressor for a Content-Encoding of a request, or None if it's not supported
+    """
+    if encoding in ('gzip', 'x-gzip') or (encoding == 'zstd' and zstandard):
+        return _Decompressor('zstd' if encoding == 'zstd' else 'gzip', max_size)
+    return None
+
+
+class DecompressionMiddleware():
+    """
+    WSGI middleware that transparently inflates compressed request bodies on the configured routes,
+    so the endpoints can keep using request.get_json() as usual.
+    """
+    def __init__(self, wsgi_app, routes, max_size):
+        self.wsgi_app = wsgi_app
+        self.routes = [re.compile(route) for route in routes]
+        #upper limit for the decompressed body (protection against 'zip bombs')
+        self.max_size = max_size
+
+    def _error(self, environ, start_response, message, status):
+        resp = Response(json.dumps({'message': message}), status=status, mimetype='application/json')
+        return resp(environ, start_response)
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if (not encoding or encoding == 'identity' or environ.get('REQUEST_METHOD') not in ('POST', 'PUT')
+                or not any(route.match(environ.get('PATH_INFO', '')) for route in self.routes)):
+            return self.wsgi_app(environ, start_response)
+
+        decompressor = get_decompressor(encoding, self.max_size)
+        if decompressor is None:
+            return self._error(environ, start_response, f'Unsupported Content-Encoding <{encoding}>.', 415)
+
+        stream = get_input_stream(environ)
+        body = bytearray()
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                body += decompressor.decompress(chunk)
+            decompressor.finish()
+        except BodyTooLarge:
+            return self._error(environ, start_response, 'Decompressed request body is too large.', 413)
+        except DECOMPRESSION_ERRORS:
+            return self._error(environ, start_response, 'Request body could not be decompressed.', 400)
+
+        environ['wsgi.input'] = io.BytesIO(bytes(body))
+        environ['CONTENT_LENGTH'] = str(len(body))
+        del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+
+def init_compression(app):
+    """
+    Register response compression and request decompression for the given app
+    """
+    #compressed bodies of cacheable responses, keyed by a digest of the uncompressed body, so e.g.
+    #many viewers loading the same map only pay for compressing it once
+    app.extensions['compression_cache'] = LRUCache(app.config['COMPRESS_CACHE_SIZE'])
+    app.after_request(compress_response)
+    app.wsgi_app = DecompressionMiddleware(app.wsgi_app, app.config['DECOMPRESS_REQUEST_ROUTES'],
+                                           app.config['DECOMPRESS_MAX_SIZE'])
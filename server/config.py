@@ -5,6 +5,183 @@ class Config:
     SQLALCHEMY_DATABASE_URI = "sqlite:///db.db"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    #lifetime of the tokens returned by /login and /refresh
+    TOKEN_VALID_HOURS = 24
+    REFRESH_TOKEN_VALID_DAYS = 30
+
+    #password hashing is done by a few worker threads (see server/passwords.py)
+    PASSWORD_HASH_METHOD = 'sha256'
+    PASSWORD_HASH_WORKERS = 4
+    #maximum number of passwords waiting to be hashed, further logins are rejected (503)
+    PASSWORD_HASH_QUEUE = 64
+    #how long [s] a request waits for its hash
+    PASSWORD_HASH_TIMEOUT = 10
+    #successful logins are remembered for this long [s], so the password doesn't have to be hashed again
+    LOGIN_CACHE_TTL = 300
+    LOGIN_CACHE_SIZE = 10000
+
+    #response compression (gzip is always available, br/zstd only if 'brotli'/'zstandard' are installed)
+    COMPRESS_ENABLED = True
+    COMPRESS_LEVEL = 6
+    #bodies smaller than this [bytes] are sent uncompressed since it's not worth the effort
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_MIMETYPES = ['application/json', 'text/plain', 'text/csv', 'application/x-ndjson']
+    #number of compressed bodies of cacheable (GET) responses kept in memory
+    COMPRESS_CACHE_SIZE = 64
+    #routes (regex on the path) which accept gzip/zstd compressed request bodies (discovery ingest)
+    DECOMPRESS_REQUEST_ROUTES = [r'^/maps/[^/]+$', r'^/aps$', r'^/uploads/[^/]+/\d+$']
+    #maximum size [bytes] of a decompressed request body
+    DECOMPRESS_MAX_SIZE = 64 * 1024 * 1024
+
+    #'direct': every request writes its discovery itself
+    #'sharded': discoveries are written to per-map SQLite shards by separate writer processes (see server/sharding.py)
+    INGEST_MODE = 'direct'
+    #directory of the shard files (relative to the server package, just like the SQLite DB)
+    SHARD_DIRECTORY = 'shards'
+    #number of writer processes (0 = one per CPU core)
+    SHARD_WRITERS = 0
+    #maximum number of discoveries a writer commits at once
+    SHARD_BATCH_SIZE = 500
+    #maximum number of discoveries waiting per writer, and how long [s] a request waits if that queue is full
+    SHARD_QUEUE_SIZE = 10000
+    SHARD_QUEUE_TIMEOUT = 1.0
+
+    #write-behind of the AP "last seen" values (see server/writebehind.py)
+    AP_WRITE_BEHIND = True
+    #how often [s] the buffered values are written, and how many APs may be waiting before they are written right away
+    AP_WRITE_BEHIND_INTERVAL = 2.0
+    AP_WRITE_BEHIND_MAX_PENDING = 10000
+    #APs returned by the API show the values still waiting in the buffer of this process
+    AP_WRITE_BEHIND_READS = True
+
+    #archive of finalized maps (see server/archive.py), relative to the server package just like the shards
+    ARCHIVE_DIRECTORY = 'archives'
+    #new discoveries for an archived map reactivate it (otherwise they are rejected with 409)
+    ARCHIVE_REACTIVATE_ON_WRITE = True
+    #number of archives kept open (memory-mapped) at once
+    ARCHIVE_CACHE_SIZE = 16
+
+    #storage of the read-heavy map endpoints (see server/storage.py): 'sql' or 'columnar' (mirrors the discoveries
+    #into Parquet files read with DuckDB, needs duckdb)
+    STORAGE_BACKEND = 'sql'
+    #directory of the columnar copy, relative to the server package just like the archives
+    STORAGE_DIRECTORY = 'columnar'
+    #mirrored discoveries are written every STORAGE_FLUSH_INTERVAL seconds, or right away once this many are waiting
+    STORAGE_FLUSH_ROWS = 10000
+    STORAGE_FLUSH_INTERVAL = 5.0
+
+    #map sharing (see server/acl.py): non-admins only see the maps shared with them (and those they contributed to)
+    MAP_ACL_ENABLED = False
+    #what a user may see is cached for this long [s] (changes in other processes take up to this long)
+    MAP_ACL_CACHE_TTL = 60
+    MAP_ACL_CACHE_SIZE = 10000
+
+    #read replicas: add them as binds, e.g. SQLALCHEMY_BINDS = {'replica1': 'mysql://...'},
+    #and list the names of these binds in SQLALCHEMY_REPLICAS
+    SQLALCHEMY_BINDS = {}
+    SQLALCHEMY_REPLICAS = []
+    #GET routes of these blueprints are served by the replicas
+    REPLICA_BLUEPRINTS = ['maps', 'aps', 'users']
+    #replicas lagging behind more than this [s] are not used
+    REPLICA_MAX_LAG = 5
+    #how often [s] the health of a replica is checked
+    REPLICA_CHECK_INTERVAL = 10
+    #a client reads from the primary for this long [s] after it has written something
+    REPLICA_READ_YOUR_WRITES = 10
+    #cookie carrying the time of the last write of a client to all processes/servers
+    REPLICA_WRITE_COOKIE = 'last_write'
+
+    #path to the complete IEEE OUI registry (oui.csv or oui.txt) used to look up the vendors of APs
+    #if not provided, only a small built-in list of vendors is known
+    OUI_FILE = None
+
+    #build all marshmallow schemas at startup instead of on first use
+    #(recommended together with gunicorn's --preload, so that the workers share them)
+    PRELOAD_SCHEMAS = False
+
+    #maximum number of cells per side of a heatmap
+    HEATMAP_MAX_RESOLUTION = 1024
+    #number of rendered heatmaps kept in memory
+    HEATMAP_CACHE_SIZE = 32
+
+    #proximity queries (/aps/near, /aps/<mac>/neighbors): default and maximum radius [m], maximum k
+    NEAR_DEFAULT_RADIUS = 200
+    NEAR_MAX_RADIUS = 10000
+    NEAR_MAX_K = 1000
+
+    #GPS tracks: points closer than this [m] to the simplified track are not stored at all
+    TRACK_MIN_TOLERANCE = 2
+    #level of detail [m] of the tracks served if the client doesn't ask for a specific one
+    TRACK_DEFAULT_TOLERANCE = 10
+    #maximum number of GPS fixes per upload
+    TRACK_MAX_FIXES = 100000
+
+    #admission control (see server/ratelimit.py)
+    RATELIMIT_ENABLED = True
+    #'memory': buckets of each process are independent, or a redis URL (redis://host:6379/0) to share them
+    RATELIMIT_STORAGE = 'memory'
+    #(requests per second, burst) per user and route, None = unlimited
+    RATELIMIT_DEFAULT = (20, 100)
+    #limits for single routes (by endpoint name) overriding the default
+    RATELIMIT_ROUTES = {
+        'maps.add_discovery': (10, 50),
+        'aps.add_discovery': (10, 50),
+        #per IP address: many users (e.g. sniffers behind the same NAT or proxy) may log in from the same one
+        'system.login': (10, 100),
+        'system.refresh': (10, 100),
+    }
+    #limits per username sent with basic auth, in addition to the ones above: guessing the password of one user
+    #stays slow without locking out everyone else with the same IP address
+    RATELIMIT_USERNAME_ROUTES = {
+        'system.login': (1, 10),
+    }
+    #maximum number of requests a server process answers at the same time for these (expensive) routes
+    RATELIMIT_CONCURRENCY = {
+        'aps.get_all_discoveries': 4,
+        'maps.get_map': 4,
+    }
+    #how long [s] a request waits for a free slot before it is rejected
+    RATELIMIT_CONCURRENCY_TIMEOUT = 0.5
+
+    #profiling (see server/profiling.py)
+    #trace every request (for debugging only), otherwise only admins' requests with PROFILING_HEADER are traced
+    PROFILING_ENABLED = False
+    #header to trace a request: '1', or 'cprofile'/'pyinstrument' to also profile the python code (None = disabled)
+    PROFILING_HEADER = 'X-Profile'
+    #fraction of all requests that are traced, so the slow-request log contains their SQL statements
+    PROFILING_SAMPLE_RATE = 0.0
+    #requests taking longer than this [s] go to the slow-request log (None = disabled), but only this fraction of them
+    PROFILING_SLOW_THRESHOLD = 1.0
+    PROFILING_SLOW_SAMPLE_RATE = 1.0
+    #number of slow requests and traces kept in memory for /slow-requests and /profiles/<id>
+    PROFILING_SLOW_LOG_SIZE = 100
+    PROFILING_TRACES_KEPT = 100
+    #run EXPLAIN for the SELECT statements of traced requests
+    PROFILING_EXPLAIN = True
+    #maximum number of SQL statements recorded per request
+    PROFILING_MAX_STATEMENTS = 200
+    #directory of the cProfile/pyinstrument dumps (relative to the server package)
+    PROFILING_DIRECTORY = 'profiles'
+
+    #anomaly detection (flask data anomalies, see server/anomalies.py)
+    #APs with the same SSID within this distance [m] are compared (evil twins)
+    ANOMALY_TWIN_RADIUS = 500
+    #an AP seen further than this [m] from its usual position is reported as displaced
+    ANOMALY_DISPLACEMENT = 2000
+    #sightings needed before an AP has a usual position
+    ANOMALY_MIN_SIGHTINGS = 3
+    #discoveries analysed per transaction
+    ANOMALY_CHUNK_SIZE = 10000
+    #maximum number of (discovery, AP) pairs compared at once, bounds the memory for very common SSIDs
+    ANOMALY_MAX_PAIRS = 1000000
+
+    #ASGI mode (see server/asgi.py): URI of the DB with an async driver, derived from SQLALCHEMY_DATABASE_URI if None
+    ASYNC_DATABASE_URI = None
+    #number of threads running the (sync) Flask routes in ASGI mode
+    ASGI_WSGI_THREADS = 32
+    #maximum number of DB connections of the async routes
+    ASYNC_POOL_SIZE = 10
+
 #note that if really used in a production environment, a wsgi
 #server (e.g. gunicorn in combination with nginx) should be used
 #instead of the default flask webserver
@@ -12,6 +189,7 @@ class ProductionConfig(Config):
     DEBUG = False
     #this is Flasks default, since it helps with caching
     JSON_SORT_KEYS = True
+    PRELOAD_SCHEMAS = True
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -1,35 +1,221 @@
 from flask import request, jsonify, current_app as app, Blueprint, g
-from sqlalchemy import exc
+from sqlalchemy import exc, func
 from marshmallow import ValidationError
 
 from server import db, ma
-from server.models import AccessPoint, Discovery, AP_EAV
+from server.models import AccessPoint, Discovery, AP_EAV, SSIDTrigram, APChange
 from server.login import admin_required, login_required
-from server.endpoints.api_definition import discovery_schema, discoveries_schema, ap_schema, aps_schema
+from server.endpoints.schemas import discovery_schema, discoveries_schema, ap_discoveries_schema, ap_schema, aps_schema, ap_changes_schema
+from server.sharding import shards, from_global_id
+from server.archive import archive
+from server.writebehind import ap_buffer
+from server.acl import acl
+from server.storage import storage, row_of
+from server.oui import oui_registry
+from server.search import query_trigrams, escape_like, FUZZY_THRESHOLD
+from server import gps
+
+import math
+from datetime import datetime
+
+import numpy as np
 
 aps = Blueprint('aps', __name__, url_prefix='/aps')
 
 
 ###############################################AccessPoints#######################################
 
+def _visible(query):
+    #only the APs on maps the current user may see (see server/acl.py)
+    visible = acl.visibility().ap_filter()
+    return query.filter(visible) if visible is not None else query
+
+
+def _get_ap(mac):
+    return _visible(AccessPoint.query.filter_by(mac=mac)).first_or_404()
+
+
 @aps.route('', methods=['GET'])
 @login_required
 def get_all_aps():
     """
     Get all Access Points (without their discoveries)
+    Optional query parameter 'vendor': only APs of vendors whose name contains this string
     """
-    aps = AccessPoint.query.all()
+    query = _visible(AccessPoint.query)
+
+    vendor = request.args.get('vendor')
+    if vendor:
+        #the registry translates the vendor into its OUIs, which are then looked up using the index
+        query = query.filter(AccessPoint.oui.in_(oui_registry.prefixes(vendor)))
 
-    output = aps_schema.dump(aps)
+    aps = query.all()
+
+    output = ap_buffer.apply(aps_schema.dump(aps))
     return jsonify({'aps': output})
 
+@aps.route('/search', methods=['GET'])
+@login_required
+def search_aps():
+    """
+    Search APs by their SSID (case insensitive).
+    Query parameters:
+    - q: the search term
+    - mode: 'substring' (default), 'prefix' or 'fuzzy' (also finds SSIDs with typos, best matches first)
+    - page (starting at 1), per_page (default 50, max 500)
+    More recently seen APs are ranked higher.
+    """
+    q = request.args.get('q', '')
+    mode = request.args.get('mode', 'substring')
+    if not q.strip():
+        return jsonify({'message': 'Please provide a search term q.'}), 400
+    if mode not in ('substring', 'prefix', 'fuzzy'):
+        return jsonify({'message': "mode has to be 'substring', 'prefix' or 'fuzzy'."}), 400
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 50)), 1), 500)
+    except ValueError:
+        return jsonify({'message': 'page and per_page have to be integers.'}), 400
+
+    wanted = query_trigrams(q, mode)
+    pattern = escape_like(q.lower())
+    query = _visible(AccessPoint.query)
+
+    if wanted:
+        #candidates from the index: APs having all (prefix/substring) or enough (fuzzy) trigrams of the query
+        shared = func.count(SSIDTrigram.trigram).label('shared')
+        required = len(wanted) if mode != 'fuzzy' else max(1, math.ceil(len(wanted) * FUZZY_THRESHOLD))
+        candidates = db.session.query(SSIDTrigram.mac, shared).filter(SSIDTrigram.trigram.in_(wanted)) \
+            .group_by(SSIDTrigram.mac).having(shared >= required).subquery()
+        query = query.join(candidates, AccessPoint.mac == candidates.c.mac)
+        if mode == 'fuzzy':
+            query = query.order_by(candidates.c.shared.desc())
+    if mode == 'prefix':
+        #the trigrams are only a necessary condition, so check the SSID of the remaining candidates
+        query = query.filter(func.lower(AccessPoint.last_ssid).like(pattern + '%', escape='\\'))
+    elif mode == 'substring':
+        #NOTE: search terms with less than 3 characters can't use the index
+        query = query.filter(func.lower(AccessPoint.last_ssid).like('%' + pattern + '%', escape='\\'))
+
+    #fetch one more than needed to know whether there is another page (cheaper than counting all matches)
+    results = query.order_by(AccessPoint.t_last_seen.desc()).offset((page - 1) * per_page).limit(per_page + 1).all()
+
+    return jsonify({'aps': ap_buffer.apply(aps_schema.dump(results[:per_page])), 'page': page, 'per_page': per_page,
+                    'has_next': len(results) > per_page})
+
+
+def _within(p, radius, exclude=None):
+    """
+    All APs within radius [km] around p: (macs, distances [km]) sorted by distance
+    """
+    lat_min, lon_min, lat_max, lon_max = gps.bounding_box(p, radius)
+    #prefilter with the (lat, lon) index, only the coordinates are loaded
+    query = db.session.query(AccessPoint.mac, AccessPoint.gps_lat, AccessPoint.gps_lon) \
+        .filter(AccessPoint.gps_lat >= lat_min, AccessPoint.gps_lat <= lat_max)
+    if lon_min is not None:
+        query = query.filter(AccessPoint.gps_lon >= lon_min, AccessPoint.gps_lon <= lon_max)
+    if exclude is not None:
+        query = query.filter(AccessPoint.mac != exclude)
+    rows = _visible(query).all()
+    if not rows:
+        return np.array([], dtype=np.int64), np.array([])
+
+    macs = np.array([row[0] for row in rows], dtype=np.int64)
+    distances = gps.distance_accurate_many(p, [row[1] for row in rows], [row[2] for row in rows])
+    inside = distances <= radius
+    macs, distances = macs[inside], distances[inside]
+    #stable sort, so APs with the same distance always come in the same order (pagination)
+    order = np.lexsort((macs, distances))
+    return macs[order], distances[order]
+
+
+def _nearest(p, k, max_radius, exclude=None):
+    """
+    The k APs closest to p, but not further away than max_radius [km]
+    """
+    #start small and grow the search radius until it contains k APs: all APs within the radius have been found,
+    #so the k nearest ones are among them
+    radius = min(0.1, max_radius)
+    while True:
+        macs, distances = _within(p, radius, exclude)
+        if len(macs) >= k or radius >= max_radius:
+            return macs[:k], distances[:k]
+        radius = min(radius * 4, max_radius)
+
+
+def _proximity_response(p, exclude=None):
+    """
+    Shared implementation of /near and /<mac>/neighbors.
+    Query parameters: radius [m] or k (k nearest APs, optionally within radius), page, per_page
+    """
+    try:
+        radius = float(request.args.get('radius', app.config['NEAR_DEFAULT_RADIUS']))
+        k = int(request.args['k']) if request.args.get('k') else None
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 50)), 1), 500)
+    except ValueError:
+        return jsonify({'message': 'radius has to be a number, k, page and per_page have to be integers.'}), 400
+    if not 0 < radius <= app.config['NEAR_MAX_RADIUS']:
+        return jsonify({'message': f'radius has to be between 0 and {app.config["NEAR_MAX_RADIUS"]} m.'}), 400
+    if k is not None and not 0 < k <= app.config['NEAR_MAX_K']:
+        return jsonify({'message': f'k has to be between 1 and {app.config["NEAR_MAX_K"]}.'}), 400
+
+    if k is not None:
+        #without an explicit radius, search as far as allowed
+        max_radius = radius if request.args.get('radius') else app.config['NEAR_MAX_RADIUS']
+        macs, distances = _nearest(p, k, max_radius / 1000, exclude)
+    else:
+        macs, distances = _within(p, radius / 1000, exclude)
+
+    #only the APs of the requested page are loaded completely
+    start = (page - 1) * per_page
+    page_macs = [int(mac) for mac in macs[start:start + per_page]]
+    aps = {ap.mac: ap for ap in AccessPoint.query.filter(AccessPoint.mac.in_(page_macs))} if page_macs else {}
+    found = [(aps[mac], distance) for mac, distance in zip(page_macs, distances[start:start + per_page]) if mac in aps]
+    #like the AP lists, without the discoveries of the APs
+    output = aps_schema.dump([ap for ap, _ in found])
+    for ap, (_, distance) in zip(output, found):
+        ap['distance'] = float(distance) * 1000
+    ap_buffer.apply(output)
+
+    return jsonify({'aps': output, 'total': len(macs), 'page': page, 'per_page': per_page,
+                    'has_next': start + per_page < len(macs)})
+
+
+@aps.route('/near', methods=['GET'])
+@login_required
+def get_aps_near():
+    """
+    APs around a point, closest first, with their 'distance' [m].
+    Query parameters: lat, lon (required), radius [m] (default NEAR_DEFAULT_RADIUS),
+    k (only the k nearest APs), page (starting at 1), per_page (default 50, max 500)
+    """
+    try:
+        lat, lon = float(request.args['lat']), float(request.args['lon'])
+    except (KeyError, ValueError):
+        return jsonify({'message': 'Please provide lat and lon values'}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({'message': 'lat has to be within [-90, 90] and lon within [-180, 180].'}), 400
+    return _proximity_response(gps.Point(lat, lon))
+
+
+@aps.route('/<mac>/neighbors', methods=['GET'])
+@login_required
+def get_ap_neighbors(mac):
+    """
+    APs around this AP (same query parameters as /aps/near, but without lat and lon)
+    """
+    ap = _get_ap(mac)
+    return _proximity_response(gps.Point(ap.gps_lat, ap.gps_lon), exclude=ap.mac)
+
+
 @aps.route('/<mac>', methods=["POST"])
 @login_required
 def add_ap_attribute(mac):
     """
     Dynamically add access point attributes
     """
-    ap = AccessPoint.query.filter_by(mac=mac).first_or_404()
+    ap = _get_ap(mac)
     
     #get and validate post data
     input = request.get_json(silent=True)
@@ -65,23 +251,64 @@ def get_ap(mac):
     # using all past discoveries -> then update values of AP in DB
     # - good because it is only done when the user loads this specific AP
     # - idea: if you do that, remember to remove update code when adding new discovery
-    ap = AccessPoint.query.filter_by(mac=mac).first_or_404()
+    ap = _get_ap(mac)
+
+    output = ap_buffer.apply(ap_schema.dump(ap))
+    #the discoveries in shards and in the archives of finalized maps
+    other = shards.discoveries(access_point_mac=ap.mac) + archive.discoveries(access_point_mac=ap.mac)
+    output['discoveries'] += ap_discoveries_schema.dump(other)
+    visibility = acl.visibility()
+    if not visibility.unrestricted:
+        #only the discoveries on maps the user may see
+        discoveries = Discovery.query.filter(Discovery.access_point_mac == ap.mac, visibility.discovery_filter()).all()
+        discoveries += [d for d in other if visibility.contains(d.map_id, d.gps_lat, d.gps_lon)]
+        output['discoveries'] = ap_discoveries_schema.dump(discoveries)
+    return jsonify({'ap': output})              
+
+
+@aps.route('/<mac>/history', methods=['GET'])
+@login_required
+def get_ap_history(mac):
+    """
+    All changes of the tracked attributes (ssid, encryption, channel) of this AP in chronological order.
+    Optional query parameters: attribute, since and until (ISO 8601 timestamps)
+    """
+    ap = _get_ap(mac)
 
-    return jsonify({'ap': ap_schema.dump(ap)})              
+    query = ap.changes
+    visible = acl.visibility().map_filter(APChange.map_id)
+    if visible is not None:
+        query = query.filter(visible)
+    try:
+        if request.args.get('since'):
+            query = query.filter(APChange.timestamp >= datetime.fromisoformat(request.args['since']))
+        if request.args.get('until'):
+            query = query.filter(APChange.timestamp <= datetime.fromisoformat(request.args['until']))
+    except ValueError:
+        return jsonify({'message': 'since and until have to be ISO 8601 timestamps.'}), 400
+    if request.args.get('attribute'):
+        query = query.filter(APChange.attribute == request.args['attribute'])
+
+    return jsonify({'changes': ap_changes_schema.dump(query.order_by(APChange.timestamp).all())})
 
 
 #TODO: does this route really make sense? maybe we should remove it
 @aps.route('/<mac>', methods=['PUT'])
-@login_required
+@admin_required
 def update_ap(mac):
-    """Update access point"""
-    ap = AccessPoint.query.filter_by(mac=mac).first_or_404()
+    """
+    Update access point. Only admins: the AP is shared by all maps it was found on, not only the ones
+    the user may see.
+    """
+    ap = _get_ap(mac)
 
     try:
         #update existing object 
         ap = ap_schema.load(request.get_json(), instance=ap)
     except ValidationError as e:
        return jsonify(e.messages), 400 
+    #the SSID might have been changed
+    ap.index_ssid()
 
     db.session.add(ap)
     db.session.commit()
@@ -89,13 +316,13 @@ def update_ap(mac):
     return jsonify({'message': 'AP has been updated.'})
 
 @aps.route('/<mac>', methods=['DELETE'])
-@login_required
+@admin_required
 def delete_ap(mac):
     """
     Deleting an AP means all its discoveries will also be deleted if the foreign key constraints
-    are enforced correctly.
+    are enforced correctly. Only admins, like updating it.
     """
-    ap = AccessPoint.query.filter_by(mac=mac).first_or_404()
+    ap = _get_ap(mac)
 
     db.session.delete(ap)
     db.session.commit()
@@ -124,11 +351,14 @@ def add_discovery():
     #if this is the first time the AP is discovered, add the AP
     #check whether there already is an AP with this mac
     ap = AccessPoint.query.filter_by(mac=discovery.access_point_mac).first()
+    #only the "last seen" values change: write them later (see server/writebehind.py)
+    deferred = ap is not None and ap_buffer.can_defer(ap, discovery)
 
     if ap:
         #if there is, add this discovery to the ap
         #and update the values of the AP
-        ap.update(discovery)
+        if not deferred:
+            ap.update(discovery)
     
     #if this is the first time the AP is discovered
     else:
@@ -151,6 +381,8 @@ def add_discovery():
         db.session.commit()
     except exc.IntegrityError as e:
         return jsonify({'message': 'Integrity error occured when adding discovery.'}), 400
+    if deferred:
+        ap_buffer.submit(discovery)
 
     return jsonify({'message': 'New discovery was added.'})
 
@@ -162,10 +394,26 @@ def delete_discovery(mac, discovery_id):
     Delete a single discovery of an AP. Does not mean the AP will be deleted even if it is 
     the last discovery left of this AP (TODO).
     """
-    dis = Discovery.query.filter_by(id=discovery_id).first_or_404()
-
+    #discoveries stored in a shard have ids that can't occur in the main DB
+    #(the id contains the map, but discoveries of geofenced maps would have to be loaded to check them)
+    visibility = acl.visibility()
+    ids = from_global_id(discovery_id) if shards.enabled else None
+    if ids and visibility.can_see(ids[0]) and visibility.fence(ids[0]) is None:
+        deleted = shards.delete_discovery(discovery_id)
+        if deleted is not None:
+            storage.remove(ids[0], [row_of(deleted)])
+            return jsonify({'message': 'Discovery has been deleted.'})
+
+    query = Discovery.query.filter_by(id=discovery_id)
+    visible = visibility.discovery_filter()
+    if visible is not None:
+        query = query.filter(visible)
+    dis = query.first_or_404()
+
+    row = row_of(dis)
     db.session.delete(dis)
     db.session.commit()
+    storage.remove(dis.map_id, [row])
 
     return jsonify({'message': 'Discovery has been deleted.'})
 
@@ -177,5 +425,11 @@ def get_all_discoveries():
     Show all discoveries. Primarily intended for debugging.
     """
 
-    discoveries = Discovery.query.all()
+    visibility = acl.visibility()
+    other = shards.discoveries() + archive.discoveries()
+    if visibility.unrestricted:
+        discoveries = Discovery.query.all() + other
+    else:
+        discoveries = Discovery.query.filter(visibility.discovery_filter()).all()
+        discoveries += [d for d in other if visibility.contains(d.map_id, d.gps_lat, d.gps_lon)]
     return jsonify({'discoveries': discoveries_schema.dump(discoveries)})
\ No newline at end of file
@@ -1,21 +1,19 @@
+import json
+
 from marshmallow import fields
 
 from server import ma
-from server.models import AccessPoint, Discovery, WardrivingMap, User, Sniffer, Map_StringEAV, AP_EAV
+from server.oui import oui_registry
+from server.models import AccessPoint, Discovery, WardrivingMap, User, Sniffer, Map_StringEAV, AP_EAV, UploadSession, APChange, Track, \
+    AnomalyFinding
 
 """
 Here are all API definitions, meaning that 
 it is defined how the output and valid input of our API should look like.
-"""
 
-#already define this here and complete it later in order to prevent a NameError
-#since we have cyclic class dependencies here (because we need class names for fields.Nested)
-class MapSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = WardrivingMap
-class DiscoverySchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = Discovery
+NOTE: building these schemas is expensive, so the endpoints don't import this module directly
+but use the lazy stand-ins of server/endpoints/schemas.py
+"""
 
 
 ###################################USER RELATED###################################################
@@ -44,8 +42,10 @@ class SnifferSchema(ma.SQLAlchemyAutoSchema):
         load_only = ['password']
         dump_only = ['public_id', 'id']
     
-    maps = fields.Nested(MapSchema, many=True)
-    discoveries = fields.Nested(DiscoverySchema, many=True)
+    #we have cyclic class dependencies here, so these schemas are referenced by name (resolved when first used)
+    #only the plain columns of maps and discoveries are shown here
+    maps = fields.Nested("MapSchema", many=True, exclude=['sniffers', 'discoveries', 'attributes'])
+    discoveries = fields.Nested("DiscoverySchema", many=True, exclude=['access_point_mac', 'sniffer'])
 
 sniffer_schema = SnifferSchema()
 sniffers_schema = SnifferSchema(many=True, exclude=['discoveries'])
@@ -85,7 +85,13 @@ class DiscoverySchema(ma.SQLAlchemyAutoSchema):
     
 
 discovery_schema = DiscoverySchema()
+#creates Discovery objects without touching the DB session (used by the async routes, see server/asgi.py)
+discovery_input_schema = DiscoverySchema(transient=True)
 discoveries_schema = DiscoverySchema(many=True)
+#discoveries listed as part of their AP (the mac is already part of the AP itself)
+ap_discoveries_schema = DiscoverySchema(many=True, exclude=['access_point_mac'])
+#discoveries listed as part of their sniffer (like SnifferSchema.discoveries)
+sniffer_discoveries_schema = DiscoverySchema(many=True, exclude=['access_point_mac', 'sniffer'])
 
 
 class AccessPointSchema(ma.SQLAlchemyAutoSchema):
@@ -98,8 +104,13 @@ class AccessPointSchema(ma.SQLAlchemyAutoSchema):
         #fields to exclude (entirely/when producing JSON output/when parsing incoming data)
         exclude=[]
         load_only = []
-        dump_only = []
+        dump_only = ['oui']
     
+    #vendor is looked up in memory using the OUI, so this does not cost an additional query per AP
+    vendor = fields.Method("get_vendor", dump_only=True)
+    def get_vendor(self, ap):
+        return oui_registry.vendor(ap.mac)
+
     #you don't need to transfer 'access_point_mac' since the mac is already part of the AP itself
     discoveries = fields.Nested(DiscoverySchema, many=True, exclude=['access_point_mac'])
     attributes = fields.Nested(AP_EAV_Schema, many=True)
@@ -109,6 +120,16 @@ ap_schema = AccessPointSchema()
 aps_schema = AccessPointSchema(many=True, exclude=['discoveries'])
 
 
+class APChangeSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = APChange
+        #we want to see the mac of the AP and the map
+        include_fk = True
+        exclude = ['id']
+
+ap_changes_schema = APChangeSchema(many=True)
+
+
 ###########################################MAP####################################################
 
 class MapEAVSchema(ma.SQLAlchemyAutoSchema):
@@ -127,7 +148,7 @@ class MapSchema(ma.SQLAlchemyAutoSchema):
         #fields to exclude (entirely/when producing JSON output/when parsing incoming data)
         exclude=[]
         load_only = []
-        dump_only = []
+        dump_only = ['archived']
     
     sniffers = fields.Nested(SnifferSchema, many=True, exclude=["maps", "discoveries"])
     discoveries = fields.Nested(DiscoverySchema, many=True)
@@ -136,4 +157,46 @@ class MapSchema(ma.SQLAlchemyAutoSchema):
 map_schema = MapSchema()
 maps_schema = MapSchema(many=True, exclude=['discoveries'])
 
- 
\ No newline at end of file
+
+###########################################UPLOADS################################################
+
+class UploadSessionSchema(ma.SQLAlchemyAutoSchema):
+
+    class Meta:
+        model = UploadSession
+        include_fk = True
+        #the internal id is not needed since the session is identified by its public id
+        exclude = ['id']
+
+upload_session_schema = UploadSessionSchema()
+
+
+###########################################TRACKS#################################################
+
+class TrackSchema(ma.SQLAlchemyAutoSchema):
+
+    class Meta:
+        model = Track
+        include_fk = True
+        #the encoded points are added by the endpoint at the requested level of detail
+        exclude = ['path', 'significance', 'times']
+
+track_schema = TrackSchema()
+tracks_schema = TrackSchema(many=True)
+
+
+###########################################ALERTS#################################################
+
+class AnomalyFindingSchema(ma.SQLAlchemyAutoSchema):
+
+    class Meta:
+        model = AnomalyFinding
+        include_fk = True
+
+    #stored as JSON text
+    details = fields.Method('dump_details')
+
+    def dump_details(self, finding):
+        return json.loads(finding.details) if finding.details else None
+
+anomaly_findings_schema = AnomalyFindingSchema(many=True)
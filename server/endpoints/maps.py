@@ -1,15 +1,54 @@
-from flask import request, jsonify, current_app as app, Blueprint, g
-from sqlalchemy import exc
+from flask import request, jsonify, current_app as app, Blueprint, g, make_response
+from sqlalchemy import exc, select
 from marshmallow import ValidationError
 
+import base64
+import math
+from datetime import datetime, timezone
+
+import numpy as np
+
 from server import db
-from server.models import AccessPoint, WardrivingMap, Sniffer, Discovery, Map_StringEAV
-from server.endpoints.api_definition import map_schema, maps_schema, sniffers_schema, discovery_schema, discoveries_schema
-from server.login import login_required
+from server.sharding import shards
+from server.archive import archive
+from server.acl import acl
+from server.storage import storage, viewport_bbox
+from server.oui import oui_registry
+from server.cache import LRUCache
+from server.ingest import insert_ignore, store_discovery, RESPONSES
+from server import heatmap, polyline
+from server.models import AccessPoint, WardrivingMap, Sniffer, Map_StringEAV, APChange, Track, \
+    MapContribution, ContributedAP, participate_in, User, MapAccess, AnomalyFinding
+from server.endpoints.schemas import map_schema, maps_schema, discovery_schema, discoveries_schema, ap_changes_schema, \
+    track_schema, anomaly_findings_schema
+from server.login import login_required, admin_required
 
 maps = Blueprint('maps', __name__, url_prefix='/maps')
 
 
+@maps.record_once
+def init_heatmap_cache(state):
+    state.app.extensions['heatmap_cache'] = LRUCache(state.app.config['HEATMAP_CACHE_SIZE'])
+
+
+def _get_map(id):
+    """
+    The map with this id, 404 if it doesn't exist or isn't shared with the current user (see server/acl.py)
+    """
+    query = WardrivingMap.query.filter_by(id=id)
+    visible = acl.visibility().map_filter(WardrivingMap.id)
+    if visible is not None:
+        query = query.filter(visible)
+    return query.first_or_404()
+
+
+def _fence_discoveries(visibility, map_id, output):
+    #dumped discoveries of a geofenced map: only those within the fence
+    if visibility.fence(map_id) is None:
+        return output
+    return [d for d in output if visibility.contains(map_id, d['gps_lat'], d['gps_lon'])]
+
+
 ###############################################ROUTES########################################
 
 
@@ -19,7 +58,11 @@ def get_all_maps():
     """
     Get all maps including their generic eav attributes
     """
-    maps = WardrivingMap.query.all()
+    visibility = acl.visibility()
+    query = WardrivingMap.query
+    if not visibility.unrestricted:
+        query = query.filter(visibility.map_filter(WardrivingMap.id))
+    maps = query.all()
 
     output = maps_schema.dump(maps)
     return jsonify({'maps': output})
@@ -31,9 +74,15 @@ def get_map(id):
     """
     Retrieve the information of a single map (including the generic eav attributes)
     """
-    ap = WardrivingMap.query.filter_by(id=id).first_or_404()
+    ap = _get_map(id)
 
-    return jsonify({'map': map_schema.dump(ap)}) 
+    output = map_schema.dump(ap)
+    #in sharded mode, most of the discoveries are stored in the shard of this map
+    output['discoveries'] += discoveries_schema.dump(shards.discoveries(map_id=ap.id))
+    #the discoveries of a finalized map are in its archive
+    output['discoveries'] += discoveries_schema.dump(archive.discoveries(ap.id))
+    output['discoveries'] = _fence_discoveries(acl.visibility(), ap.id, output['discoveries'])
+    return jsonify({'map': output}) 
 
 
 @maps.route('', methods=['POST'])
@@ -52,6 +101,9 @@ def create_map():
         db.session.commit()
     except exc.IntegrityError as e:
         return jsonify({'message': 'Integrity error occured.'}), 400
+    #the creator can see the new map
+    if acl.enabled and not g.current_user.admin:
+        acl.grant(map.id, g.current_user.id)
 
     return jsonify({'message': 'New map created.', 'map_id': map.id})
 
@@ -63,7 +115,7 @@ def update_map(id):
     """
     Update map information
     """
-    map = WardrivingMap.query.filter_by(id=id).first_or_404()
+    map = _get_map(id)
 
     try:
         #update existing object 
@@ -82,20 +134,55 @@ def update_map(id):
 @maps.route('/<id>', methods=['DELETE'])
 @login_required
 def delete_map(id):
-    map = WardrivingMap.query.filter_by(id=id).first_or_404()
+    map = _get_map(id)
 
+    #the contribution counters are deleted with plain statements instead of loading them as objects
+    for model in (MapContribution, ContributedAP, MapAccess, AnomalyFinding):
+        db.session.execute(model.__table__.delete().where(model.__table__.c.map_id == map.id))
     db.session.delete(map)
     db.session.commit()
+    archive.delete(map.id)
+    shards.delete_map(map.id)
+    storage.remove(map.id)
 
     return jsonify({'message': 'Map has been deleted.'})
 
+
+@maps.route('/<id>/finalize', methods=['POST'])
+@admin_required
+def finalize_map(id):
+    """
+    Move all discoveries of this (completed) map from the discovery table into a read-only archive
+    (uncompressed, memory-mapped .npy files, see server/archive.py). The map can still be read just like before.
+    """
+    map = _get_map(id)
+    if map.archived:
+        return jsonify({'message': 'Map has already been finalized.'}), 409
+
+    n = archive.finalize(map)
+    return jsonify({'message': 'Map has been finalized.', 'discoveries': n})
+
+
+@maps.route('/<id>/reactivate', methods=['POST'])
+@admin_required
+def reactivate_map(id):
+    """
+    Move the discoveries of a finalized map back into the discovery table, so new discoveries can be added
+    """
+    map = _get_map(id)
+    if not map.archived:
+        return jsonify({'message': 'Map has not been finalized.'}), 409
+
+    n = archive.reactivate(map)
+    return jsonify({'message': 'Map has been reactivated.', 'discoveries': n})
+
 @maps.route('/<id>/meta', methods=["POST"])
 @login_required
 def add_map_metadata(id):
     """
     Dynamically add map attributes
     """
-    map = WardrivingMap.query.filter_by(id=id).first_or_404()
+    map = _get_map(id)
     
     #get post data
     input = request.get_json(silent=True)
@@ -125,7 +212,7 @@ def add_discovery(id):
     If there is no corresponding Access Point for this discovery, 
     a new AP is also created in the process.
     """
-    map = WardrivingMap.query.filter_by(id=id).first_or_404()
+    map = _get_map(id)
 
     #load Discovery object from JSON input
     try:
@@ -133,39 +220,12 @@ def add_discovery(id):
     except ValidationError as e:
         return jsonify(e.messages), 400
 
-    #if this is the first time the AP is discovered, add the AP
-    #check whether there already is an AP with this mac
-    ap = AccessPoint.query.filter_by(mac=discovery.access_point_mac).first()
-
-    if ap:
-        #if there is, add this discovery to the ap
-        #and update the values of the AP
-        ap.update(discovery)
-    
-    #if this is the first time the AP is discovered
-    else:
-        #also automatically sets this AP as the access_point of the current discovery
-        ap = AccessPoint(mac=discovery.access_point_mac)
-        ap.update(discovery)
-
-        try:
-            db.session.add(ap)
-            db.session.commit()
-        except exc.IntegrityError as e:
-            return jsonify({'message': 'Integrity error occured when adding AP.'}), 400
-    
-    #as foreign key we can use the current user object
-    discovery.sniffer_id = g.current_user.id
-    #add discovery to map
-    discovery.map_id = map.id
-
-    try:
-        db.session.add(discovery)
-        db.session.commit()
-    except exc.IntegrityError as e:
-        return jsonify({'message': 'Integrity error occured when adding discovery.'}), 400
+    if not archive.ensure_writable(map):
+        return jsonify({'message': 'Map has been finalized, reactivate it to add discoveries.'}), 409
 
-    return jsonify({'message': 'New discovery was added.'})
+    #the same code stores the discoveries sent to the ASGI server (see server/ingest.py)
+    message, status = RESPONSES[store_discovery(db.session, map.id, discovery, g.current_user.id)]
+    return jsonify({'message': message}), status
 
 
 @maps.route('/<id>/aps', methods=['GET'])
@@ -175,42 +235,342 @@ def get_aps(id):
     Returns all discoveries that belong to this map that are within the rectangle defined by 
     [lat1, lon1] and [lat2, lon2]
     """
-    map = WardrivingMap.query.filter_by(id=id).first_or_404()
+    map = _get_map(id)
 
-    #get query parameters
-    lat1, lat2 = request.args.get('lat1'), request.args.get('lat2')
-    lon1, lon2 = request.args.get('lon1'), request.args.get('lon2')
-
-    if not (lat1 and lat2 and lon1 and lon2):
+    try:
+        bbox = viewport_bbox(request.args)
+    except ValueError:
         return jsonify({'message': 'Please provide lat and lon values'}), 400
-    else:
-        #parse arguments (query params are strings)
-        lat1, lat2 = float(lat1), float(lat2)
-        lon1, lon2 = float(lon1), float(lon2)
-
-    lat_min, lon_min = min(lat1, lat2), min(lon1, lon2)
-    lat_max, lon_max = max(lat1, lat2), max(lon1, lon2)
 
     #NOTE: (idea) add a route in the future that only displays unique APs
     # AccessPoint.query.join(AccessPoint.maps).filter(WardrivingMap.id == id) \
     #     .filter(AccessPoint.lat <= lat_max, AccessPoint.lat >= lat_min,
     #             AccessPoint.lon <= lon_max, AccessPoint.lon >= lon_min).all()
-    discoveries = Discovery.query.filter_by(map_id=map.id).filter( 
-        Discovery.gps_lat >= lat_min, Discovery.gps_lat <= lat_max, 
-        Discovery.gps_lon >= lon_min, Discovery.gps_lon <= lon_max).all()
+    #the DB (with shards and archive) or its columnar copy, see server/storage.py; the ASGI route does the same
+    discoveries = storage.viewport(acl.visibility(), map.id, bbox)
 
     return jsonify({'discoveries': discoveries_schema.dump(discoveries)})
 
 
 
+@maps.route('/<id>/stats', methods=['GET'])
+@login_required
+def get_map_stats(id):
+    """
+    Statistics of this map: number of discoveries, number of unique APs and APs per vendor
+    """
+    map = _get_map(id)
+
+    #on a geofenced map, only the discoveries within the fence are counted
+    n_discoveries, n_aps, ouis = storage.reads.counts(map.id, acl.visibility().fence(map.id))
+
+    vendors = [{'oui': f'{oui:06X}', 'vendor': oui_registry.vendor_of_oui(oui), 'aps': count}
+               for oui, count in ouis.most_common()]
+
+    return jsonify({'stats': {'discoveries': n_discoveries, 'aps': n_aps, 'vendors': vendors}})
+
+
+@maps.route('/<id>/heatmap', methods=['GET'])
+@login_required
+def get_heatmap(id):
+    """
+    Signal strength heatmap of this map, rendered on the server.
+    Query parameters (all optional):
+    - bbox=lat1,lon1,lat2,lon2: area of the heatmap (default: area covered by the discoveries)
+    - resolution: number of cells from west to east (default 128); cells are roughly square
+    - ap: only use the discoveries of the AP with this mac
+    - agg: 'max' (default) or 'mean' of the signal strengths within a cell
+    - format: 'png' (default) or 'json' (cells as int8 [dBm], base64 encoded, row by row from north to south)
+    """
+    map = _get_map(id)
+
+    agg = request.args.get('agg', 'max')
+    format = request.args.get('format', 'png')
+    if agg not in ('max', 'mean') or format not in ('png', 'json'):
+        return jsonify({'message': "agg has to be 'max' or 'mean', format has to be 'png' or 'json'."}), 400
+    try:
+        bbox = request.args.get('bbox')
+        if bbox:
+            lat1, lon1, lat2, lon2 = [float(x) for x in bbox.split(',')]
+            bbox = (min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2))
+        resolution = int(request.args.get('resolution', 128))
+        mac = request.args.get('ap')
+        mac = int(mac) if mac else None
+    except ValueError:
+        return jsonify({'message': 'bbox has to be lat1,lon1,lat2,lon2; resolution and ap have to be integers.'}), 400
+    if not 0 < resolution <= app.config['HEATMAP_MAX_RESOLUTION']:
+        return jsonify({'message': f"resolution has to be between 1 and {app.config['HEATMAP_MAX_RESOLUTION']}."}), 400
+
+    #on a geofenced map, only the discoveries within the fence are used
+    fence = acl.visibility().fence(map.id)
+
+    #the heatmap only changes when discoveries are added to or removed from this map
+    key = (map.id, storage.reads.name, storage.reads.version(map.id), bbox, fence, resolution, mac, agg, format)
+    cache = app.extensions['heatmap_cache']
+    cached = cache.get(key)
+
+    if cached is None:
+        areas = acl.visibility().bboxes(map.id, bbox)
+        if areas:
+            lat, lon, rssi = storage.reads.signal_points(map.id, areas[0], mac)
+        else:
+            lat = lon = rssi = np.array([])
+        if not bbox:
+            if not len(rssi):
+                return jsonify({'message': 'There are no discoveries for this heatmap.'}), 404
+            bbox = (lat.min(), lon.min(), lat.max(), lon.max())
+
+        #choose the number of rows so that the cells are roughly square on the ground
+        lat_span, lon_span = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        lon_span *= math.cos(math.radians((bbox[0] + bbox[2]) / 2))
+        height = resolution if not lon_span else round(resolution * lat_span / lon_span)
+        height = min(max(height, 1), app.config['HEATMAP_MAX_RESOLUTION'])
+
+        grid = heatmap.rasterize(lat, lon, rssi, bbox, resolution, height, agg)
+        bbox = [float(x) for x in bbox]
+        if format == 'png':
+            cached = (heatmap.to_png(grid), bbox)
+        else:
+            cached = ({'bbox': bbox, 'width': resolution, 'height': height, 'agg': agg, 'nodata': heatmap.NODATA,
+                       'values': base64.b64encode(heatmap.to_int8(grid).tobytes()).decode()}, bbox)
+        cache.put(key, cached)
+
+    data, bbox = cached
+    if format == 'json':
+        return jsonify({'heatmap': data})
+
+    resp = make_response(data)
+    resp.mimetype = 'image/png'
+    #the client needs to know where to place the image
+    resp.headers['X-Heatmap-Bbox'] = ','.join(str(x) for x in bbox)
+    return resp
+
+
+@maps.route('/<id>/changes', methods=['GET'])
+@login_required
+def get_changes(id):
+    """
+    Report of the APs on this map whose SSID, encryption or channel changed since a point in time.
+    Query parameters: since (ISO 8601 timestamp, required), attribute (optional), limit (default 1000)
+    """
+    map = _get_map(id)
+
+    try:
+        since = datetime.fromisoformat(request.args.get('since', ''))
+        limit = int(request.args.get('limit', 1000))
+    except ValueError:
+        return jsonify({'message': 'Please provide since as ISO 8601 timestamp (and limit as integer).'}), 400
+
+    #uses the index on (map_id, timestamp) of the change log
+    query = APChange.query.filter(APChange.map_id == map.id, APChange.timestamp >= since)
+    visibility = acl.visibility()
+    if visibility.fence(map.id) is not None:
+        #only the APs within the fence
+        query = query.filter(APChange.mac.in_(select(AccessPoint.mac).where(visibility.ap_filter())))
+    if request.args.get('attribute'):
+        query = query.filter(APChange.attribute == request.args['attribute'])
+    changes = query.order_by(APChange.timestamp).limit(limit).all()
+
+    return jsonify({'changes': ap_changes_schema.dump(changes), 'aps': len({c.mac for c in changes})})
+
+
+@maps.route('/<id>/alerts', methods=['GET'])
+@login_required
+def get_alerts(id):
+    """
+    Suspicious APs found on this map by the anomaly detection (flask data anomalies, see server/anomalies.py),
+    most recent first. Query parameters (all optional): kind (evil_twin, ssid_clone, displaced), severity,
+    since (ISO 8601 timestamp, last seen since then), limit (default 1000)
+    """
+    map = _get_map(id)
+
+    try:
+        since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+        limit = int(request.args.get('limit', 1000))
+    except ValueError:
+        return jsonify({'message': 'Please provide since as ISO 8601 timestamp (and limit as integer).'}), 400
+
+    #uses the index on (map_id, last_seen)
+    query = AnomalyFinding.query.filter(AnomalyFinding.map_id == map.id)
+    visible = acl.visibility().discovery_filter(AnomalyFinding.__table__)
+    if visible is not None:
+        #on a geofenced map, only the findings within the fence
+        query = query.filter(visible)
+    if since is not None:
+        query = query.filter(AnomalyFinding.last_seen >= since)
+    for attribute in ('kind', 'severity'):
+        if request.args.get(attribute):
+            query = query.filter(getattr(AnomalyFinding, attribute) == request.args[attribute])
+    findings = query.order_by(AnomalyFinding.last_seen.desc()).limit(limit).all()
+
+    return jsonify({'alerts': anomaly_findings_schema.dump(findings)})
+
+
+def _parse_fixes(fixes):
+    """
+    [[lat, lon, timestamp], ...] with ISO 8601 timestamps or seconds since the epoch -> list of (lat, lon, datetime)
+    ordered by time. Raises ValueError if a fix is invalid.
+    """
+    parsed = []
+    for fix in fixes:
+        if not isinstance(fix, (list, tuple)) or len(fix) != 3:
+            raise ValueError()
+        lat, lon, t = float(fix[0]), float(fix[1]), fix[2]
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError()
+        t = datetime.utcfromtimestamp(t) if isinstance(t, (int, float)) else datetime.fromisoformat(t)
+        #timestamps with an offset are converted to UTC, naive ones are taken as UTC
+        if t.tzinfo is not None:
+            t = t.astimezone(timezone.utc).replace(tzinfo=None)
+        parsed.append((lat, lon, t))
+    return sorted(parsed, key=lambda fix: fix[2])
+
+
+def _track_tolerance(track):
+    """
+    Level of detail [km] requested with the query parameters 'tolerance' [m] or 'zoom' (of a web map)
+    """
+    if request.args.get('zoom') is not None:
+        zoom = float(request.args['zoom'])
+        points = track.simplified(float('inf'))
+        lat = points[0][0] if points else 0
+        #size of a pixel [m] at this zoom level: details smaller than that can't be seen anyway
+        return 156543.03 * math.cos(math.radians(lat)) / 2 ** zoom / 1000
+    return float(request.args.get('tolerance', app.config['TRACK_DEFAULT_TOLERANCE'])) / 1000
+
+
+def _dump_track(track):
+    tolerance = _track_tolerance(track)
+    points = track.simplified(tolerance)
+    #on a geofenced map, only the parts of the track within the fence
+    visibility = acl.visibility()
+    if visibility.fence(track.map_id) is not None:
+        points = [p for p in points if visibility.contains(track.map_id, p[0], p[1])]
+    output = track_schema.dump(track)
+    output['tolerance'] = tolerance * 1000
+    if request.args.get('format') == 'points':
+        output['points'] = [[lat, lon, offset] for lat, lon, offset in points]
+    else:
+        output['path'] = polyline.encode([(lat, lon) for lat, lon, _ in points])
+        output['times'] = polyline.encode_deltas(offset for _, _, offset in points)
+    return output
+
+
+@maps.route('/<id>/tracks', methods=['POST'])
+@login_required
+def add_track(id):
+    """
+    Upload the GPS track of a drive: {"fixes": [[lat, lon, timestamp], ...]}.
+    To continue a track in further uploads, send the id of the track returned by the first one as "track".
+    The uploads may come in any order, but must not overlap in time (409).
+    """
+    map = _get_map(id)
+    if not isinstance(g.current_user, Sniffer):
+        return jsonify({'message': 'Only sniffers can upload tracks.'}), 403
+
+    input = request.get_json(silent=True)
+    if not input or not isinstance(input.get('fixes'), list) or not input['fixes']:
+        return jsonify({'message': 'You have to provide a list of fixes [lat, lon, timestamp].'}), 400
+    if len(input['fixes']) > app.config['TRACK_MAX_FIXES']:
+        return jsonify({'message': f'At most {app.config["TRACK_MAX_FIXES"]} fixes can be uploaded at once.'}), 413
+    try:
+        fixes = _parse_fixes(input['fixes'])
+    except (ValueError, TypeError, OverflowError):
+        return jsonify({'message': 'Every fix has to be [lat, lon, timestamp] (ISO 8601 or seconds since the epoch).'}), 400
+
+    if input.get('track') is not None:
+        track = Track.query.filter_by(id=input['track'], map_id=map.id, sniffer_id=g.current_user.id).first_or_404()
+    else:
+        track = Track(map_id=map.id, sniffer_id=g.current_user.id)
+    if track.overlaps(fixes):
+        return jsonify({'message': 'The fixes overlap a part of the track that was already uploaded.'}), 409
+    track.add_fixes(fixes, app.config['TRACK_MIN_TOLERANCE'] / 1000)
+
+    db.session.add(track)
+    db.session.commit()
+
+    return jsonify({'message': 'Track stored.', 'track': track_schema.dump(track)})
+
+
+@maps.route('/<id>/tracks', methods=['GET'])
+@login_required
+def get_tracks(id):
+    """
+    All tracks of this map, simplified to the requested level of detail.
+    Query parameters: tolerance [m] or zoom (web map zoom level), sniffer (public id),
+    format ('path': encoded polylines, default; 'points': [lat, lon, seconds since t_start])
+    """
+    map = _get_map(id)
+
+    query = Track.query.filter_by(map_id=map.id)
+    if request.args.get('sniffer'):
+        sniffer = Sniffer.query.filter_by(public_id=request.args['sniffer']).first_or_404()
+        query = query.filter_by(sniffer_id=sniffer.id)
+    try:
+        return jsonify({'tracks': [_dump_track(track) for track in query.order_by(Track.t_start).all()]})
+    except ValueError:
+        return jsonify({'message': 'tolerance and zoom have to be numbers.'}), 400
+
+
+@maps.route('/<id>/tracks/<int:track_id>', methods=['GET'])
+@login_required
+def get_track(id, track_id):
+    """
+    One track at the requested level of detail (same query parameters as for all tracks)
+    """
+    map = _get_map(id)
+    track = Track.query.filter_by(id=track_id, map_id=map.id).first_or_404()
+    try:
+        return jsonify({'track': _dump_track(track)})
+    except ValueError:
+        return jsonify({'message': 'tolerance and zoom have to be numbers.'}), 400
+
+
+#orders of the leaderboard of a map: column and whether the highest value comes first
+LEADERBOARD_ORDERS = {
+    'discoveries': (MapContribution.discoveries, True),
+    'aps': (MapContribution.aps, True),
+    'first_seen': (MapContribution.first_seen, False),
+    'last_seen': (MapContribution.last_seen, True),
+}
+
+
 @maps.route('/<id>/sniffers', methods=['GET'])
 @login_required
 def get_all_sniffers(id):
     """
-    Get all contributing sniffers of this map
+    Leaderboard of the sniffers that contributed to this map: their discoveries, different APs and
+    first/last discovery on this map. Query parameters: order ('discoveries' (default), 'aps', 'first_seen',
+    'last_seen'), limit (default: all)
     """
-    map = WardrivingMap.query.filter_by(id=id).first_or_404() 
-    return jsonify({'sniffers': sniffers_schema.dump(map.sniffers)})
+    map = _get_map(id)
+
+    order = request.args.get('order', 'discoveries')
+    if order not in LEADERBOARD_ORDERS:
+        return jsonify({'message': f"order has to be one of {', '.join(LEADERBOARD_ORDERS)}."}), 400
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({'message': 'limit has to be an integer.'}), 400
+    column, descending = LEADERBOARD_ORDERS[order]
+
+    #the counters are maintained at ingest, so this only reads one row per contributor
+    query = db.session.query(Sniffer.id, Sniffer.public_id, Sniffer.name, MapContribution.discoveries, MapContribution.aps,
+                             MapContribution.first_seen, MapContribution.last_seen) \
+        .select_from(participate_in).join(Sniffer, Sniffer.id == participate_in.c.sniffer_id) \
+        .outerjoin(MapContribution, (MapContribution.map_id == participate_in.c.map_id) &
+                   (MapContribution.sniffer_id == participate_in.c.sniffer_id)) \
+        .filter(participate_in.c.map_id == map.id) \
+        .order_by(column.is_(None), column.desc() if descending else column, Sniffer.name)
+    if limit is not None:
+        query = query.limit(limit)
+
+    sniffers = [{'rank': rank, 'id': id, 'public_id': public_id, 'name': name,
+                 'discoveries': discoveries or 0, 'aps': aps or 0,
+                 'first_seen': first_seen.isoformat() if first_seen else None,
+                 'last_seen': last_seen.isoformat() if last_seen else None}
+                for rank, (id, public_id, name, discoveries, aps, first_seen, last_seen) in enumerate(query, 1)]
+    return jsonify({'sniffers': sniffers, 'order': order})
 
 
 @maps.route('/<id>/sniffers', methods=['POST'])
@@ -219,19 +579,65 @@ def add_sniffer(id):
     """
     Add the current sniffer as a contributer to this map
     """
-    map = WardrivingMap.query.filter_by(id=id).first_or_404()
+    map = _get_map(id)
 
-    print(g.current_user.id)
-    sniffer = Sniffer.query.filter_by(id=g.current_user.id).first()
-    if not sniffer:
+    if not isinstance(g.current_user, Sniffer):
         return jsonify({'message': 'Sniffer with this id could not be found. Maybe you are \
-                                    trying to add the admin user as a Sniffer to this map.'})          
-    map.sniffers.append(sniffer)
+                                    trying to add the admin user as a Sniffer to this map.'})
 
-    try:
-        db.session.add(map)
-        db.session.commit()
-    except exc.IntegrityError as e:
-        return jsonify({'message': 'Integrity error occured.'}), 400
+    #nothing happens if the sniffer already is a contributor, and the other contributors are never loaded
+    insert_ignore(db.session, participate_in, [{'map_id': map.id, 'sniffer_id': g.current_user.id}])
+    db.session.commit()
+
+    return jsonify({'message': 'Added sniffer as contributer to map.'}), 200
+
+
+################################## sharing (see server/acl.py) ##################################
+
+@maps.route('/<id>/access', methods=['GET'])
+@admin_required
+def get_map_access(id):
+    """
+    The users this map is shared with and their geofences (only enforced with MAP_ACL_ENABLED)
+    """
+    map = _get_map(id)
+
+    rows = db.session.query(User.public_id, User.name, MapAccess).join(MapAccess, MapAccess.user_id == User.id) \
+        .filter(MapAccess.map_id == map.id).order_by(User.name)
+    return jsonify({'access': [{'public_id': public_id, 'name': name,
+                                'bbox': list(access.bbox) if access.bbox else None}
+                               for public_id, name, access in rows]})
+
+
+@maps.route('/<id>/access/<public_id>', methods=['PUT'])
+@admin_required
+def share_map(id, public_id):
+    """
+    Share this map with a user. Optional JSON body {"bbox": [lat1, lon1, lat2, lon2]}: the user only sees
+    the discoveries and APs of the map within this box.
+    """
+    map = _get_map(id)
+    user = User.query.filter_by(public_id=public_id).first_or_404()
+
+    input = request.get_json(silent=True) or {}
+    bbox = input.get('bbox')
+    if bbox is not None:
+        try:
+            lat1, lon1, lat2, lon2 = [float(x) for x in bbox]
+        except (TypeError, ValueError):
+            return jsonify({'message': 'bbox has to be [lat1, lon1, lat2, lon2].'}), 400
+        bbox = (min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2))
+
+    acl.grant(map.id, user.id, bbox)
+    return jsonify({'message': f'Map has been shared with {user.name}.'})
+
+
+@maps.route('/<id>/access/<public_id>', methods=['DELETE'])
+@admin_required
+def unshare_map(id, public_id):
+    map = _get_map(id)
+    user = User.query.filter_by(public_id=public_id).first_or_404()
 
-    return jsonify({'message': 'Added sniffer as contributer to map.'}), 200
\ No newline at end of file
+    if not acl.revoke(map.id, user.id):
+        return jsonify({'message': 'Map has not been shared with this user.'}), 404
+    return jsonify({'message': f'Map is no longer shared with {user.name}.'})
@@ -0,0 +1,70 @@
+import importlib
+
+from server.profiling import profiler
+
+
+"""
+Lazy stand-ins for the schema instances of api_definition.py.
+
+Building all SQLAlchemyAutoSchemas takes a noticeable amount of time, which every process
+(e.g. each gunicorn worker or test run) would have to pay at import time, even if it never uses most of them.
+The objects here only import api_definition (and thereby build the schemas) when they are used for the first time.
+If PRELOAD_SCHEMAS is set, create_server builds them right away instead, which is what you want
+when gunicorn preloads the app before forking its workers (they then share the schemas).
+"""
+
+
+def load_schemas():
+    """
+    Build all schemas now (if this has not happened yet) and return the api_definition module
+    """
+    #python's import system already makes sure this happens only once, even with multiple threads
+    return importlib.import_module('server.endpoints.api_definition')
+
+
+class LazySchema():
+    """
+    Behaves like the schema instance with the given name in api_definition
+    """
+    def __init__(self, name):
+        self._name = name
+        self._schema = None
+
+    def __getattr__(self, attr):
+        #only called for attributes this object doesn't have itself (e.g. dump or load)
+        if self._schema is None:
+            self._schema = getattr(load_schemas(), self._name)
+        value = getattr(self._schema, attr)
+        if attr == 'dump':
+            #measured in traced requests (see server/profiling.py)
+            return profiler.wrap('serialize', value)
+        return value
+
+    def __repr__(self):
+        return f"LazySchema('{self._name}')"
+
+
+user_schema = LazySchema('user_schema')
+users_schema = LazySchema('users_schema')
+sniffer_schema = LazySchema('sniffer_schema')
+sniffers_schema = LazySchema('sniffers_schema')
+
+discovery_schema = LazySchema('discovery_schema')
+discovery_input_schema = LazySchema('discovery_input_schema')
+discoveries_schema = LazySchema('discoveries_schema')
+ap_discoveries_schema = LazySchema('ap_discoveries_schema')
+sniffer_discoveries_schema = LazySchema('sniffer_discoveries_schema')
+
+ap_schema = LazySchema('ap_schema')
+aps_schema = LazySchema('aps_schema')
+ap_changes_schema = LazySchema('ap_changes_schema')
+
+map_schema = LazySchema('map_schema')
+maps_schema = LazySchema('maps_schema')
+
+upload_session_schema = LazySchema('upload_session_schema')
+
+track_schema = LazySchema('track_schema')
+tracks_schema = LazySchema('tracks_schema')
+
+anomaly_findings_schema = LazySchema('anomaly_findings_schema')
@@ -1,8 +1,12 @@
 from flask import request, jsonify, make_response, current_app as app, Blueprint
-from werkzeug.security import check_password_hash
 
+from server.replicas import replicas
+from server.ratelimit import limiter
+from server.passwords import passwords, HashingOverloaded
+from server.profiling import profiler
+from server.sharding import shards
 from server.models import User
-from server.login import generate_token 
+from server.login import generate_token, generate_refresh_token, user_of_refresh_token, admin_required
 
 
 system = Blueprint('system', __name__)
@@ -69,9 +73,101 @@ def login():
         return make_response('Could not verify!', 401, {'WWW-Authenticate' : 'Basic realm="Login Required"'})
 
     #password is not correct
-    if not check_password_hash(user.password, auth.password):
+    try:
+        valid = passwords.check(user, auth.password)
+    except HashingOverloaded:
+        return _overloaded()
+    if not valid:
         return make_response('Could not verify!', 401, {'WWW-Authenticate' : 'Basic realm="Login Required"'})
 
     #if everything is fine, generate a token and return it
+    #with the refresh token, the client can get new tokens later without sending its password again
     token = generate_token(user)
-    return jsonify({'token': token})
\ No newline at end of file
+    return jsonify({'token': token, 'refresh_token': generate_refresh_token(user)})
+
+
+def _overloaded():
+    resp = jsonify({'message': 'Too many logins at the moment, please try again later.'})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '1'
+    return resp
+
+
+@system.route('/refresh', methods=['POST'])
+def refresh():
+    """
+    Get a new token without a password check: send the refresh token from /login
+    (JSON {'refresh_token': ...} or header 'x-refresh-token'). The response contains a new refresh token as well.
+    """
+    data = request.get_json(silent=True) or {}
+    refresh_token = data.get('refresh_token') or request.headers.get('x-refresh-token')
+    if not refresh_token:
+        return jsonify({'message': 'Refresh token is missing!'}), 401
+
+    user = user_of_refresh_token(refresh_token)
+    if not user:
+        return jsonify({'message': 'Refresh token is invalid!'}), 401
+
+    return jsonify({'token': generate_token(user), 'refresh_token': generate_refresh_token(user)})
+
+
+@system.route('/replicas', methods=['GET'])
+@admin_required
+def replica_status():
+    """
+    Health check of all configured read replicas (reachable, replication lag)
+    """
+    return jsonify({'replicas': replicas.status()})
+
+
+@system.route('/ratelimits', methods=['GET'])
+@admin_required
+def ratelimit_metrics():
+    """
+    Number of requests rejected by the rate limits and concurrency caps since the server started
+    """
+    return jsonify(limiter.status())
+
+
+@system.route('/profiles/<trace_id>', methods=['GET'])
+@admin_required
+def get_profile(trace_id):
+    """
+    Trace of a request sent with the profiling header (its id is in the X-Profile-Id header of the response)
+    """
+    trace = profiler.traces.get(trace_id)
+    if trace is None:
+        return jsonify({'message': 'Trace not found, only the latest traces are kept.'}), 404
+    return jsonify({'profile': trace})
+
+
+@system.route('/slow-requests', methods=['GET'])
+@admin_required
+def get_slow_requests():
+    """
+    The latest requests that took longer than PROFILING_SLOW_THRESHOLD
+    """
+    return jsonify({'slow_requests': profiler.slow_requests()})
+
+
+@system.route('/shards', methods=['GET'])
+@admin_required
+def shard_status():
+    """
+    Sharded ingest: discoveries waiting for the writers and the batches the writers failed to write
+    """
+    if not shards.enabled:
+        return jsonify({'message': 'Sharded ingest is not enabled.'}), 404
+    return jsonify(shards.status())
+
+
+@system.route('/shards/retry', methods=['POST'])
+@admin_required
+def retry_failed_batches():
+    """
+    Hand the batches the writers failed to write over to them again (e.g. after the cause of the error was fixed)
+    """
+    if not shards.enabled:
+        return jsonify({'message': 'Sharded ingest is not enabled.'}), 404
+    n = shards.retry_failed()
+    return jsonify({'message': f'{n} discoveries were queued again.'})
@@ -0,0 +1,212 @@
+from flask import request, jsonify, current_app as app, Blueprint, g
+from sqlalchemy import exc
+from marshmallow import ValidationError
+
+import uuid
+
+from server import db
+from server.archive import archive
+from server.ingest import update_contributions, contribution_of
+from server.writebehind import ap_buffer
+from server.acl import acl
+from server.storage import storage, row_of
+from server.models import AccessPoint, WardrivingMap, Discovery, UploadSession
+from server.endpoints.schemas import discoveries_schema, upload_session_schema
+from server.login import login_required
+
+uploads = Blueprint('uploads', __name__, url_prefix='/uploads')
+
+
+"""
+Resumable and idempotent uploads of discoveries for sniffers with an unreliable connection:
+
+1. POST /uploads {"map_id": ...}                 -> opens a session and returns its id
+2. PUT  /uploads/<session_id>/<n> {"discoveries": [...]}
+   sends chunk number n (0, 1, 2, ...); every discovery should carry a 'client_discovery_id'
+   generated by the sniffer. Chunks which have already been stored are acknowledged again without
+   doing anything, and discoveries which have already been stored (same sniffer and client_discovery_id)
+   are skipped, so retrying is always safe.
+3. GET  /uploads/<session_id>                    -> 'last_chunk' tells where to resume after an interruption
+4. POST /uploads/<session_id>/commit             -> closes the session
+
+NOTE: uploads are always written to the main DB, also if INGEST_MODE is 'sharded'.
+"""
+
+
+def _get_session(session_id):
+    """
+    Returns the upload session or a (response, status) tuple if it can't be used by the current sniffer
+    """
+    session = UploadSession.query.filter_by(public_id=session_id).first_or_404()
+    if session.sniffer_id != g.current_user.id:
+        return None, (jsonify({'message': 'This upload session belongs to another sniffer.'}), 403)
+    return session, None
+
+
+def _check_chunk(session, chunk):
+    """
+    Returns a (response, status) tuple if chunk number <chunk> can't be stored (next), else None
+    """
+    if session.committed:
+        return jsonify({'message': 'This upload session has already been committed.'}), 409
+    #this chunk was stored before, but the acknowledgement got lost
+    if chunk <= session.last_chunk:
+        return jsonify({'message': 'Chunk had already been received.', 'chunk': chunk,
+                        'last_chunk': session.last_chunk}), 200
+    #chunks have to arrive in order, otherwise we could not resume after the last one
+    if chunk != session.last_chunk + 1:
+        return jsonify({'message': f'Expected chunk {session.last_chunk + 1}.',
+                        'last_chunk': session.last_chunk}), 409
+    return None
+
+
+def _store_discoveries(map_id, discoveries):
+    """
+    Add the new discoveries of a chunk to the session (without committing) and update their APs.
+    Returns the number of discoveries that had already been stored before, the new discoveries and those whose
+    APs have to be passed to the write-behind buffer after the commit.
+    """
+    #one query for the whole chunk to find out what we already have
+    client_ids = [d.client_discovery_id for d in discoveries if d.client_discovery_id]
+    known = set()
+    if client_ids:
+        known = {cid for cid, in db.session.query(Discovery.client_discovery_id).filter(
+            Discovery.sniffer_id == g.current_user.id, Discovery.client_discovery_id.in_(client_ids))}
+
+    new = []
+    for d in discoveries:
+        #a chunk could also contain the same discovery twice
+        if d.client_discovery_id in known:
+            continue
+        if d.client_discovery_id:
+            known.add(d.client_discovery_id)
+        new.append(d)
+
+    #load all APs of this chunk at once instead of one query per discovery
+    macs = {d.access_point_mac for d in new}
+    aps = {ap.mac: ap for ap in AccessPoint.query.filter(AccessPoint.mac.in_(macs))} if macs else {}
+    deferred = []
+    for d in new:
+        d.sniffer_id = g.current_user.id
+        d.map_id = map_id
+
+        ap = aps.get(d.access_point_mac)
+        if not ap:
+            ap = aps[d.access_point_mac] = AccessPoint(mac=d.access_point_mac)
+            db.session.add(ap)
+        #only the "last seen" values change: written later (see server/writebehind.py)
+        if ap_buffer.can_defer(ap, d):
+            deferred.append(d)
+        else:
+            ap.update(d)
+        db.session.add(d)
+
+    update_contributions(db.session, [contribution_of(d) for d in new])
+    return len(discoveries) - len(new), new, deferred
+
+
+###############################################ROUTES########################################
+
+@uploads.route('', methods=['POST'])
+@login_required
+def open_session():
+    """
+    Open a new upload session for the map with the given 'map_id'
+    """
+    input = request.get_json(silent=True)
+    if not input or not input.get('map_id'):
+        return jsonify({'message': 'You have to provide a map_id.'}), 400
+    map = WardrivingMap.query.filter_by(id=input['map_id']).first_or_404()
+    #like the map routes, answer as if maps that aren't shared with the user didn't exist
+    if not acl.visibility().can_see(map.id):
+        return jsonify({'message': 'Not found.'}), 404
+
+    session = UploadSession(public_id=str(uuid.uuid4()), sniffer_id=g.current_user.id, map_id=map.id)
+    try:
+        db.session.add(session)
+        db.session.commit()
+    except exc.IntegrityError as e:
+        return jsonify({'message': 'Integrity error occured.'}), 400
+
+    return jsonify({'message': 'Upload session opened.', 'session': upload_session_schema.dump(session)})
+
+
+@uploads.route('/<session_id>', methods=['GET'])
+@login_required
+def get_session(session_id):
+    """
+    State of an upload session, especially the last chunk that has been stored
+    """
+    session, error = _get_session(session_id)
+    if error:
+        return error
+    return jsonify({'session': upload_session_schema.dump(session)})
+
+
+@uploads.route('/<session_id>/<int:chunk>', methods=['PUT'])
+@login_required
+def upload_chunk(session_id, chunk):
+    """
+    Store chunk number <chunk> of this upload session
+    """
+    session, error = _get_session(session_id)
+    if error:
+        return error
+    error = _check_chunk(session, chunk)
+    if error:
+        return error
+
+    input = request.get_json(silent=True)
+    if not input or not isinstance(input.get('discoveries'), list):
+        return jsonify({'message': 'You have to provide a list of discoveries.'}), 400
+    try:
+        discoveries = discoveries_schema.load(input['discoveries'])
+    except ValidationError as e:
+        return jsonify(e.messages), 400
+
+    if not archive.ensure_writable(WardrivingMap.query.get(session.map_id)):
+        return jsonify({'message': 'Map has been finalized, reactivate it to add discoveries.'}), 409
+
+    table = UploadSession.__table__
+    try:
+        #claim the chunk first: if the same chunk is sent twice at the same time, only one request gets past this
+        #(the other one waits for the row lock and then doesn't find last_chunk = chunk - 1 anymore)
+        claimed = db.session.execute(table.update().where(
+            table.c.id == session.id, table.c.last_chunk == chunk - 1, table.c.committed == False).values(
+            last_chunk=chunk)).rowcount
+        if not claimed:
+            db.session.rollback()
+            return _check_chunk(session, chunk) or (jsonify({'message': 'Please resend this chunk.'}), 409)
+
+        duplicates, new, deferred = _store_discoveries(session.map_id, discoveries)
+        db.session.execute(table.update().where(table.c.id == session.id).values(
+            n_discoveries=table.c.n_discoveries + len(discoveries) - duplicates,
+            n_duplicates=table.c.n_duplicates + duplicates))
+        #the discoveries and the new state of the session are stored atomically
+        db.session.commit()
+    except exc.IntegrityError as e:
+        #e.g. the same chunk was sent twice at the same time
+        db.session.rollback()
+        return jsonify({'message': 'Integrity error occured, please resend this chunk.'}), 409
+    for d in deferred:
+        ap_buffer.submit(d)
+    storage.add([row_of(d) for d in new])
+
+    return jsonify({'message': 'Chunk stored.', 'chunk': chunk, 'last_chunk': session.last_chunk,
+                    'added': len(discoveries) - duplicates, 'duplicates': duplicates})
+
+
+@uploads.route('/<session_id>/commit', methods=['POST'])
+@login_required
+def commit_session(session_id):
+    """
+    Finish the upload session; committing it again is harmless
+    """
+    session, error = _get_session(session_id)
+    if error:
+        return error
+
+    session.committed = True
+    db.session.commit()
+
+    return jsonify({'message': 'Upload session committed.', 'session': upload_session_schema.dump(session)})
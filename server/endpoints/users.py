@@ -1,12 +1,15 @@
 from flask import request, jsonify, current_app as app, Blueprint, g
-from werkzeug.security import generate_password_hash 
 from sqlalchemy import exc
 from marshmallow import ValidationError
 
 from server import db
-from server.models import User, Sniffer
+from server.models import User, Sniffer, Discovery
 from server.login import admin_required, login_required
-from server.endpoints.api_definition import user_schema, users_schema, sniffer_schema, sniffers_schema
+from server.endpoints.schemas import user_schema, users_schema, sniffer_schema, sniffers_schema, sniffer_discoveries_schema
+from server.sharding import shards
+from server.archive import archive
+from server.acl import acl
+from server.passwords import passwords, HashingOverloaded
 
 import uuid
 
@@ -65,7 +68,19 @@ def get_sniffer(id):
     Get one specific sniffer
     """
     sniffer = Sniffer.query.filter_by(id=id).first_or_404()
-    return jsonify({'sniffer': sniffer_schema.dump(sniffer)})
+
+    output = sniffer_schema.dump(sniffer)
+    #the discoveries in shards and in the archives of finalized maps
+    other = shards.discoveries(sniffer_id=sniffer.id) + archive.discoveries(sniffer_id=sniffer.id)
+    output['discoveries'] += sniffer_discoveries_schema.dump(other)
+    visibility = acl.visibility()
+    if not visibility.unrestricted:
+        #only the maps and discoveries the current user may see (see server/acl.py)
+        output['maps'] = [m for m in output['maps'] if visibility.can_see(m['id'])]
+        discoveries = Discovery.query.filter(Discovery.sniffer_id == sniffer.id, visibility.discovery_filter()).all()
+        discoveries += [d for d in other if visibility.contains(d.map_id, d.gps_lat, d.gps_lon)]
+        output['discoveries'] = sniffer_discoveries_schema.dump(discoveries)
+    return jsonify({'sniffer': output})
 
 
 @users.route('', methods=['POST'])
@@ -80,7 +95,10 @@ def create_sniffer():
         return jsonify(e.messages), 400
 
     #create a password hash and store this as the user's password in the DB
-    hashed_password = generate_password_hash(sniffer.password, method='sha256')
+    try:
+        hashed_password = passwords.generate(sniffer.password)
+    except HashingOverloaded:
+        return jsonify({'message': 'Server is busy, please try again later.'}), 503
     sniffer.password = hashed_password
 
     sniffer.public_id=str(uuid.uuid4())
@@ -107,7 +125,10 @@ def change_user_password(public_id):
     except ValidationError as e:
        return jsonify(e.messages), 400 
 
-    hashed_password = generate_password_hash(user.password, method='sha256')
+    try:
+        hashed_password = passwords.generate(user.password)
+    except HashingOverloaded:
+        return jsonify({'message': 'Server is busy, please try again later.'}), 503
     user.password = hashed_password
 
     db.session.add(user)
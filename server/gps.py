@@ -52,6 +52,110 @@ def distance_accurate(p1, p2):
     return EARTH_RADIUS * angle
 
 
+def distance_accurate_many(p, lats, lons):
+    """
+    'distance_accurate' between p and many points at once [km]
+    lats, lons: numpy arrays in degrees
+    """
+    import numpy as np
+
+    lat_rad = np.asarray(lats, dtype=np.float64) * degree_rad_const
+    lon_rad = np.asarray(lons, dtype=np.float64) * degree_rad_const
+    cos_angle = np.sin(p.lat_rad)*np.sin(lat_rad) + np.cos(p.lat_rad)*np.cos(lat_rad)*np.cos(lon_rad-p.lon_rad)
+    #rounding errors can push the value slightly out of [-1, 1] for (almost) identical points
+    return EARTH_RADIUS * np.arccos(np.clip(cos_angle, -1, 1))
+
+
+def distance_simple_pairs(lats1, lons1, lats2, lons2):
+    """
+    'distance_simple' between the points of two arrays, element by element [km]
+    (e.g. to compare many pairs of nearby APs at once)
+    """
+    import numpy as np
+
+    lats1, lons1 = np.asarray(lats1, dtype=np.float64), np.asarray(lons1, dtype=np.float64)
+    lats2, lons2 = np.asarray(lats2, dtype=np.float64), np.asarray(lons2, dtype=np.float64)
+    dy = 111.3 * (lats1 - lats2)
+    dx = 111.3 * np.cos((lats1 + lats2) / 2 * degree_rad_const) * (lons1 - lons2)
+    return np.sqrt(dx**2 + dy**2)
+
+
+def bounding_box(p, radius):
+    """
+    (lat_min, lon_min, lat_max, lon_max) of a box containing all points within radius [km] around p.
+    lon_min/lon_max are None if the box covers all longitudes (near the poles or across the antimeridian).
+    """
+    #with some margin, since the distance functions use slightly different constants
+    dlat = radius / 111.0 * 1.01
+    lat_min, lat_max = max(p.lat - dlat, -90), min(p.lat + dlat, 90)
+    if lat_min <= -90 or lat_max >= 90:
+        return lat_min, None, lat_max, None
+    #degrees of longitude get shorter towards the poles, so the widest part of the box is the one closest to a pole
+    dlon = radius / (111.0 * math.cos(max(abs(lat_min), abs(lat_max)) * math.pi / 180)) * 1.01
+    if p.lon - dlon < -180 or p.lon + dlon > 180:
+        return lat_min, None, lat_max, None
+    return lat_min, p.lon - dlon, lat_max, p.lon + dlon
+
+
+def distance_to_segment(p, a, b):
+    """
+    Shortest distance [km] between p and the line segment from a to b.
+    Uses the same flat approximation as 'distance_simple', so only use it for short segments (e.g. of a GPS track)
+    """
+    lat = (a.lat + b.lat) / 2 * degree_rad_const
+    #project everything onto a plane [km] with a in its origin
+    bx, by = 111.3 * math.cos(lat) * (b.lon - a.lon), 111.3 * (b.lat - a.lat)
+    px, py = 111.3 * math.cos(lat) * (p.lon - a.lon), 111.3 * (p.lat - a.lat)
+
+    length = bx**2 + by**2
+    #position of the closest point on the segment (0 = a, 1 = b)
+    t = 0 if length == 0 else max(0, min(1, (px*bx + py*by) / length))
+    return math.sqrt((px - t*bx)**2 + (py - t*by)**2)
+
+
+def douglas_peucker(lat, lon):
+    """
+    Douglas-Peucker simplification of a track for all tolerances at once:
+    returns the 'significance' [km] of every point, i.e. the point is part of the track simplified with
+    tolerance t if and only if its significance is >= t (the end points are always part of it: inf).
+    lat, lon: numpy arrays in degrees
+    Distances are computed like 'distance_to_segment', but vectorized with numpy.
+    """
+    import numpy as np
+
+    n = len(lat)
+    significance = np.zeros(n)
+    if n == 0:
+        return significance
+    significance[0] = significance[-1] = np.inf
+
+    #flat projection [km] around the mean latitude of the track
+    x = 111.3 * np.cos(np.mean(lat) * degree_rad_const) * np.asarray(lon, dtype=np.float64)
+    y = 111.3 * np.asarray(lat, dtype=np.float64)
+
+    #(first, last, significance of the point that split this part off); no recursion, tracks can be long
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+        bx, by = x[last] - x[first], y[last] - y[first]
+        px, py = x[first+1:last] - x[first], y[first+1:last] - y[first]
+        length = bx**2 + by**2
+        t = np.zeros(len(px)) if length == 0 else np.clip((px*bx + py*by) / length, 0, 1)
+        distances = np.hypot(px - t*bx, py - t*by)
+
+        split = int(np.argmax(distances))
+        #a point can't be more significant than the one that caused its part to be examined at all,
+        #otherwise filtering by significance would not be the same as running Douglas-Peucker
+        level = min(distances[split], parent)
+        split += first + 1
+        significance[split] = level
+        stack.append((first, split, level))
+        stack.append((split, last, level))
+    return significance
+
+
 #good explanation: https://www.kompf.de/gps/distcalc.html
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+import struct
+import zlib
+
+import numpy as np
+
+
+"""
+Rasterization of discoveries into signal strength (RSSI) heatmaps.
+All computations are vectorized with numpy, so even maps with millions of discoveries
+can be rasterized within one request.
+"""
+
+#RSSI range [dBm] that is mapped onto the color ramp of the PNG output
+RSSI_MIN = -100
+RSSI_MAX = -30
+
+#value of empty cells in the compact (int8) array output
+NODATA = -128
+
+#color ramp from weak (blue) over green and yellow to strong (red) signals
+_RAMP = np.array([[0, 0, 255], [0, 255, 255], [0, 255, 0], [255, 255, 0], [255, 0, 0]], dtype=np.float64)
+
+
+def rasterize(lat, lon, rssi, bbox, width, height, agg='max'):
+    """
+    Bin the points into a grid of height x width cells covering bbox and aggregate their RSSI per cell.
+    lat, lon, rssi: 1-D numpy arrays of the same length
+    bbox: (lat_min, lon_min, lat_max, lon_max)
+    agg: 'max' or 'mean'
+    Returns a float array (row 0 is the northern edge) with NaN for cells without any discovery.
+    """
+    lat_min, lon_min, lat_max, lon_max = bbox
+    grid = np.full(width * height, np.nan)
+
+    inside = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+    lat, lon, rssi = lat[inside], lon[inside], rssi[inside].astype(np.float64)
+    if not len(rssi):
+        return grid.reshape(height, width)
+
+    #points on the upper edges of the bbox belong to the last cell
+    col = np.minimum(((lon - lon_min) / max(lon_max - lon_min, 1e-12) * width).astype(np.int64), width - 1)
+    row = np.minimum(((lat_max - lat) / max(lat_max - lat_min, 1e-12) * height).astype(np.int64), height - 1)
+    cell = row * width + col
+
+    if agg == 'mean':
+        counts = np.bincount(cell, minlength=width * height)
+        sums = np.bincount(cell, weights=rssi, minlength=width * height)
+        seen = counts > 0
+        grid[seen] = sums[seen] / counts[seen]
+    else:
+        values = np.full(width * height, -np.inf)
+        np.maximum.at(values, cell, rssi)
+        seen = values > -np.inf
+        grid[seen] = values[seen]
+
+    return grid.reshape(height, width)
+
+
+def to_int8(grid):
+    """
+    Compact representation: RSSI rounded to whole dBm as int8, NODATA for empty cells
+    """
+    out = np.full(grid.shape, NODATA, dtype=np.int8)
+    seen = ~np.isnan(grid)
+    out[seen] = np.clip(np.round(grid[seen]), NODATA + 1, 127)
+    return out
+
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def to_png(grid):
+    """
+    Render the grid as RGBA PNG (empty cells are transparent). Implemented by hand, so we don't need Pillow.
+    """
+    height, width = grid.shape
+    seen = ~np.isnan(grid)
+
+    #position of every cell on the color ramp, then linear interpolation between the two neighbouring colors
+    t = np.clip((np.nan_to_num(grid, nan=RSSI_MIN) - RSSI_MIN) / (RSSI_MAX - RSSI_MIN), 0, 1) * (len(_RAMP) - 1)
+    lower = np.minimum(t.astype(np.int64), len(_RAMP) - 2)
+    frac = (t - lower)[..., None]
+    rgb = _RAMP[lower] * (1 - frac) + _RAMP[lower + 1] * frac
+
+    rgba = np.zeros((height, width, 4), dtype=np.uint8)
+    rgba[..., :3] = rgb.astype(np.uint8)
+    rgba[..., 3] = np.where(seen, 200, 0)
+
+    #every scanline starts with the filter type (0 = none)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header)
+            + _png_chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + _png_chunk(b'IEND', b''))
@@ -0,0 +1,257 @@
+from datetime import datetime
+
+from sqlalchemy import select, bindparam, exc, and_, or_, case
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.orm import Session, scoped_session
+
+from server.oui import oui_of
+from server.search import trigrams
+
+
+"""
+Batched ingest helpers that work directly on the tables (SQLAlchemy core) instead of ORM objects.
+They do the same as AccessPoint.update() does for a single discovery, but for many discoveries at once,
+and are used where discoveries arrive in bulk (sharded writer processes, bulk import).
+store_discovery() is the ingest of a single discovery, shared by the Flask route and the ASGI route of POST /maps/<id>.
+"""
+
+#results of store_discovery()
+ADDED, DUPLICATE, QUEUED, BUSY, CONFLICT = 'added', 'duplicate', 'queued', 'busy', 'conflict'
+#result -> (message, status) of the response
+RESPONSES = {
+    ADDED: ('New discovery was added.', 200),
+    DUPLICATE: ('Discovery had already been added.', 200),
+    #accepted, but not written yet (see the durability notes in server/sharding.py)
+    QUEUED: ('New discovery was queued and will be added shortly.', 202),
+    BUSY: ('Too many discoveries are waiting to be written, please try again later.', 503),
+    CONFLICT: ('Integrity error occured when adding discovery.', 400),
+}
+
+
+def _connection(conn):
+    #the connection of a session, so the statements run in its transaction
+    return conn.connection() if isinstance(conn, (Session, scoped_session)) else conn
+
+
+def insert_ignore(conn, table, rows):
+    """
+    Insert the rows into the table, skipping those whose primary key already exists. Unlike catching the
+    IntegrityError, this doesn't abort the transaction, and nothing has to be loaded to check it before.
+    conn: connection or session
+    """
+    conn = _connection(conn)
+    if not rows:
+        return
+
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        stmt = sqlite.insert(table).on_conflict_do_nothing()
+    elif dialect == 'postgresql':
+        stmt = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'mysql':
+        stmt = table.insert().prefix_with('IGNORE')
+    else:
+        #other DBs: look the rows up first
+        keys = list(table.primary_key.columns)
+        rows = [row for row in rows if conn.execute(
+            select(keys[0]).where(and_(*[c == row[c.name] for c in keys]))).first() is None]
+        if not rows:
+            return
+        stmt = table.insert()
+    conn.execute(stmt, rows)
+
+
+def update_contributions(conn, batch):
+    """
+    Add the discoveries of this batch to the contribution counters of their sniffers (MapContribution)
+    and register the sniffers as contributors of the maps. Everything is written in the transaction of conn
+    (connection or session), so the counters are stored together with the discoveries.
+    batch: dicts with map_id, sniffer_id, access_point_mac and timestamp (datetime or ISO 8601 string)
+    """
+    from server.models import MapContribution, ContributedAP, Sniffer, participate_in
+    conn = _connection(conn)
+    table = MapContribution.__table__
+    ap_table = ContributedAP.__table__
+
+    #(map id, sniffer id) -> [discoveries, macs, first seen, last seen]
+    totals = {}
+    for d in batch:
+        if d.get('map_id') is None or d.get('sniffer_id') is None:
+            continue
+        t = d['timestamp']
+        t = datetime.fromisoformat(t) if isinstance(t, str) else t
+        total = totals.setdefault((d['map_id'], d['sniffer_id']), [0, set(), t, t])
+        total[0] += 1
+        total[1].add(d['access_point_mac'])
+        total[2], total[3] = min(total[2], t), max(total[3], t)
+
+    #discoveries can also be added by (admin) users, which are not sniffers
+    sniffer_ids = {sniffer_id for _, sniffer_id in totals}
+    if sniffer_ids:
+        sniffer_ids = {id for id, in conn.execute(select(Sniffer.__table__.c.id).where(Sniffer.__table__.c.id.in_(sniffer_ids)))}
+    totals = {key: total for key, total in totals.items() if key[1] in sniffer_ids}
+    if not totals:
+        return
+
+    keys = [{'map_id': map_id, 'sniffer_id': sniffer_id} for map_id, sniffer_id in totals]
+    insert_ignore(conn, participate_in, keys)
+    insert_ignore(conn, table, [dict(key, discoveries=0, aps=0) for key in keys])
+
+    for (map_id, sniffer_id), (n, macs, first, last) in totals.items():
+        #only the APs this sniffer hasn't found on this map before are new
+        known = {mac for mac, in conn.execute(select(ap_table.c.mac).where(
+            ap_table.c.map_id == map_id, ap_table.c.sniffer_id == sniffer_id, ap_table.c.mac.in_(macs)))}
+        new = macs - known
+        insert_ignore(conn, ap_table, [{'map_id': map_id, 'sniffer_id': sniffer_id, 'mac': mac} for mac in new])
+
+        #relative updates, so concurrent requests of the same sniffer don't overwrite each other's counts
+        conn.execute(table.update().where(table.c.map_id == map_id, table.c.sniffer_id == sniffer_id).values(
+            discoveries=table.c.discoveries + n,
+            aps=table.c.aps + len(new),
+            first_seen=case((or_(table.c.first_seen.is_(None), table.c.first_seen > first), first), else_=table.c.first_seen),
+            last_seen=case((or_(table.c.last_seen.is_(None), table.c.last_seen < last), last), else_=table.c.last_seen)))
+
+
+def contribution_of(discovery):
+    """
+    The values of a Discovery object needed by update_contributions()
+    """
+    return {'map_id': discovery.map_id, 'sniffer_id': discovery.sniffer_id,
+            'access_point_mac': discovery.access_point_mac, 'timestamp': discovery.timestamp}
+
+
+def update_access_points(engine, batch):
+    """
+    Apply the discoveries of this batch to the global AP directory, the SSID search index and the
+    change log of the APs (one transaction per batch instead of one per discovery).
+    batch: dicts with the keys of SHARD_COLUMNS in server/sharding.py (timestamp as ISO 8601 string)
+    """
+    from server.models import AccessPoint, SSIDTrigram, APChange
+    table = AccessPoint.__table__
+    trigram_table = SSIDTrigram.__table__
+    change_table = APChange.__table__
+    tracked = [(APChange.SSID, 'last_ssid'), (APChange.ENCRYPTION, 'last_encryption'), (APChange.CHANNEL, 'last_channel')]
+
+    macs = list({d['access_point_mac'] for d in batch})
+    update = table.update().where(table.c.mac == bindparam('b_mac'))
+    #another writer might insert the same new AP concurrently, so retry once as an update
+    for attempt in range(2):
+        try:
+            with engine.begin() as conn:
+                existing = {row.mac: dict(row._mapping) for row in conn.execute(
+                    select(table.c.mac, table.c.last_ssid, table.c.last_encryption, table.c.last_channel,
+                           table.c.t_last_seen).where(table.c.mac.in_(macs)))}
+
+                #go through the batch in the order of the timestamps: later discoveries overwrite earlier ones
+                #(like AccessPoint.update()), and every change in between ends up in the change log
+                rows, changes = {}, []
+                for d in sorted(batch, key=lambda d: datetime.fromisoformat(d['timestamp'])):
+                    mac = d['access_point_mac']
+                    values = {'last_ssid': d['ssid'],
+                              't_last_seen': datetime.fromisoformat(d['timestamp']),
+                              'last_encryption': d['encryption'],
+                              'last_channel': d['channel'],
+                              'gps_lat': d['gps_lat'],
+                              'gps_lon': d['gps_lon']}
+                    old = rows.get(mac) or existing.get(mac)
+                    #discoveries older than the AP's state (uploaded late) don't change it, see AccessPoint.update()
+                    if old and old['t_last_seen'] is not None and values['t_last_seen'] < old['t_last_seen']:
+                        continue
+                    if old:
+                        changes += [{'mac': mac, 'attribute': attribute, 'old_value': APChange._str(old[column]),
+                                     'new_value': APChange._str(values[column]), 'timestamp': values['t_last_seen'],
+                                     'map_id': d['map_id']}
+                                    for attribute, column in tracked if old[column] != values[column]]
+                    rows[mac] = values
+
+                inserts = [dict(values, mac=mac, oui=oui_of(mac)) for mac, values in rows.items() if mac not in existing]
+                updates = [dict(values, b_mac=mac) for mac, values in rows.items() if mac in existing]
+                if inserts:
+                    conn.execute(table.insert(), inserts)
+                if updates:
+                    conn.execute(update, updates)
+                if changes:
+                    conn.execute(change_table.insert(), changes)
+
+                #keep the SSID search index in sync (like AccessPoint.index_ssid() does)
+                renamed = [mac for mac, values in rows.items()
+                           if values['last_ssid'] != existing.get(mac, {}).get('last_ssid')]
+                if renamed:
+                    conn.execute(trigram_table.delete().where(trigram_table.c.mac.in_(renamed)))
+                    trigram_rows = [{'mac': mac, 'trigram': t} for mac in renamed for t in trigrams(rows[mac]['last_ssid'])]
+                    if trigram_rows:
+                        conn.execute(trigram_table.insert(), trigram_rows)
+            return
+        except exc.IntegrityError:
+            if attempt:
+                raise
+
+
+def _is_duplicate(session, map_id, discovery, sniffer_id):
+    #the same sniffer and client_discovery_id in the DB or in the shard of the map (the writer skips the
+    #duplicates that are queued at the same time, see server/sharding.py)
+    from server.models import Discovery
+    from server.sharding import shards
+
+    if not discovery.client_discovery_id:
+        return False
+    if session.execute(select(Discovery.id).filter_by(
+            sniffer_id=sniffer_id, client_discovery_id=discovery.client_discovery_id)).first():
+        return True
+    return bool(shards.rows(['id'], map_id, sniffer_id=sniffer_id, client_discovery_id=discovery.client_discovery_id))
+
+
+def store_discovery(session, map_id, discovery, sniffer_id):
+    """
+    Add a (validated, not yet persisted) Discovery object to the map and update or create its AP, or hand it over
+    to the writer process of the map in sharded mode. The caller has to make sure the map is writable
+    (archive.ensure_writable()).
+    session: sync session which is committed here, i.e. db.session or the session of AsyncSession.run_sync()
+    Returns one of the results above, see RESPONSES.
+    """
+    import queue
+    from server.models import AccessPoint
+    from server.sharding import shards
+    from server.writebehind import ap_buffer
+    from server.storage import storage, row_of
+
+    if shards.enabled:
+        #without gunicorn, the first discovery starts the writers (which also update the shards of an older version)
+        shards.start()
+    #if the sniffer sent an id for this discovery, a retry of an earlier request does not add it again
+    if _is_duplicate(session, map_id, discovery, sniffer_id):
+        return DUPLICATE
+
+    #in sharded mode, the writer process owning this map persists the discovery and updates the AP
+    if shards.enabled:
+        try:
+            shards.submit(map_id, discovery, sniffer_id)
+        except queue.Full:
+            return BUSY
+        return QUEUED
+
+    discovery.map_id = map_id
+    discovery.sniffer_id = sniffer_id
+    ap = session.get(AccessPoint, discovery.access_point_mac)
+    if not ap:
+        ap = AccessPoint(mac=discovery.access_point_mac)
+        session.add(ap)
+    #if only the "last seen" values of the AP change, they are written later together with those of other
+    #discoveries (see server/writebehind.py)
+    deferred = ap_buffer.can_defer(ap, discovery)
+    if not deferred:
+        ap.update(discovery)
+    session.add(discovery)
+    try:
+        update_contributions(session, [contribution_of(discovery)])
+        session.commit()
+    except exc.IntegrityError:
+        session.rollback()
+        #a retry which arrived at the same time as the first request, the other one has added the discovery
+        if _is_duplicate(session, map_id, discovery, sniffer_id):
+            return DUPLICATE
+        return CONFLICT
+    if deferred:
+        ap_buffer.submit(discovery)
+    storage.add([row_of(discovery)])
+    return ADDED
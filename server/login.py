@@ -1,9 +1,11 @@
 from flask import jsonify, g, request, Blueprint, current_app as app
 
 from server.models import User
+from server.profiling import profiler
 
 import jwt
 import datetime
+import hashlib
 from functools import wraps
 
 
@@ -23,15 +25,55 @@ def load_token():
 
 
 #when a new client should be registered, you want to generate a new token
-def generate_token(user, valid_duration=24):
+def generate_token(user, valid_duration=None):
     """
     this function will generate a JWT token
     valid_duration: hours in which the token will expire
     """
-    token = jwt.encode({'public_id': user.public_id, 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)}, app.config['SECRET_KEY'], algorithm="HS256")
+    valid_duration = valid_duration or app.config['TOKEN_VALID_HOURS']
+    token = jwt.encode({'public_id': user.public_id, 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=valid_duration)}, app.config['SECRET_KEY'], algorithm="HS256")
     return token
 
 
+def _password_fingerprint(user):
+    #changes whenever the password is changed
+    return hashlib.sha256(user.password.encode()).hexdigest()[:16]
+
+
+def generate_refresh_token(user):
+    """
+    Long-lived token which can only be used to get new (access) tokens at /refresh, without sending the password.
+    It becomes invalid as soon as the user's password is changed.
+    """
+    return jwt.encode({'public_id': user.public_id, 'type': 'refresh', 'pwd': _password_fingerprint(user),
+                       'exp': datetime.datetime.utcnow() + datetime.timedelta(days=app.config['REFRESH_TOKEN_VALID_DAYS'])},
+                      app.config['SECRET_KEY'], algorithm="HS256")
+
+
+def user_of_refresh_token(token):
+    """
+    Returns the user of a valid refresh token or None
+    """
+    try:
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    except jwt.PyJWTError:
+        return None
+    if data.get('type') != 'refresh':
+        return None
+    user = User.query.filter_by(public_id=data.get('public_id')).first()
+    if not user or data.get('pwd') != _password_fingerprint(user):
+        return None
+    return user
+
+
+def _decode_access_token(token):
+    data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    #refresh tokens can't be used to access the API
+    if data.get('type', 'access') != 'access':
+        raise jwt.InvalidTokenError()
+    return data
+
+
 ################################## decorators that can be used for routes ###########################
 
 def login_required(f):
@@ -47,17 +89,19 @@ def login_required(f):
             return jsonify({'message': 'Token is missing!'}), 401
 
         try:
-            data = jwt.decode(g.token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            g.current_user = User.query.filter_by(public_id=data['public_id']).first()
+            with profiler.phase('auth'):
+                data = _decode_access_token(g.token)
+                g.current_user = User.query.filter_by(public_id=data['public_id']).first()
 
             if not g.current_user:
                 raise Exception()
         except:
             return jsonify({'message': 'Token is invalid!'}), 401
+        profiler.authorize(g.current_user)
 
         #every function that gets decorated with 'login_required' will need a user object
         #as its first parameter
-        return f(*args, **kwargs)
+        return profiler.call(f, *args, **kwargs)
 
     return decorated
 
@@ -75,8 +119,9 @@ def admin_required(f):
             return jsonify({'message': 'Token is missing!'}), 401
 
         try:
-            data = jwt.decode(g.token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            g.current_user = User.query.filter_by(public_id=data['public_id']).first()
+            with profiler.phase('auth'):
+                data = _decode_access_token(g.token)
+                g.current_user = User.query.filter_by(public_id=data['public_id']).first()
             
             if not g.current_user:
                 raise Exception()
@@ -86,9 +131,10 @@ def admin_required(f):
         #after this, you can access the current_user object
         if not g.current_user.admin:
             return jsonify({'message': 'You don\'t have the permission to do that!'}), 403
+        profiler.authorize(g.current_user)
 
         #every function that gets decorated with 'login_required' will need a user object
         #as its first parameter
-        return f(*args, **kwargs)
+        return profiler.call(f, *args, **kwargs)
 
     return decorated
\ No newline at end of file
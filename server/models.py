@@ -1,5 +1,9 @@
+import bisect
 from datetime import datetime
 from server import db
+from server.oui import oui_of
+from server.search import trigrams
+from server import gps, polyline
 
 
 """
@@ -47,6 +51,8 @@ class Encryption():
 
 class AccessPoint(db.Model):
     __tablename__ = 'access_point'
+    #proximity queries (/aps/near) first select the APs within a bounding box using this index
+    __table_args__ = (db.Index('ix_access_point_lat_lon', 'gps_lat', 'gps_lon'),)
 
     #Of course, it of makes sense to use the MAC address as the primary key.
     #But for better performance, we don't want to store it as a string but rather
@@ -54,6 +60,10 @@ class AccessPoint(db.Model):
     #e.g. 00-80-41-ae-fd-7e -> 0x008041AEFD7E and convert this hex number to decimal
     mac = db.Column(db.Integer, primary_key=True)
 
+    #derived from the mac (mac >> 24): identifies the vendor of this AP (see server/oui.py)
+    #stored separately so that we can filter and group by vendor using an index
+    oui = db.Column(db.Integer, index=True)
+
     #a SSID has a max length of 32 characters, but we intentionally drop that constraint
     #to be open for changes
     last_ssid = db.Column(db.String(64))
@@ -77,6 +87,20 @@ class AccessPoint(db.Model):
     #attributes of this AP which were added at runtime by a user
     attributes = db.relationship('AP_EAV', back_populates='access_point')
 
+    #history of the tracked attributes (append-only, see APChange)
+    changes = db.relationship('APChange', lazy='dynamic', cascade='all, delete-orphan')
+
+    #search index over last_ssid (see server/search.py)
+    ssid_trigrams = db.relationship('SSIDTrigram', cascade='all, delete-orphan')
+
+    def index_ssid(self):
+        """
+        Bring the search index of this AP up to date with last_ssid
+        """
+        #keep the rows of trigrams that are still part of the SSID instead of deleting and re-inserting them
+        existing = {t.trigram: t for t in self.ssid_trigrams}
+        self.ssid_trigrams = [existing.get(t) or SSIDTrigram(trigram=t) for t in trigrams(self.last_ssid)]
+
     def update(self, discovery):
         """
         Update all the values of the AP with the new information of this discovery.
@@ -86,8 +110,28 @@ class AccessPoint(db.Model):
         #WARNING: don't try to add the discovery to the list of this AP's discoveries here since it 
         #will complicate things unneccessarily
 
+        if self.oui is None:
+            self.oui = oui_of(self.mac)
+        #an older discovery (e.g. uploaded late by a sniffer that was offline) doesn't tell the current state of the AP,
+        #it would only show up as two changes in the log (to the old value and back) which never happened
+        if self.t_last_seen is not None and discovery.timestamp < self.t_last_seen:
+            return
+
+        #record every change of a tracked attribute (but not the initial values of a new AP)
+        if self.t_last_seen is not None:
+            for attribute, old, new in ((APChange.SSID, self.last_ssid, discovery.ssid),
+                                        (APChange.ENCRYPTION, self.last_encryption, discovery.encryption),
+                                        (APChange.CHANNEL, self.last_channel, discovery.channel)):
+                if old != new:
+                    #lazy='dynamic': appending does not load the existing history
+                    self.changes.append(APChange.create(attribute, old, new, discovery))
+
         #update values
+        #the search index only has to be touched if the SSID really changed
+        ssid_changed = discovery.ssid != self.last_ssid
         self.last_ssid = discovery.ssid
+        if ssid_changed:
+            self.index_ssid()
         self.t_last_seen = discovery.timestamp
         self.last_encryption = discovery.encryption
         self.last_channel = discovery.channel
@@ -97,6 +141,55 @@ class AccessPoint(db.Model):
         self.gps_lon = discovery.gps_lon
 
 
+class APChange(db.Model):
+    """
+    Append-only log of the changes of an AP's tracked attributes (SSID, encryption, channel), written during ingest.
+    Answers questions like 'when did this AP switch from WEP to WPA2' without going through all discoveries.
+    """
+    __tablename__ = 'ap_change'
+    __table_args__ = (
+        db.Index('ix_ap_change_mac_timestamp', 'mac', 'timestamp'),
+        db.Index('ix_ap_change_map_timestamp', 'map_id', 'timestamp'),
+    )
+
+    #names of the tracked attributes
+    SSID = 'ssid'
+    ENCRYPTION = 'encryption'
+    CHANNEL = 'channel'
+
+    id = db.Column(db.Integer, primary_key=True)
+    mac = db.Column(db.Integer, db.ForeignKey('access_point.mac', ondelete='CASCADE'), nullable=False)
+    attribute = db.Column(db.String(32), nullable=False)
+    #values are stored as strings (encryption and channel are the numbers as used in the discoveries)
+    old_value = db.Column(db.String(64))
+    new_value = db.Column(db.String(64))
+
+    #timestamp of the discovery which revealed the change
+    timestamp = db.Column(db.DateTime, nullable=False)
+    #the map on which the change was seen (if known)
+    map_id = db.Column(db.Integer, db.ForeignKey('wardriving_map.id', ondelete='CASCADE'), nullable=True)
+
+    @staticmethod
+    def _str(value):
+        return None if value is None else str(value)
+
+    @classmethod
+    def create(cls, attribute, old, new, discovery):
+        return cls(attribute=attribute, old_value=cls._str(old), new_value=cls._str(new),
+                   timestamp=discovery.timestamp, map_id=discovery.map_id)
+
+
+class SSIDTrigram(db.Model):
+    """
+    Search index over the SSIDs of all APs: one row per trigram of the SSID of an AP.
+    The primary key (trigram, mac) is used to find all APs with a certain trigram.
+    """
+    __tablename__ = 'ssid_trigram'
+
+    trigram = db.Column(db.String(3), primary_key=True)
+    mac = db.Column(db.Integer, db.ForeignKey('access_point.mac', ondelete='CASCADE'), primary_key=True, index=True)
+
+
 class AP_EAV(db.Model):
     """
     Used to add attributes to access points dynamiccaly during runtime without 
@@ -123,6 +216,12 @@ class AP_EAV(db.Model):
 #an AP can be discovered by multiple sniffers - we want to keep track of all occurances 
 class Discovery(db.Model):
     __tablename__ = 'discovery'
+    #a sniffer can't send the same discovery twice (e.g. when retrying an interrupted upload)
+    __table_args__ = (
+        db.UniqueConstraint('sniffer_id', 'client_discovery_id', name='uq_discovery_client_id'),
+        #most reads are per map; with the id it also covers count() and max(id) of the cache version of a map
+        db.Index('ix_discovery_map_id', 'map_id', 'id'),
+    )
 
     #discovery should be a weak entity type, so the existance of its entities depends on 
     #the existance of the corresponding AP entities 
@@ -146,6 +245,9 @@ class Discovery(db.Model):
     gps_lat = db.Column(db.Float, nullable=False)
     gps_lon = db.Column(db.Float, nullable=False)
     
+    #id the sniffer generated for this discovery (optional), used as idempotency key
+    client_discovery_id = db.Column(db.String(64), nullable=True)
+
     #the sniffer which made this discovery
     sniffer_id = db.Column(db.Integer, db.ForeignKey('sniffer.id'), nullable=False)
     sniffer = db.relationship('Sniffer', back_populates='discoveries')
@@ -183,6 +285,9 @@ class WardrivingMap(db.Model):
 
     date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    #finalized map: the discoveries are stored in its archive (see server/archive.py) instead of the discovery table
+    archived = db.Column(db.Boolean, nullable=False, default=False)
+
     #sniffers that contributed to this map
     sniffers = db.relationship('Sniffer', secondary=participate_in, back_populates='maps')
 
@@ -195,9 +300,263 @@ class WardrivingMap(db.Model):
     #further generic attributes
     attributes = db.relationship('Map_StringEAV', back_populates='map')
 
+    #routes the sniffers drove
+    tracks = db.relationship('Track', back_populates='map', cascade="all, delete")
+
     def __repr__(self):
         return f"Map('{self.id}', '{self.title}')"
 
+class MapContribution(db.Model):
+    """
+    Running totals of what a sniffer contributed to a map. They are updated whenever discoveries are stored
+    (see update_contributions() in server/ingest.py), so leaderboards don't have to aggregate over the discoveries.
+    """
+    __tablename__ = 'map_contribution'
+
+    map_id = db.Column(db.Integer, db.ForeignKey('wardriving_map.id', ondelete='CASCADE'), primary_key=True)
+    sniffer_id = db.Column(db.Integer, db.ForeignKey('sniffer.id', ondelete='CASCADE'), primary_key=True)
+
+    discoveries = db.Column(db.Integer, nullable=False, default=0)
+    #number of different APs this sniffer found on this map
+    aps = db.Column(db.Integer, nullable=False, default=0)
+    #timestamps of the sniffer's earliest and latest discovery on this map
+    first_seen = db.Column(db.DateTime, nullable=True)
+    last_seen = db.Column(db.DateTime, nullable=True)
+
+
+class ContributedAP(db.Model):
+    """
+    APs a sniffer has found on a map (one row per AP, no matter how often it was discovered),
+    needed to count the new APs of MapContribution at ingest
+    """
+    __tablename__ = 'map_contribution_ap'
+
+    map_id = db.Column(db.Integer, db.ForeignKey('wardriving_map.id', ondelete='CASCADE'), primary_key=True)
+    sniffer_id = db.Column(db.Integer, db.ForeignKey('sniffer.id', ondelete='CASCADE'), primary_key=True)
+    mac = db.Column(db.Integer, primary_key=True)
+
+
+class MapAccess(db.Model):
+    """
+    A map shared with a user (only enforced with MAP_ACL_ENABLED, see server/acl.py).
+    If the bounding box is set, the user only sees the part of the map within it (geofence).
+    """
+    __tablename__ = 'map_access'
+
+    map_id = db.Column(db.Integer, db.ForeignKey('wardriving_map.id', ondelete='CASCADE'), primary_key=True)
+    #the maps of a user are looked up on every request (if not cached), so this is the index we need
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True, index=True)
+
+    lat_min = db.Column(db.Float, nullable=True)
+    lon_min = db.Column(db.Float, nullable=True)
+    lat_max = db.Column(db.Float, nullable=True)
+    lon_max = db.Column(db.Float, nullable=True)
+
+    @property
+    def bbox(self):
+        if self.lat_min is None:
+            return None
+        return (self.lat_min, self.lon_min, self.lat_max, self.lon_max)
+
+
+class AnomalyFinding(db.Model):
+    """
+    Suspicious AP (or pair of APs) found on a map by the anomaly detection (see server/anomalies.py).
+    Repeated sightings of the same anomaly are counted in one row.
+    """
+    __tablename__ = 'anomaly_finding'
+    __table_args__ = (db.Index('ix_anomaly_finding_map_last_seen', 'map_id', 'last_seen'),)
+
+    #kinds of findings
+    EVIL_TWIN = 'evil_twin'
+    SSID_CLONE = 'ssid_clone'
+    DISPLACED = 'displaced'
+
+    map_id = db.Column(db.Integer, db.ForeignKey('wardriving_map.id', ondelete='CASCADE'), primary_key=True)
+    kind = db.Column(db.String(16), primary_key=True)
+    mac = db.Column(db.Integer, primary_key=True)
+    #the other AP of a pair (the smaller mac is always stored in mac), 0 if the finding is about one AP
+    other_mac = db.Column(db.Integer, primary_key=True, default=0)
+
+    ssid = db.Column(db.String(64))
+    #'low', 'medium' or 'high'
+    severity = db.Column(db.String(8), nullable=False)
+    #largest distance seen (in meters): between the twins or from the usual position
+    distance = db.Column(db.Float, nullable=False, default=0)
+    #JSON object with what was compared (e.g. the encryptions and channels of the twins)
+    details = db.Column(db.Text, nullable=True)
+
+    #where it was seen last (also lets the map ACL apply geofences to the findings)
+    gps_lat = db.Column(db.Float, nullable=False)
+    gps_lon = db.Column(db.Float, nullable=False)
+
+    #timestamps of the discoveries
+    first_seen = db.Column(db.DateTime, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class APPosition(db.Model):
+    """
+    Usual position of an AP for the anomaly detection: running mean of its sightings, without those
+    that were reported as displaced
+    """
+    __tablename__ = 'ap_position'
+
+    mac = db.Column(db.Integer, primary_key=True)
+    sightings = db.Column(db.Integer, nullable=False)
+    gps_lat = db.Column(db.Float, nullable=False)
+    gps_lon = db.Column(db.Float, nullable=False)
+
+
+class AnalysisCursor(db.Model):
+    """
+    How far a background job got through the discovery table (the highest id it has processed),
+    so the next run only looks at the new discoveries
+    """
+    __tablename__ = 'analysis_cursor'
+
+    name = db.Column(db.String(32), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+
+
+class UploadSession(db.Model):
+    """
+    A resumable upload of discoveries by a sniffer: the discoveries are sent in numbered chunks
+    and we keep track of the last chunk we have stored, so an interrupted upload can be continued there.
+    """
+    __tablename__ = 'upload_session'
+
+    id = db.Column(db.Integer, primary_key=True)
+    #used to identify the session in the API
+    public_id = db.Column(db.String(50), unique=True, nullable=False)
+
+    sniffer_id = db.Column(db.Integer, db.ForeignKey('sniffer.id', ondelete='CASCADE'), nullable=False)
+    map_id = db.Column(db.Integer, db.ForeignKey('wardriving_map.id', ondelete='CASCADE'), nullable=False)
+
+    #number of the last chunk that has been stored (chunks are numbered from 0, so -1 means none yet)
+    last_chunk = db.Column(db.Integer, nullable=False, default=-1)
+    #statistics: discoveries stored and discoveries dropped because they had already been sent before
+    n_discoveries = db.Column(db.Integer, nullable=False, default=0)
+    n_duplicates = db.Column(db.Integer, nullable=False, default=0)
+
+    date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    #set when the sniffer has sent everything; no more chunks are accepted after that
+    committed = db.Column(db.Boolean, nullable=False, default=False)
+
+
+class Track(db.Model):
+    """
+    A route driven by a sniffer while creating a map.
+    Instead of one row per GPS fix, the whole track is stored in a single row as encoded polyline
+    (see server/polyline.py). Together with every point we store its Douglas-Peucker significance, so the track
+    can be served at any level of detail by just skipping the points that are not significant enough.
+    Points that deviate less than TRACK_MIN_TOLERANCE from the track are not stored at all.
+    """
+    __tablename__ = 'track'
+    __table_args__ = (db.Index('ix_track_map_sniffer', 'map_id', 'sniffer_id'),)
+
+    #significance of points that are always part of the track: end of every upload and start of every upload
+    #(tracks stored before uploads could be merged use ALWAYS for both)
+    ALWAYS = -1
+    START = -2
+
+    id = db.Column(db.Integer, primary_key=True)
+    sniffer_id = db.Column(db.Integer, db.ForeignKey('sniffer.id', ondelete='CASCADE'), nullable=False)
+    map_id = db.Column(db.Integer, db.ForeignKey('wardriving_map.id', ondelete='CASCADE'), nullable=False)
+    map = db.relationship('WardrivingMap', back_populates='tracks')
+
+    t_start = db.Column(db.DateTime, nullable=True)
+    t_end = db.Column(db.DateTime, nullable=True)
+    #number of GPS fixes received and number of points actually stored
+    n_fixes = db.Column(db.Integer, nullable=False, default=0)
+    n_points = db.Column(db.Integer, nullable=False, default=0)
+    #[km] of the stored track
+    length = db.Column(db.Float, nullable=False, default=0.0)
+
+    #encoded polyline of the points
+    path = db.Column(db.Text, nullable=False, default='')
+    #significance of every point in [dm] (ALWAYS for end points)
+    significance = db.Column(db.Text, nullable=False, default='')
+    #time of every point in [s] since t_start (delta encoded)
+    times = db.Column(db.Text, nullable=False, default='')
+
+    def _decode(self):
+        """
+        All stored points as (lats, lons, times [s since t_start], significances [dm])
+        """
+        points = polyline.decode(self.path or '')
+        return ([lat for lat, _ in points], [lon for _, lon in points],
+                polyline.decode_deltas(self.times or ''), polyline.decode_numbers(self.significance or ''))
+
+    def overlaps(self, fixes):
+        """
+        Whether the time span of the fixes overlaps one of the uploads already stored, i.e. the fixes either
+        contain a stored point or fall between two stored points of the same upload
+        fixes: list of (lat, lon, datetime) ordered by time
+        """
+        if not self.t_start:
+            return False
+        _, _, offsets, levels = self._decode()
+        first = (fixes[0][2] - self.t_start).total_seconds()
+        last = (fixes[-1][2] - self.t_start).total_seconds()
+        i = bisect.bisect_left(offsets, first)
+        if i < len(offsets) and offsets[i] <= last:
+            return True
+        if i == 0 or i == len(offsets):
+            return False
+        #between two uploads, the next point starts one of them
+        return not (levels[i] == self.START or levels[i - 1] == levels[i] == self.ALWAYS)
+
+    def add_fixes(self, fixes, min_tolerance):
+        """
+        Simplify the GPS fixes and merge them into this track (by time, so older fixes can be uploaded later).
+        Check overlaps() first: the fixes must not overlap an upload already stored.
+        fixes: list of (lat, lon, datetime) ordered by time
+        min_tolerance: [km] points closer than this to the simplified track are dropped
+        WARNING: you still have to call session.add(track) and commit() to apply these changes to the DB!
+        """
+        import numpy as np
+
+        lat = np.array([f[0] for f in fixes], dtype=np.float64)
+        lon = np.array([f[1] for f in fixes], dtype=np.float64)
+        significance = gps.douglas_peucker(lat, lon)
+        keep = significance >= min_tolerance
+
+        lats, lons, offsets, levels = self._decode()
+        #times are stored relative to the start of the track, which moves if older fixes are added
+        t_start = min(self.t_start, fixes[0][2]) if self.t_start else fixes[0][2]
+        shift = (self.t_start - t_start).total_seconds() if self.t_start else 0
+        points = [(offset + shift, lat, lon, level) for lat, lon, offset, level in zip(lats, lons, offsets, levels)]
+        for i in np.flatnonzero(keep):
+            if i == 0:
+                level = self.START
+            else:
+                level = self.ALWAYS if np.isinf(significance[i]) else int(significance[i] * 10000)
+            points.append(((fixes[i][2] - t_start).total_seconds(), float(lat[i]), float(lon[i]), level))
+        #stable: points with the same time stay in the order they were uploaded
+        points.sort(key=lambda point: point[0])
+
+        self.path = polyline.encode([(lat, lon) for _, lat, lon, _ in points])
+        self.times = polyline.encode_deltas(int(round(seconds)) for seconds, _, _, _ in points)
+        self.significance = polyline.encode_numbers(level for _, _, _, level in points)
+        self.t_start = t_start
+        self.t_end = max(self.t_end or fixes[-1][2], fixes[-1][2])
+        self.n_fixes = (self.n_fixes or 0) + len(fixes)
+        self.n_points = len(points)
+        self.length = sum(gps.distance_simple(gps.Point(points[i][1], points[i][2]), gps.Point(points[i+1][1], points[i+1][2]))
+                          for i in range(len(points) - 1))
+
+    def simplified(self, tolerance):
+        """
+        The track simplified with the given tolerance [km]: list of (lat, lon, seconds since t_start)
+        """
+        lats, lons, offsets, levels = self._decode()
+        threshold = tolerance * 10000
+        return [(lat, lon, offset) for lat, lon, offset, level in zip(lats, lons, offsets, levels)
+                if level < 0 or level >= threshold]
+
+
 class Map_StringEAV(db.Model):
     """
     Generic table that can be used to dynamically add metadate/attributs to maps without 
@@ -0,0 +1,89 @@
+import csv
+import os
+import re
+from functools import lru_cache
+
+
+"""
+Vendor lookup for MAC addresses.
+The first 24 bits of a MAC address (the OUI) identify the manufacturer. Since we store MACs as integers,
+the OUI of an AP is simply 'mac >> 24', which is also stored in the indexed column AccessPoint.oui.
+
+The registry is loaded once at startup into a dict keyed by the 24-bit prefix, so a lookup is O(1) and
+never needs the DB. Only a handful of vendors are built in (server/data/oui.csv); for the complete list,
+download the IEEE registry (https://standards-oui.ieee.org/oui/oui.csv or oui.txt) and set OUI_FILE.
+"""
+
+BUILTIN_OUI_FILE = os.path.join(os.path.dirname(__file__), 'data', 'oui.csv')
+
+#line format of the IEEE oui.txt, e.g. "00-80-41   (hex)		VEB KOMBINAT ROBOTRON"
+_OUI_TXT_LINE = re.compile(r'^\s*([0-9A-Fa-f]{2})-([0-9A-Fa-f]{2})-([0-9A-Fa-f]{2})\s+\(hex\)\s+(.+?)\s*$')
+
+
+def oui_of(mac):
+    """
+    The 24-bit OUI of a MAC address given as integer
+    """
+    return int(mac) >> 24
+
+
+class OUIRegistry():
+    def __init__(self):
+        #OUI (int) -> vendor name
+        self._vendors = {}
+
+    def __len__(self):
+        return len(self._vendors)
+
+    def _load_csv(self, f):
+        for row in csv.DictReader(f):
+            assignment = (row.get('Assignment') or '').replace(' ', '').replace('-', '')
+            vendor = (row.get('Organization Name') or '').strip()
+            #only MA-L assignments are 24 bit prefixes
+            if len(assignment) == 6 and vendor:
+                self._vendors[int(assignment, 16)] = vendor
+
+    def _load_txt(self, f):
+        for line in f:
+            match = _OUI_TXT_LINE.match(line)
+            if match:
+                self._vendors[int(''.join(match.groups()[:3]), 16)] = match.group(4)
+
+    def load(self, path):
+        """
+        Add all entries of an IEEE registry file (oui.csv or oui.txt) to this registry
+        """
+        with open(path, encoding='utf-8', errors='replace') as f:
+            if path.endswith('.csv'):
+                self._load_csv(f)
+            else:
+                self._load_txt(f)
+        self.prefixes.cache_clear()
+
+    def init_app(self, app):
+        #the registry is shared by all apps of this process, so only load it once
+        if not self._vendors:
+            self.load(BUILTIN_OUI_FILE)
+            if app.config['OUI_FILE']:
+                self.load(app.config['OUI_FILE'])
+        app.extensions['oui'] = self
+
+    def vendor_of_oui(self, oui):
+        return self._vendors.get(oui)
+
+    def vendor(self, mac):
+        """
+        Vendor name of a MAC address (integer) or None if it is unknown
+        """
+        return self._vendors.get(oui_of(mac))
+
+    @lru_cache(maxsize=256)
+    def prefixes(self, vendor):
+        """
+        All OUIs whose vendor name contains the given string (case insensitive)
+        """
+        vendor = vendor.lower()
+        return tuple(sorted(oui for oui, name in self._vendors.items() if vendor in name.lower()))
+
+
+oui_registry = OUIRegistry()
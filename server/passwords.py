@@ -0,0 +1,91 @@
+import hashlib
+import hmac
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import BoundedSemaphore
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from server.cache import LRUCache
+
+
+"""
+Password hashing off the request threads:
+all hashing runs in a small, bounded thread pool (PASSWORD_HASH_WORKERS), so a burst of logins - e.g. a whole
+fleet of sniffers reconnecting after an outage - can't occupy all workers of the server. If more than
+PASSWORD_HASH_QUEUE hashes are waiting, further requests are rejected right away (HashingOverloaded).
+
+Successful verifications are remembered for LOGIN_CACHE_TTL seconds, so repeated logins with the same
+credentials don't have to be hashed again. The cache key is an HMAC of the credentials and the stored hash
+with a random key of this process, so the cache contains nothing that helps to recover a password, and changing
+the password invalidates the entry.
+"""
+
+
+class HashingOverloaded(Exception):
+    pass
+
+
+class PasswordHasher():
+    """
+    Extension object doing the password hashing for all requests
+    """
+    def __init__(self):
+        self._executor = None
+        self._cache = LRUCache(0)
+        #never leaves this process
+        self._key = os.urandom(32)
+
+    def init_app(self, app):
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self.cache_ttl = app.config['LOGIN_CACHE_TTL']
+        if self._executor is None:
+            workers = app.config['PASSWORD_HASH_WORKERS']
+            self._executor = ThreadPoolExecutor(workers, thread_name_prefix='pwhash')
+            #jobs being hashed plus jobs waiting for a worker
+            self._slots = BoundedSemaphore(workers + app.config['PASSWORD_HASH_QUEUE'])
+        self._cache = LRUCache(app.config['LOGIN_CACHE_SIZE'])
+        app.extensions['passwords'] = self
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloaded()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HashingOverloaded()
+
+    def generate(self, password):
+        """
+        Hash a new password (to store it in User.password)
+        """
+        return self._run(generate_password_hash, password, self.method)
+
+    def _cache_key(self, user, password):
+        return hmac.new(self._key, f'{user.id}\0{user.password}\0{password}'.encode(), hashlib.sha256).digest()
+
+    def check(self, user, password):
+        """
+        Is this the password of the user?
+        """
+        key = self._cache_key(user, password)
+        expires = self._cache.get(key)
+        if expires is not None and expires > time.monotonic():
+            return True
+
+        valid = self._run(check_password_hash, user.password, password)
+        #only successful logins are cached, wrong passwords always cost a full hash
+        if valid and self.cache_ttl > 0:
+            self._cache.put(key, time.monotonic() + self.cache_ttl)
+        return valid
+
+
+passwords = PasswordHasher()
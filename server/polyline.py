@@ -0,0 +1,85 @@
+"""
+Encoded polylines (the format of the Google Maps API, which most map libraries can decode):
+every number is stored as the difference to the previous one (delta encoding), and these mostly small
+differences are written as variable-length groups of 5 bits in printable ASCII characters.
+A GPS fix typically needs 4-8 characters instead of two floats.
+
+https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+"""
+
+#5 decimal places ~ 1 m, the precision of the format used by Google
+PRECISION = 5
+
+
+def encode_numbers(numbers):
+    """
+    Encode a sequence of integers (not delta encoded by itself)
+    """
+    out = []
+    for number in numbers:
+        #the sign goes into the lowest bit
+        value = ~(number << 1) if number < 0 else number << 1
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return ''.join(out)
+
+
+def decode_numbers(encoded):
+    numbers = []
+    value, shift = 0, 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            numbers.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    return numbers
+
+
+def _deltas(values):
+    previous = 0
+    for value in values:
+        yield value - previous
+        previous = value
+
+
+def _sums(deltas):
+    total = 0
+    for delta in deltas:
+        total += delta
+        yield total
+
+
+def encode(points, precision=PRECISION):
+    """
+    points: sequence of (lat, lon) in degrees
+    """
+    factor = 10 ** precision
+    lats = _deltas(int(round(lat * factor)) for lat, _ in points)
+    lons = _deltas(int(round(lon * factor)) for _, lon in points)
+    return encode_numbers(n for pair in zip(lats, lons) for n in pair)
+
+
+def decode(encoded, precision=PRECISION):
+    """
+    Inverse of encode(): list of (lat, lon)
+    """
+    factor = 10 ** precision
+    numbers = decode_numbers(encoded)
+    lats = _sums(numbers[0::2])
+    lons = _sums(numbers[1::2])
+    return [(lat / factor, lon / factor) for lat, lon in zip(lats, lons)]
+
+
+def encode_deltas(values):
+    """
+    Delta encoding of any sequence of integers (e.g. timestamps)
+    """
+    return encode_numbers(_deltas(values))
+
+
+def decode_deltas(encoded):
+    return list(_sums(decode_numbers(encoded)))
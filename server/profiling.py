@@ -0,0 +1,359 @@
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from threading import Lock
+
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from server.cache import LRUCache
+
+#pyinstrument is optional: without it, only cProfile dumps can be requested
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+"""
+Opt-in profiling of single requests and a log of slow requests.
+
+A traced request records how much time was spent in each phase:
+- auth: checking the token and loading the user (login_required/admin_required)
+- sql: executing SQL statements in the DB
+- orm: fetching the rows and turning them into model objects
+- serialize: marshmallow dumps
+- json: encoding the JSON response
+- view: everything else the route does, other: everything outside the route (request hooks, compression...)
+The times are exclusive, e.g. SQL executed by a lazy load during a marshmallow dump counts as sql, not serialize.
+All SQL statements are recorded with their duration, number of rows and EXPLAIN plan.
+
+Admins trace a request by sending the header 'X-Profile: 1' (PROFILING_HEADER). The response then contains a
+Server-Timing header with the phases and an X-Profile-Id; the full trace can be fetched at GET /profiles/<id>.
+'X-Profile: cprofile' (or 'pyinstrument', if installed) additionally profiles the python code of the route and
+stores the dump in PROFILING_DIRECTORY. PROFILING_ENABLED traces every request, PROFILING_SAMPLE_RATE a random
+part of them.
+
+Requests taking longer than PROFILING_SLOW_THRESHOLD are written to the 'server.slow' logger (a sample of
+PROFILING_SLOW_SAMPLE_RATE of them) and kept for GET /slow-requests, including the trace if they were traced.
+
+NOTE: the async routes of the ASGI mode (see server/asgi.py) are not traced.
+"""
+
+#values of the profiling header which also profile the python code
+DUMP_MODES = ('cprofile', 'pyinstrument')
+
+slow_log = logging.getLogger('server.slow')
+
+
+class Trace():
+    """
+    Timings and SQL statements of one request
+    """
+    def __init__(self, requested=False, mode=None):
+        self.id = uuid.uuid4().hex[:16]
+        #requested with the header: the results are sent to the client once it turned out to be an admin
+        self.requested = requested
+        self.authorized = False
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.total = None
+        self.phases = {}
+        self.statements = []
+        self.dropped_statements = 0
+        self.profile = None
+        #phases currently running: [name, start, time of nested phases]
+        self._stack = []
+
+    def begin(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def end(self, name):
+        now = time.perf_counter()
+        if not any(frame[0] == name for frame in self._stack):
+            return
+        while self._stack:
+            current, start, nested = self._stack.pop()
+            elapsed = now - start
+            self.phases[current] = self.phases.get(current, 0.0) + elapsed - nested
+            if self._stack:
+                self._stack[-1][2] += elapsed
+            if current == name:
+                break
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        self.phases['other'] = max(0.0, self.total - sum(self.phases.values()))
+
+    def server_timing(self):
+        """
+        Value of the Server-Timing header (shown by the dev tools of browsers)
+        """
+        return ', '.join([f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.phases.items()] +
+                         [f'total;dur={self.total * 1000:.2f}'])
+
+    def report(self):
+        return {'id': self.id, 'total_ms': round(self.total * 1000, 3),
+                'phases_ms': {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+                'statements': [{key: value for key, value in s.items() if key not in ('engine', 'raw_parameters')}
+                               for s in self.statements],
+                'dropped_statements': self.dropped_statements, 'profile': self.profile}
+
+
+def _trace():
+    return g.get('profile') if has_app_context() else None
+
+
+class Profiler():
+    """
+    Extension object tracing requests (used just like 'db')
+    """
+    def __init__(self):
+        self.traces = LRUCache(0)
+        self.slow = deque()
+        self._lock = Lock()
+        self._listening = False
+
+    def init_app(self, app):
+        self.enabled = app.config['PROFILING_ENABLED']
+        self.header = app.config['PROFILING_HEADER']
+        self.sample_rate = app.config['PROFILING_SAMPLE_RATE']
+        self.slow_threshold = app.config['PROFILING_SLOW_THRESHOLD']
+        self.slow_sample_rate = app.config['PROFILING_SLOW_SAMPLE_RATE']
+        self.explain = app.config['PROFILING_EXPLAIN']
+        self.max_statements = app.config['PROFILING_MAX_STATEMENTS']
+        self.directory = os.path.join(app.root_path, app.config['PROFILING_DIRECTORY'])
+        self.traces = LRUCache(app.config['PROFILING_TRACES_KEPT'])
+        self.slow = deque(maxlen=app.config['PROFILING_SLOW_LOG_SIZE'])
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+        #without any way to start a trace, the SQL and JSON hooks would only cost time
+        if self.enabled or self.header or self.sample_rate:
+            self._listen()
+            profiler = self
+
+            class TimedJSONEncoder(app.json_encoder):
+                def encode(self, o):
+                    with profiler.phase('json'):
+                        return super().encode(o)
+
+            app.json_encoder = TimedJSONEncoder
+        app.extensions['profiling'] = self
+
+    def _listen(self):
+        #the events are registered for all engines and sessions, so only once per process
+        if self._listening:
+            return
+        self._listening = True
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(Engine, 'handle_error', self._handle_error)
+        event.listen(Session, 'do_orm_execute', self._do_orm_execute)
+
+    ################################## request hooks ###################################################
+
+    def start(self):
+        g.request_started = time.perf_counter()
+        value = request.headers.get(self.header, '').strip().lower() if self.header else ''
+        if value or self.enabled or (self.sample_rate and random.random() < self.sample_rate):
+            g.profile = Trace(requested=bool(value), mode=value if value in DUMP_MODES else None)
+
+    def authorize(self, user):
+        """
+        Called by login_required/admin_required once the user is known: only admins may trace their requests
+        """
+        trace = _trace()
+        if trace is None or not trace.requested:
+            return
+        if getattr(user, 'admin', False):
+            trace.authorized = True
+        elif self.enabled:
+            trace.requested, trace.mode = False, None
+        else:
+            g.profile = None
+
+    def call(self, f, *args, **kwargs):
+        """
+        Run the route f (called by login_required/admin_required), profiling its python code if requested
+        """
+        trace = _trace()
+        if trace is None:
+            return f(*args, **kwargs)
+
+        with trace.phase('view'):
+            if trace.mode == 'cprofile':
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(f, *args, **kwargs)
+                finally:
+                    trace.profile = self._dump_cprofile(trace, profile)
+            if trace.mode == 'pyinstrument' and pyinstrument:
+                profile = pyinstrument.Profiler()
+                profile.start()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    profile.stop()
+                    trace.profile = self._dump_pyinstrument(trace, profile)
+            return f(*args, **kwargs)
+
+    def phase(self, name):
+        """
+        Context manager measuring a phase of the current request (does nothing if it isn't traced)
+        """
+        trace = _trace()
+        return trace.phase(name) if trace is not None else contextlib.nullcontext()
+
+    def wrap(self, name, fn):
+        """
+        fn, measured as phase 'name' when called during a traced request
+        """
+        if _trace() is None:
+            return fn
+
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return fn(*args, **kwargs)
+        return timed
+
+    def finish(self, response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        duration = time.perf_counter() - started
+        slow = self.slow_threshold is not None and duration >= self.slow_threshold
+
+        trace = g.pop('profile', None)
+        if trace is not None:
+            trace.finish()
+            if self.explain and (trace.authorized or slow):
+                self._explain(trace)
+            if trace.authorized:
+                self.traces.put(trace.id, trace.report())
+                response.headers['Server-Timing'] = trace.server_timing()
+                response.headers['X-Profile-Id'] = trace.id
+
+        if slow and random.random() < self.slow_sample_rate:
+            self._log_slow(response, duration, trace)
+        return response
+
+    def _log_slow(self, response, duration, trace):
+        user = g.get('current_user')
+        entry = {'time': datetime.utcnow().isoformat(), 'method': request.method, 'path': request.full_path.rstrip('?'),
+                 'endpoint': request.endpoint, 'status': response.status_code, 'duration_ms': round(duration * 1000, 3),
+                 'user': user.public_id if user is not None else None,
+                 'trace': trace.report() if trace is not None else None}
+        with self._lock:
+            self.slow.append(entry)
+        slow_log.warning(json.dumps(entry, default=str))
+
+    def slow_requests(self):
+        with self._lock:
+            return list(reversed(self.slow))
+
+    ################################## SQL ###########################################################
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        trace = _trace()
+        if trace is not None:
+            trace.begin('sql')
+            context._profile_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        trace = _trace()
+        started = getattr(context, '_profile_started', None)
+        if trace is None or started is None:
+            return
+        trace.end('sql')
+        if len(trace.statements) >= self.max_statements:
+            trace.dropped_statements += 1
+            return
+        trace.statements.append({
+            'statement': statement, 'parameters': repr(parameters)[:500], 'executemany': executemany,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            #the number of selected rows is only known after fetching them (see _do_orm_execute)
+            'rows': cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else None,
+            'plan': None, 'engine': conn.engine, 'raw_parameters': parameters})
+
+    def _handle_error(self, context):
+        trace = _trace()
+        if trace is not None:
+            trace.end('sql')
+
+    def _do_orm_execute(self, orm_execute_state):
+        """
+        Fetch all rows of a SELECT at once, so the time to build the model objects and the number of rows are known
+        """
+        trace = _trace()
+        options = orm_execute_state.execution_options
+        if trace is None or not orm_execute_state.is_select or options.get('stream_results') or options.get('yield_per'):
+            return None
+
+        first = len(trace.statements)
+        with trace.phase('orm'):
+            frozen = orm_execute_state.invoke_statement().freeze()
+        if len(trace.statements) > first:
+            trace.statements[-1]['rows'] = len(frozen.data)
+        return frozen()
+
+    def _explain(self, trace):
+        #prefix of a query plan in the different SQL dialects
+        prefixes = {'sqlite': 'EXPLAIN QUERY PLAN ', 'mysql': 'EXPLAIN ', 'postgresql': 'EXPLAIN '}
+        plans = {}
+        for s in trace.statements:
+            engine, parameters = s.pop('engine'), s.pop('raw_parameters')
+            prefix = prefixes.get(engine.dialect.name)
+            if not prefix or s['executemany'] or not s['statement'].lstrip().upper().startswith('SELECT'):
+                continue
+            #the same query is often executed many times in one request (e.g. lazy loads)
+            key = (engine, s['statement'])
+            if key not in plans:
+                try:
+                    with engine.connect() as conn:
+                        plans[key] = [list(row) for row in conn.exec_driver_sql(prefix + s['statement'], parameters)]
+                except Exception as e:
+                    plans[key] = f'EXPLAIN failed: {e}'
+            s['plan'] = plans[key]
+
+    ################################## python profiles ###############################################
+
+    def _dump_path(self, trace, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f'{request.endpoint}-{trace.id}.{extension}')
+
+    def _dump_cprofile(self, trace, profile):
+        path = self._dump_path(trace, 'prof')
+        profile.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(20)
+        return {'file': path, 'summary': out.getvalue()}
+
+    def _dump_pyinstrument(self, trace, profile):
+        path = self._dump_path(trace, 'html')
+        with open(path, 'w') as f:
+            f.write(profile.output_html())
+        return {'file': path, 'summary': profile.output_text()}
+
+
+profiler = Profiler()
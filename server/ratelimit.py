@@ -0,0 +1,205 @@
+import math
+import time
+from collections import Counter
+from threading import Lock, BoundedSemaphore
+
+import jwt
+from flask import g, request, jsonify
+
+#redis is optional: it's only needed if the buckets should be shared by several processes/servers
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+"""
+Admission control, so a single misbehaving client can't starve all others:
+- token buckets per user (or IP address for anonymous requests) and route: every request takes one token,
+  and the bucket refills with 'rate' tokens per second up to 'burst' tokens (RATELIMIT_DEFAULT/RATELIMIT_ROUTES)
+- for the login, additional buckets per submitted username (RATELIMIT_USERNAME_ROUTES): the login is anonymous, so
+  the buckets above are per IP address, which many users can share (NAT, proxies)
+- concurrency caps for expensive reads (RATELIMIT_CONCURRENCY): at most n requests of such a route are
+  answered at the same time by one server process
+Rejected requests get '429 Too Many Requests' with a Retry-After header.
+
+By default the buckets live in the memory of the server process. To share them between several
+processes (e.g. gunicorn workers) or servers, set RATELIMIT_STORAGE to a redis URL.
+"""
+
+#buckets that haven't been used for this long [s] are dropped from the memory store
+BUCKET_IDLE_TIME = 3600
+
+
+class MemoryStore():
+    """
+    Token buckets in a dict of this process
+    """
+    def __init__(self):
+        #key -> (tokens, time of the last update)
+        self._buckets = {}
+        self._lock = Lock()
+
+    def take(self, key, rate, burst):
+        """
+        Take one token from the bucket 'key'. Returns 0 if that was possible,
+        otherwise the time [s] until the next token is available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+
+            #idle buckets are full anyway, so forgetting them doesn't change anything
+            if len(self._buckets) > 100000:
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < BUCKET_IDLE_TIME}
+        return wait
+
+
+class RedisStore():
+    """
+    Token buckets in redis, shared by all processes using the same server
+    """
+    #the bucket is read and updated atomically by redis
+    SCRIPT = """
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return tostring(wait)
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('RATELIMIT_STORAGE is a redis URL, but the redis package is not installed.')
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        #the time of the redis server is used, so it's the same for all clients
+        seconds, microseconds = self._client.time()
+        now = seconds + microseconds / 1e6
+        return float(self._script(keys=['ratelimit:' + key], args=[rate, burst, now, BUCKET_IDLE_TIME]))
+
+
+class RateLimiter():
+    """
+    Extension object checking every request against the rate limits and concurrency caps
+    """
+    def __init__(self):
+        self.store = None
+        self.metrics = Counter()
+        self._slots = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config['RATELIMIT_ENABLED']
+        self.default = app.config['RATELIMIT_DEFAULT']
+        self.routes = app.config['RATELIMIT_ROUTES']
+        self.username_routes = app.config['RATELIMIT_USERNAME_ROUTES']
+        self.concurrency = app.config['RATELIMIT_CONCURRENCY']
+        self.concurrency_timeout = app.config['RATELIMIT_CONCURRENCY_TIMEOUT']
+        self.secret_key = app.config['SECRET_KEY']
+
+        storage = app.config['RATELIMIT_STORAGE']
+        self.store = RedisStore(storage) if storage.startswith(('redis://', 'rediss://', 'unix://')) else MemoryStore()
+        self._slots = {endpoint: BoundedSemaphore(n) for endpoint, n in self.concurrency.items()}
+
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+        app.extensions['ratelimit'] = self
+
+    def _identity(self):
+        """
+        Who sent this request: the user of a valid token, otherwise the IP address
+        """
+        token = request.headers.get('x-access-token')
+        if token:
+            try:
+                return 'user:' + jwt.decode(token, self.secret_key, algorithms=["HS256"])['public_id']
+            except (jwt.PyJWTError, KeyError):
+                pass
+        return 'ip:' + str(request.remote_addr)
+
+    def take(self, identity, endpoint):
+        """
+        Take a token for this client and route. Returns 0 if the request may pass, otherwise the time [s]
+        until it may try again.
+        """
+        limit = self.routes.get(endpoint, self.default)
+        if not limit:
+            return 0
+        rate, burst = limit
+        return self.store.take(f'{identity}:{endpoint}', rate, burst)
+
+    def take_username(self, endpoint):
+        """
+        Like take(), with the bucket of the username sent with basic auth (routes of RATELIMIT_USERNAME_ROUTES)
+        """
+        limit = self.username_routes.get(endpoint)
+        auth = request.authorization
+        if not (limit and auth and auth.username):
+            return 0
+        rate, burst = limit
+        return self.store.take(f'username:{auth.username}:{endpoint}', rate, burst)
+
+    def count_rejection(self, reason, endpoint):
+        with self._lock:
+            self.metrics[(reason, endpoint)] += 1
+
+    def _reject(self, reason, retry_after):
+        self.count_rejection(reason, request.endpoint)
+        resp = jsonify({'message': 'Too many requests, please try again later.', 'reason': reason})
+        resp.status_code = 429
+        resp.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return resp
+
+    def admit(self):
+        g.ratelimit_slot = None
+        if not self.enabled or request.endpoint is None or request.method == 'OPTIONS':
+            return
+
+        wait = self.take(self._identity(), request.endpoint) or self.take_username(request.endpoint)
+        if wait > 0:
+            return self._reject('rate', wait)
+
+        slot = self._slots.get(request.endpoint)
+        if slot:
+            #wait a little for a free slot, so short peaks don't get rejected
+            if not slot.acquire(timeout=self.concurrency_timeout):
+                return self._reject('concurrency', 1)
+            g.ratelimit_slot = slot
+
+    def release(self, error=None):
+        slot = g.pop('ratelimit_slot', None)
+        if slot:
+            slot.release()
+
+    def status(self):
+        """
+        Number of rejected requests per reason and route (used by the metrics endpoint)
+        """
+        with self._lock:
+            metrics = list(self.metrics.items())
+        rejected = {}
+        for (reason, endpoint), n in metrics:
+            rejected.setdefault(reason, {})[endpoint] = n
+        return {'rejected': rejected, 'total_rejected': sum(n for _, n in metrics)}
+
+
+limiter = RateLimiter()
@@ -0,0 +1,192 @@
+import itertools
+import time
+from threading import Lock
+
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, event, exc
+
+
+"""
+Read replica routing:
+GET requests to the blueprints listed in REPLICA_BLUEPRINTS are answered from one of the read replicas
+(the binds named in SQLALCHEMY_REPLICAS), everything else keeps using the primary DB.
+A client that has written something within the last REPLICA_READ_YOUR_WRITES seconds (or sends the header
+'X-Consistency: strong') reads from the primary as well, so it always sees its own writes. The time of its last
+write is sent to the client as cookie (REPLICA_WRITE_COOKIE), so this works no matter which process or server
+answers its next request.
+Replicas that are unreachable or lag behind more than REPLICA_MAX_LAG seconds are skipped; if no replica is
+healthy, the primary is used. A query that fails on the replica is sent to the primary once.
+"""
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends the queries of read-only requests to the replica chosen for this request
+    """
+    def __init__(self, db, **options):
+        self._routing_db = db
+        SignallingSession.__init__(self, db, **options)
+
+    #SQLAlchemy passes further keyword arguments e.g. when a do_orm_execute hook re-executes a statement
+    #(see server/profiling.py), which flask_sqlalchemy's session doesn't accept
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = g.get('db_replica') if has_request_context() else None
+        if replica:
+            #as soon as this request writes something, it has to stay on the primary
+            if self._flushing or self.new or self.dirty or self.deleted:
+                g.db_replica = None
+            else:
+                return self._routing_db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _retry_on_primary(orm_execute_state):
+    """
+    A read-only statement that fails on the replica (unreachable, broken connection, ...) is executed again on the
+    primary, which also serves the rest of the request
+    """
+    replica = g.get('db_replica') if has_request_context() else None
+    if not replica or not orm_execute_state.is_select:
+        return None
+    try:
+        return orm_execute_state.invoke_statement()
+    except exc.DBAPIError as e:
+        if not (e.connection_invalidated or isinstance(e, exc.OperationalError)):
+            raise
+        replicas.failed(replica)
+        g.db_replica = None
+        return orm_execute_state.invoke_statement()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Drop-in replacement for flask_sqlalchemy.SQLAlchemy using the RoutingSession
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter():
+    """
+    Extension object deciding which replica (if any) serves the current request
+    """
+    def __init__(self):
+        self.replicas = []
+        self._status = {}
+        self._engine_names = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.db = app.extensions['sqlalchemy'].db
+        self.replicas = list(app.config['SQLALCHEMY_REPLICAS'])
+        self.blueprints = set(app.config['REPLICA_BLUEPRINTS'])
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_CHECK_INTERVAL']
+        self.write_window = app.config['REPLICA_READ_YOUR_WRITES']
+        self.write_cookie = app.config['REPLICA_WRITE_COOKIE']
+        self._status = {name: {'healthy': False, 'lag': None, 'checked': 0.0, 'error': None} for name in self.replicas}
+        self._round_robin = itertools.cycle(self.replicas)
+
+        app.before_request(self.route_request)
+        app.after_request(self.remember_write)
+        app.extensions['replicas'] = self
+
+    ################################## health checks ######################################################
+
+    def _engine(self, name):
+        engine = self.db.get_engine(self.app, bind=name)
+        if engine not in self._engine_names:
+            self._engine_names[engine] = name
+            event.listen(engine, 'handle_error', self._on_error)
+        return engine
+
+    def _on_error(self, context):
+        name = self._engine_names.get(context.engine)
+        if name and (context.is_disconnect or isinstance(context.original_exception, exc.OperationalError)):
+            self.failed(name)
+
+    def failed(self, name):
+        #a replica that fails in the middle of a request won't be used until its next successful check
+        self._status[name]['healthy'] = False
+
+    def _lag(self, conn):
+        """
+        Replication lag [s] of a replica. Only MySQL reports it; other DBMS (e.g. SQLite copies
+        used for testing) are assumed to be up to date.
+        """
+        if conn.dialect.name != 'mysql':
+            return 0
+        row = conn.exec_driver_sql('SHOW SLAVE STATUS').mappings().first()
+        if row is None:
+            return 0
+        #None means that replication is not running at all
+        lag = row.get('Seconds_Behind_Master')
+        return float('inf') if lag is None else lag
+
+    def check(self, name):
+        status = self._status[name]
+        try:
+            with self._engine(name).connect() as conn:
+                conn.exec_driver_sql('SELECT 1')
+                status['lag'] = self._lag(conn)
+            status['healthy'] = status['lag'] <= self.max_lag
+            status['error'] = None if status['healthy'] else 'Replication lag is too high.'
+        except exc.SQLAlchemyError as e:
+            status['healthy'], status['lag'], status['error'] = False, None, str(e.__class__.__name__)
+        status['checked'] = time.monotonic()
+        return status
+
+    def status(self):
+        """
+        Check all replicas now and return their status (used by the health endpoint)
+        """
+        return {name: {key: value for key, value in self.check(name).items() if key != 'checked'}
+                for name in self.replicas}
+
+    def pick(self):
+        """
+        Return the name of a healthy replica or None if the primary has to be used
+        """
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                name = next(self._round_robin)
+            status = self._status[name]
+            if now - status['checked'] > self.check_interval:
+                self.check(name)
+            if status['healthy']:
+                #make sure the replica's engine reports errors to _on_error
+                self._engine(name)
+                return name
+        return None
+
+    ################################## request routing #####################################################
+
+    def _wrote_recently(self):
+        try:
+            last_write = float(request.cookies.get(self.write_cookie, ''))
+        except ValueError:
+            return False
+        return time.time() - last_write < self.write_window
+
+    def route_request(self):
+        g.db_replica = None
+        if not self.replicas or request.method not in ('GET', 'HEAD') or request.blueprint not in self.blueprints:
+            return
+        #read-your-writes: clients that just wrote something (or ask for it explicitly) read from the primary
+        if request.headers.get('X-Consistency') == 'strong' or self._wrote_recently():
+            return
+        g.db_replica = self.pick()
+
+    def remember_write(self, response):
+        #the cookie expires together with the window, the timestamp is checked as well in case the client keeps it
+        if self.replicas and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            response.set_cookie(self.write_cookie, f'{time.time():.3f}', max_age=self.write_window, httponly=True)
+        return response
+
+
+#the extension object, used just like 'db'
+replicas = ReplicaRouter()
@@ -0,0 +1,46 @@
+"""
+Helpers for the SSID search (see AccessPoint.ssid_trigrams and the route /aps/search).
+
+SSIDs are indexed as trigrams (all substrings of length 3 of the lowercased SSID), padded like
+PostgreSQL's pg_trgm does it: two spaces in front and one at the end. This makes the index usable for
+- prefix search: the padded query '  <q>' has to be contained in the padded SSID
+- substring search: every trigram of the query has to occur in the SSID
+- fuzzy search: the more trigrams the query and the SSID have in common, the more similar they are
+Since this is just a normal (indexed) table, it works the same way with SQLite and MySQL.
+"""
+
+#minimum share of the query's trigrams an SSID has to contain to be a fuzzy match
+FUZZY_THRESHOLD = 0.3
+
+
+def _windows(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def trigrams(ssid):
+    """
+    All trigrams that are stored in the index for this SSID
+    """
+    if not ssid:
+        return set()
+    return _windows(f'  {ssid.lower()} ')
+
+
+def query_trigrams(q, mode):
+    """
+    The trigrams an SSID must contain (prefix/substring) or should share (fuzzy) to match the query
+    """
+    q = q.lower()
+    if mode == 'prefix':
+        return _windows(f'  {q}')
+    if mode == 'substring':
+        #queries shorter than a trigram can't use the index
+        return _windows(q)
+    return _windows(f'  {q} ')
+
+
+def escape_like(q):
+    """
+    Escape the wildcards of a LIKE pattern (use with escape='\\\\')
+    """
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
@@ -0,0 +1,574 @@
+import atexit
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from multiprocessing.managers import BaseManager
+
+from sqlalchemy import create_engine, select
+
+from server.ingest import update_access_points, update_contributions
+
+
+"""
+Sharded ingest mode (INGEST_MODE = 'sharded'):
+discoveries are not written by the web workers themselves but handed over to a pool of writer processes.
+Every map gets its own SQLite shard file (map_<id>.db in SHARD_DIRECTORY), and every map is owned by exactly
+one writer process (map_id % SHARD_WRITERS), which owns the connections to its shard files and commits in batches.
+The access_point table of the main database stays the global AP directory and is updated by the writers
+once per batch (see server/ingest.py).
+Reads fan out over the shard files and are merged with the discoveries stored in the main database.
+
+The writers have to be started once, before the web workers are forked: gunicorn.conf.py does this in the master
+process (when_ready). The master doesn't start the writers itself but a helper process (a separate program, not a
+multiprocessing child, so the forked workers don't treat it as their own child), which starts the writers and owns
+their queues; the master and the workers hand the discoveries over to the helper through a multiprocessing manager. Without gunicorn
+(flask run, uvicorn with a single process), the writers are started by the first discovery that arrives.
+NOTE: servers that start their workers independently (e.g. uvicorn --workers 4) would start one set of writers per
+worker, so several processes would write the same shard; use gunicorn (with -k uvicorn.workers.UvicornWorker for
+ASGI) instead.
+
+Durability: POST /maps/<id> answers 202 once the discovery is queued, before a writer has committed it. Whatever is
+still queued is written when the server shuts down normally, but it is lost if the server is killed (or crashes).
+A batch the writer fails to write (e.g. the main DB is locked for too long) is kept in SHARD_DIRECTORY/failed/
+together with the error; GET /shards lists these batches and POST /shards/retry hands them over to the writers again.
+"""
+
+logger = logging.getLogger(__name__)
+
+#ids of discoveries stored in a shard are made globally unique by putting the map id into the upper bits
+#(otherwise they would collide with the ids of the main DB and with the ids of other shards)
+SHARD_ID_BITS = 40
+
+#the columns a shard stores; these are also the keys of the dicts passed to the writer processes
+SHARD_COLUMNS = ['access_point_mac', 'channel', 'encryption', 'signal_strength', 'ssid',
+                 'timestamp', 'gps_lat', 'gps_lon', 'client_discovery_id', 'sniffer_id', 'map_id']
+
+SHARD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS discovery (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    access_point_mac INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    encryption INTEGER NOT NULL,
+    signal_strength INTEGER NOT NULL,
+    ssid VARCHAR(64),
+    timestamp VARCHAR(32) NOT NULL,
+    gps_lat FLOAT NOT NULL,
+    gps_lon FLOAT NOT NULL,
+    client_discovery_id VARCHAR(64),
+    sniffer_id INTEGER NOT NULL,
+    map_id INTEGER NOT NULL
+);
+"""
+
+SHARD_INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_discovery_mac ON discovery (access_point_mac);
+CREATE INDEX IF NOT EXISTS ix_discovery_gps ON discovery (gps_lat, gps_lon);
+--a retry of a sniffer (same client_discovery_id) is not stored twice, like uq_discovery_client_id of the main DB
+CREATE UNIQUE INDEX IF NOT EXISTS ix_discovery_client_id ON discovery (sniffer_id, client_discovery_id);
+"""
+
+
+def shard_file(shard_dir, map_id):
+    return os.path.join(shard_dir, f'map_{int(map_id)}.db')
+
+
+def to_global_id(map_id, local_id):
+    return (int(map_id) << SHARD_ID_BITS) | local_id
+
+
+def from_global_id(discovery_id):
+    """
+    Returns (map_id, local_id) for a discovery id of a shard or None if the id belongs to the main DB
+    """
+    discovery_id = int(discovery_id)
+    if discovery_id >> SHARD_ID_BITS == 0:
+        return None
+    return discovery_id >> SHARD_ID_BITS, discovery_id & ((1 << SHARD_ID_BITS) - 1)
+
+
+def _open_shard(path):
+    if not os.path.exists(path):
+        #a new shard gets its tables under another name first, so the readers never see a shard without them
+        _connect(path + '.new').close()
+        os.replace(path + '.new', path)
+    return _connect(path)
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    #WAL allows the web workers to read a shard while its writer is appending to it
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SHARD_SCHEMA)
+    #shards written before client_discovery_id was stored
+    if 'client_discovery_id' not in [row[1] for row in conn.execute('PRAGMA table_info(discovery)')]:
+        conn.execute('ALTER TABLE discovery ADD COLUMN client_discovery_id VARCHAR(64)')
+    conn.executescript(SHARD_INDEXES)
+    return conn
+
+
+################################## writer processes ##############################################
+
+def _remove_shard(shard_dir, map_id):
+    path = shard_file(shard_dir, map_id)
+    for p in (path, path + '-wal', path + '-shm', path + '.new'):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def _write_batch(batch, shard_dir, connections, engine, mirror=None):
+    #discoveries are marked as 'stored' once they are committed to their shard, so a failed batch that is written
+    #again (see ShardedIngest.retry_failed) only updates the AP directory and the contributions for them.
+    #the batch can also contain deleted maps ({'delete_map': id}, see ShardedIngest.delete_map):
+    #their discoveries queued before are dropped and their shard files removed
+    discoveries, deleted = [], []
+    for item in batch:
+        if 'delete_map' in item:
+            discoveries = [d for d in discoveries if d['map_id'] != item['delete_map']]
+            deleted.append(item['delete_map'])
+        else:
+            discoveries.append(item)
+    for map_id in deleted:
+        conn = connections.pop(map_id, None)
+        if conn is not None:
+            conn.close()
+        _remove_shard(shard_dir, map_id)
+        if mirror is not None:
+            mirror.remove(map_id)
+
+    if not discoveries:
+        return
+    #maps deleted after their discoveries were written by an earlier batch don't get any more
+    from server.models import WardrivingMap
+    maps = WardrivingMap.__table__
+    with engine.connect() as conn:
+        existing = {id for id, in conn.execute(select(maps.c.id).where(maps.c.id.in_({d['map_id'] for d in discoveries})))}
+    batch = [d for d in discoveries if d['map_id'] in existing]
+    if not batch:
+        return
+
+    by_map = {}
+    for d in batch:
+        by_map.setdefault(d['map_id'], []).append(d)
+
+    #discoveries already stored (same sniffer and client_discovery_id) are skipped by the unique index
+    insert = f"INSERT OR IGNORE INTO discovery ({', '.join(SHARD_COLUMNS)}) VALUES ({', '.join('?' * len(SHARD_COLUMNS))})"
+    for map_id, discoveries in by_map.items():
+        discoveries = [d for d in discoveries if not d.get('stored')]
+        if not discoveries:
+            continue
+        conn = connections.get(map_id)
+        if conn is None:
+            conn = connections[map_id] = _open_shard(shard_file(shard_dir, map_id))
+        added = []
+        with conn:
+            for d in discoveries:
+                cursor = conn.execute(insert, [d.get(c) for c in SHARD_COLUMNS])
+                if cursor.rowcount:
+                    added.append((cursor.lastrowid, d))
+                else:
+                    d['duplicate'] = True
+        if mirror is not None:
+            mirror.add([dict(d, id=to_global_id(map_id, id)) for id, d in added])
+        for d in discoveries:
+            d['stored'] = True
+
+    #duplicates don't count for the APs and contributions
+    batch = [d for d in batch if not d.get('duplicate')]
+    if not batch:
+        return
+    update_access_points(engine, batch)
+    with engine.begin() as conn:
+        update_contributions(conn, batch)
+
+
+def _keep_failed(shard_dir, batch, error):
+    #the batch is kept with the error, so it isn't lost and can be written again once the cause is fixed
+    directory = os.path.join(shard_dir, 'failed')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'batch-{time.time_ns():020d}-{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'time': datetime.utcnow().isoformat(), 'error': repr(error), 'items': batch}, f)
+    os.replace(path + '.tmp', path)
+
+
+def _writer_main(jobs, shard_dir, db_uri, batch_size, mirror=None):
+    """
+    Entry point of a writer process: take discoveries from the queue and commit them in batches.
+    mirror: arguments of the ColumnarStorage the discoveries are copied to (see server/storage.py), or None
+    """
+    engine = create_engine(db_uri)
+    if mirror is not None:
+        from server.storage import ColumnarStorage
+        mirror = ColumnarStorage(**mirror)
+    connections = {}
+    running = True
+    while running:
+        item = jobs.get()
+        if item is None:
+            break
+        batch = [item]
+        #take everything that is already waiting, so a busy writer commits in bigger batches
+        while len(batch) < batch_size:
+            try:
+                item = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                running = False
+                break
+            batch.append(item)
+
+        try:
+            _write_batch(batch, shard_dir, connections, engine, mirror)
+        except Exception as e:
+            logger.exception('Writing a batch of %d discoveries failed.', len(batch))
+            try:
+                _keep_failed(shard_dir, batch, e)
+            except Exception:
+                logger.exception('Keeping the failed batch failed, its discoveries are lost.')
+
+    for conn in connections.values():
+        conn.close()
+    if mirror is not None:
+        mirror.flush()
+    engine.dispose()
+
+
+class _Writers():
+    """
+    The writer processes and their queues, owned by the helper process.
+    The web workers call put() through the manager; exceptions (queue.Full) are raised in the caller.
+    """
+    def __init__(self, config):
+        #spawn instead of fork: the writers should not inherit the threads of the manager
+        ctx = multiprocessing.get_context('spawn')
+        self._stopping = threading.Event()
+        self._queues = []
+        self._processes = []
+        for i in range(config['writers']):
+            jobs = ctx.Queue(config['queue_size'])
+            process = ctx.Process(target=_writer_main, name=f'wsniff-writer-{i}', daemon=True,
+                                  args=(jobs, config['shard_dir'], config['db_uri'], config['batch_size'], config['mirror']))
+            process.start()
+            self._queues.append(jobs)
+            self._processes.append(process)
+
+    def put(self, writer, item, timeout=None):
+        self._queues[writer].put(item, timeout=timeout)
+
+    def qsize(self):
+        queued = []
+        for jobs in self._queues:
+            try:
+                queued.append(jobs.qsize())
+            except NotImplementedError:
+                #not available on macOS
+                queued.append(None)
+        return queued
+
+    def stop(self):
+        self._stopping.set()
+
+    def _wait(self):
+        self._stopping.wait()
+        for jobs in self._queues:
+            jobs.put(None)
+        for process in self._processes:
+            process.join()
+
+
+class _WriterManager(BaseManager):
+    pass
+
+
+_WriterManager.register('writers')
+
+
+def _helper_main():
+    """
+    Entry point of the helper process: start the writers and serve them to the web workers until stop() is called
+    """
+    config = json.loads(sys.stdin.readline())
+    writers = _Writers(config)
+    _WriterManager.register('writers', callable=lambda: writers)
+    server = _WriterManager(config['address'], bytes.fromhex(config['authkey'])).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    #stdin is closed once the master and all of its workers are gone (e.g. killed without stop())
+    threading.Thread(target=lambda: (sys.stdin.read(), writers.stop()), daemon=True).start()
+    writers._wait()
+
+
+################################## web worker side ###############################################
+
+class ShardDiscovery():
+    """
+    Read-only stand-in for a Discovery model object whose row is stored in a shard.
+    It has the same attributes, so it can be dumped with the usual marshmallow schemas.
+    """
+    def __init__(self, row, sniffer=None):
+        for column, value in zip(['id'] + SHARD_COLUMNS, row):
+            setattr(self, column, value)
+        self.id = to_global_id(self.map_id, self.id)
+        self.timestamp = datetime.fromisoformat(self.timestamp)
+        self.sniffer = sniffer
+
+
+class ShardedIngest():
+    """
+    Extension object (used just like 'db') that routes discovery writes to the writer processes
+    and fans reads out over the shard files
+    """
+    def __init__(self):
+        self.enabled = False
+        self._helper = None
+        self._owner = None
+        self._proxy = None
+        self._proxy_pid = None
+
+    def init_app(self, app):
+        self.enabled = app.config['INGEST_MODE'] == 'sharded'
+        if not self.enabled:
+            return
+        self.shard_dir = os.path.join(app.root_path, app.config['SHARD_DIRECTORY'])
+        self.writers = app.config['SHARD_WRITERS'] or os.cpu_count() or 1
+        self.batch_size = app.config['SHARD_BATCH_SIZE']
+        self.queue_size = app.config['SHARD_QUEUE_SIZE']
+        self.put_timeout = app.config['SHARD_QUEUE_TIMEOUT']
+        #the writers copy the discoveries to the columnar storage themselves (see server/storage.py)
+        self.mirror = None
+        if app.config['STORAGE_BACKEND'] == 'columnar':
+            self.mirror = {'directory': os.path.join(app.root_path, app.config['STORAGE_DIRECTORY']),
+                           'flush_rows': app.config['STORAGE_FLUSH_ROWS'],
+                           'flush_interval': app.config['STORAGE_FLUSH_INTERVAL']}
+        app.extensions['shards'] = self
+
+    def start(self, db_uri=None):
+        """
+        Start the writer processes. db_uri has to be the already resolved URI of the main DB
+        (Flask-SQLAlchemy resolves relative SQLite paths against the app root), default: the one of the current app.
+        """
+        if self._helper is not None:
+            return
+        if db_uri is None:
+            from server import db
+            db_uri = str(db.engine.url)
+        os.makedirs(self.shard_dir, exist_ok=True)
+        #add what is missing in the shards of an older version, before the web workers read them
+        for path in self._shard_files():
+            _open_shard(path).close()
+        #the socket of the manager gets a short path (the length of socket paths is limited)
+        self._socket_dir = tempfile.mkdtemp(prefix='wsniff-')
+        self._address = os.path.join(self._socket_dir, 'writers')
+        self._authkey = os.urandom(32)
+        #the helper only needs the project directory to import this module
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self._helper = subprocess.Popen([sys.executable, '-c', 'from server.sharding import _helper_main; _helper_main()'],
+                                        cwd=root, stdin=subprocess.PIPE, text=True)
+        self._helper.stdin.write(json.dumps({
+            'address': self._address, 'authkey': self._authkey.hex(), 'writers': self.writers,
+            'queue_size': self.queue_size, 'shard_dir': self.shard_dir, 'db_uri': db_uri,
+            'batch_size': self.batch_size, 'mirror': self.mirror}) + '\n')
+        self._helper.stdin.flush()
+        self._owner = os.getpid()
+        #wait until the helper accepts connections
+        while True:
+            try:
+                self._writers()
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self._helper.poll() is not None:
+                    self._helper = None
+                    raise RuntimeError('The helper process of the shard writers exited on startup.')
+                time.sleep(0.05)
+        #make sure everything that is still queued gets committed when the server shuts down
+        atexit.register(self.stop)
+
+    def _writers(self):
+        #the writers (see _Writers) as seen by this process, every process (web worker) needs its own connection
+        if self._proxy_pid != os.getpid():
+            manager = _WriterManager(self._address, self._authkey)
+            manager.connect()
+            self._proxy = manager.writers()
+            self._proxy_pid = os.getpid()
+        return self._proxy
+
+    def stop(self):
+        """
+        Let all writers commit what is still queued and wait for them to exit (only in the process that started them)
+        """
+        if os.getpid() != self._owner or self._helper is None:
+            return
+        self._writers().stop()
+        self._proxy, self._proxy_pid = None, None
+        self._helper.wait()
+        self._helper.stdin.close()
+        self._helper = None
+        shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+    def submit(self, map_id, discovery, sniffer_id):
+        """
+        Hand a (validated, not yet persisted) Discovery object over to the writer owning this map.
+        Raises queue.Full if that writer can't keep up.
+        """
+        if self._helper is None:
+            self.start()
+        item = {column: getattr(discovery, column) for column in SHARD_COLUMNS}
+        item.update(map_id=int(map_id), sniffer_id=sniffer_id, timestamp=discovery.timestamp.isoformat())
+        self._writers().put(int(map_id) % self.writers, item, self.put_timeout)
+
+    def delete_map(self, map_id):
+        """
+        Remove the shard of a deleted map (map ids can be reused by new maps).
+        The writer owning the map does this itself, after the discoveries queued before, which are dropped.
+        """
+        if not self.enabled:
+            return
+        if self._helper is not None:
+            self._writers().put(int(map_id) % self.writers, {'delete_map': int(map_id)})
+        else:
+            _remove_shard(self.shard_dir, map_id)
+
+    def _failed_files(self):
+        return sorted(glob.glob(os.path.join(self.shard_dir, 'failed', 'batch-*.json')))
+
+    def status(self):
+        """
+        Discoveries waiting in the queue of every writer and the batches the writers failed to write (oldest first)
+        """
+        queued = self._writers().qsize() if self._helper is not None else []
+        failed = []
+        for path in self._failed_files():
+            with open(path) as f:
+                batch = json.load(f)
+            discoveries = [item for item in batch['items'] if 'delete_map' not in item]
+            failed.append({'batch': os.path.basename(path)[:-len('.json')], 'time': batch['time'],
+                           'error': batch['error'], 'discoveries': len(discoveries),
+                           'maps': sorted({d['map_id'] for d in discoveries})})
+        return {'writers': self.writers, 'running': self._helper is not None, 'queued': queued, 'failed': failed}
+
+    def retry_failed(self):
+        """
+        Hand the failed batches over to the writers again, returns the number of discoveries
+        """
+        if self._helper is None:
+            self.start()
+        n = 0
+        for path in self._failed_files():
+            with open(path) as f:
+                items = json.load(f)['items']
+            #wait for room in the queues: the batch file is removed once all of its items are queued
+            for item in items:
+                map_id = item['delete_map'] if 'delete_map' in item else item['map_id']
+                self._writers().put(int(map_id) % self.writers, item)
+            os.remove(path)
+            n += sum('delete_map' not in item for item in items)
+        return n
+
+    def _shard_files(self, map_id=None):
+        if map_id is not None:
+            path = shard_file(self.shard_dir, map_id)
+            return [path] if os.path.exists(path) else []
+        return sorted(glob.glob(os.path.join(self.shard_dir, 'map_*.db')))
+
+    def map_ids(self):
+        """
+        Ids of all maps with a shard
+        """
+        if not self.enabled:
+            return []
+        return sorted(int(os.path.basename(path)[len('map_'):-len('.db')]) for path in self._shard_files())
+
+    def version(self, map_id):
+        """
+        Changes whenever a discovery is written to or deleted from the shard of this map (used for caching)
+        """
+        if not self.enabled:
+            return None
+        path = shard_file(self.shard_dir, map_id)
+        #with WAL, new rows first end up in the -wal file
+        return tuple((s.st_mtime_ns, s.st_size) for s in (os.stat(p) for p in (path, path + '-wal') if os.path.exists(p)))
+
+    def rows(self, columns, map_id=None, bbox=None, **filters):
+        """
+        Fan out over the shard files (only the one of map_id if given) and return the given columns
+        of all matching discoveries as plain tuples.
+        bbox: (lat_min, lon_min, lat_max, lon_max)
+        filters: equality conditions on shard columns, e.g. access_point_mac=...
+        """
+        if not self.enabled:
+            return []
+
+        conditions, params = [], []
+        for column, value in filters.items():
+            conditions.append(f'{column} = ?')
+            params.append(value)
+        if bbox:
+            conditions.append('gps_lat >= ? AND gps_lat <= ? AND gps_lon >= ? AND gps_lon <= ?')
+            params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        query = f"SELECT {', '.join(columns)} FROM discovery"
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        rows = []
+        for path in self._shard_files(map_id):
+            conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+            try:
+                rows += conn.execute(query, params).fetchall()
+            finally:
+                conn.close()
+        return rows
+
+    def discoveries(self, map_id=None, bbox=None, **filters):
+        """
+        Like rows(), but returns ShardDiscovery objects which can be dumped like Discovery objects
+        """
+        rows = self.rows(['id'] + SHARD_COLUMNS, map_id, bbox, **filters)
+        if not rows:
+            return []
+
+        #resolve the sniffers with one query instead of one per discovery
+        from server.models import Sniffer
+        sniffer_ids = {row[SHARD_COLUMNS.index('sniffer_id') + 1] for row in rows}
+        sniffers = {s.id: s for s in Sniffer.query.filter(Sniffer.id.in_(sniffer_ids)).all()}
+        result = [ShardDiscovery(row) for row in rows]
+        for d in result:
+            d.sniffer = sniffers.get(d.sniffer_id)
+        return result
+
+    def delete_discovery(self, discovery_id):
+        """
+        Delete a discovery stored in a shard. Returns the deleted discovery (ShardDiscovery) or None if there is none.
+        """
+        ids = from_global_id(discovery_id)
+        if not ids:
+            return None
+        map_id, local_id = ids
+        paths = self._shard_files(map_id)
+        if not paths:
+            return None
+        conn = _open_shard(paths[0])
+        try:
+            with conn:
+                row = conn.execute(f"SELECT {', '.join(['id'] + SHARD_COLUMNS)} FROM discovery WHERE id = ?",
+                                   (local_id,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute('DELETE FROM discovery WHERE id = ?', (local_id,))
+            return ShardDiscovery(row)
+        finally:
+            conn.close()
+
+
+shards = ShardedIngest()
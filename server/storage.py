@@ -0,0 +1,467 @@
+import atexit
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections import Counter
+from threading import Lock, Event, Thread, local
+
+import numpy as np
+from sqlalchemy import func, select, distinct
+
+#duckdb is optional: it's only needed for the columnar backend
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+
+"""
+Storage backends behind the read-heavy map endpoints (viewport, stats, heatmap), selected with STORAGE_BACKEND:
+
+- 'sql' (default): the discovery table through SQLAlchemy, plus the shards and the archive of finalized maps.
+  This is and stays the system of record: every ingest path (POST /maps/<id>, upload sessions, sharded writers,
+  bulk import) writes here first, exactly as before.
+- 'columnar': in addition, every stored discovery is mirrored into an append-only columnar copy: Parquet files per
+  map in STORAGE_DIRECTORY, which DuckDB scans for bounding boxes and aggregates. A scan only reads the two or
+  three columns it needs, while the discovery table has to go through whole rows (and has no index on the
+  position). The copy contains all discoveries of a map, no matter whether they are in the DB, a shard or an archive.
+
+Both implement the same interface (see SQLStorage): ingest (add, remove), viewport queries (viewport) and aggregates
+(counts, signal_points, version). The endpoints read from 'storage.reads', which is the columnar copy only if it is
+selected; the rest of the API (single APs, search, exports, ...) always uses the DB.
+
+Mirrored rows are collected per process and written as a new Parquet file every STORAGE_FLUSH_INTERVAL seconds
+(or STORAGE_FLUSH_ROWS rows), so the columnar reads lag behind by a few seconds. Every file is written once under a
+temporary name and then renamed, so several processes (gunicorn workers, sharded writers) can add files to the same
+map without locking. Deleted discoveries are recorded as tombstones which reads leave out: files with their id, AP
+and timestamp, since SQLite can give the id of a deleted discovery to a new one.
+
+    flask data columnar --rebuild [--map ID]   (copy the discoveries of the DB, e.g. before switching to 'columnar')
+    flask data columnar --compact [--map ID]   (merge the small files of each map, e.g. nightly from cron)
+"""
+
+logger = logging.getLogger(__name__)
+
+#columns of the columnar copy: (numpy type of a batch, type in the files)
+STORAGE_COLUMNS = {
+    'id': (np.int64, 'BIGINT'),
+    'access_point_mac': (np.int64, 'BIGINT'),
+    'channel': (np.int16, 'SMALLINT'),
+    'encryption': (np.int8, 'TINYINT'),
+    'signal_strength': (np.int16, 'SMALLINT'),
+    'ssid': (object, 'VARCHAR'),
+    'timestamp': ('datetime64[us]', 'TIMESTAMP'),
+    'gps_lat': (np.float64, 'DOUBLE'),
+    'gps_lon': (np.float64, 'DOUBLE'),
+    'client_discovery_id': (object, 'VARCHAR'),
+    'sniffer_id': (np.int32, 'INTEGER'),
+    'map_id': (np.int32, 'INTEGER'),
+}
+#a tombstone only matches the deleted discovery, not a later one which got the same id
+TOMBSTONE_COLUMNS = ['id', 'access_point_mac', 'timestamp']
+
+
+def row_of(discovery):
+    """
+    The row of a (committed) Discovery object, as mirrored by add()
+    """
+    return {column: getattr(discovery, column) for column in STORAGE_COLUMNS}
+
+
+def viewport_bbox(args):
+    """
+    (lat_min, lon_min, lat_max, lon_max) of a viewport request with the query parameters lat1, lon1, lat2, lon2
+    (GET /maps/<id>/aps, Flask and ASGI). Raises ValueError if they are missing or not numbers.
+    """
+    values = [args.get(name) for name in ('lat1', 'lon1', 'lat2', 'lon2')]
+    if not all(values):
+        raise ValueError()
+    lat1, lon1, lat2, lon2 = [float(value) for value in values]
+    return min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2)
+
+
+def _discoveries(rows):
+    """
+    Read-only stand-ins for Discovery objects (which can be dumped with the usual schemas), with their sniffers
+    resolved by one query instead of one per discovery
+    """
+    from server.archive import ArchivedDiscovery
+    from server.models import Sniffer
+    if not rows:
+        return []
+    sniffers = {s.id: s for s in Sniffer.query.filter(Sniffer.id.in_({row['sniffer_id'] for row in rows})).all()}
+    return [ArchivedDiscovery(row, row['map_id'], sniffers.get(row['sniffer_id'])) for row in rows]
+
+
+class SQLStorage():
+    """
+    The discovery table (and the shards and archives, like the endpoints always did)
+    """
+    name = 'sql'
+
+    def add(self, rows):
+        """
+        Ingest: called with the rows of discoveries after they were committed to the DB
+        (nothing to do here, the endpoints write the DB themselves)
+        """
+
+    def remove(self, map_id, rows=None):
+        """
+        Ingest: called after discoveries (their rows, see row_of()) or all discoveries of a map (rows=None) were
+        deleted from the DB
+        """
+
+    def viewport(self, map_id, bbox):
+        """
+        The discoveries of the map within bbox (lat_min, lon_min, lat_max, lon_max) as objects for the schemas
+        """
+        from server.models import Discovery
+        from server.sharding import shards
+        from server.archive import archive
+
+        discoveries = Discovery.query.filter_by(map_id=map_id).filter(
+            Discovery.gps_lat >= bbox[0], Discovery.gps_lat <= bbox[2],
+            Discovery.gps_lon >= bbox[1], Discovery.gps_lon <= bbox[3]).all()
+        discoveries += shards.discoveries(map_id=map_id, bbox=bbox)
+        discoveries += archive.discoveries(map_id, bbox=bbox)
+        return discoveries
+
+    def counts(self, map_id, bbox=None):
+        """
+        Number of discoveries of the map (within bbox), number of different APs and APs per OUI (Counter)
+        """
+        from server import db
+        from server.models import Discovery, AccessPoint
+        from server.sharding import shards
+        from server.archive import archive
+
+        inside = [Discovery.map_id == map_id]
+        if bbox:
+            inside += [Discovery.gps_lat.between(bbox[0], bbox[2]), Discovery.gps_lon.between(bbox[1], bbox[3])]
+        n_discoveries = db.session.query(func.count(Discovery.id)).filter(*inside).scalar()
+        #the DB counts the APs per vendor prefix itself (access_point.oui), no need to load all MACs
+        ouis = Counter(dict(db.session.query(AccessPoint.oui, func.count(distinct(Discovery.access_point_mac)))
+                            .join(AccessPoint, AccessPoint.mac == Discovery.access_point_mac)
+                            .filter(*inside).group_by(AccessPoint.oui)))
+
+        shard_macs = np.array([mac for mac, in shards.rows(['access_point_mac'], map_id, bbox)], dtype=np.int64)
+        archived_macs, = archive.columns(map_id, ['access_point_mac'], bbox)
+        other = np.concatenate([shard_macs, np.asarray(archived_macs, dtype=np.int64)])
+        n_discoveries += len(other)
+        other = np.unique(other)
+        if len(other) and ouis:
+            #rarely, an AP is in the DB and in a shard or archive as well (e.g. discoveries added to a finalized map)
+            known = np.array([mac for mac, in db.session.query(Discovery.access_point_mac).filter(*inside).distinct()],
+                             dtype=np.int64)
+            other = np.setdiff1d(other, known, assume_unique=True)
+        prefixes, n = np.unique(other >> 24, return_counts=True)
+        ouis.update(dict(zip(prefixes.tolist(), n.tolist())))
+        return n_discoveries, sum(ouis.values()), ouis
+
+    def signal_points(self, map_id, bbox=None, mac=None):
+        """
+        lat, lon and signal strength of all matching discoveries of this map as numpy arrays
+        (without creating ORM objects for them)
+        """
+        from server import db
+        from server.models import Discovery
+        from server.sharding import shards
+        from server.archive import archive
+
+        stmt = select(Discovery.gps_lat, Discovery.gps_lon, Discovery.signal_strength).where(Discovery.map_id == map_id)
+        filters = {}
+        if mac is not None:
+            stmt = stmt.where(Discovery.access_point_mac == mac)
+            filters['access_point_mac'] = mac
+        if bbox:
+            stmt = stmt.where(Discovery.gps_lat >= bbox[0], Discovery.gps_lat <= bbox[2],
+                              Discovery.gps_lon >= bbox[1], Discovery.gps_lon <= bbox[3])
+
+        #convert the result in parts, so we never hold all rows as python tuples at once: stream_results fetches them
+        #part by part (server side cursor with PostgreSQL/MySQL, SQLite steps through the result anyway) instead of
+        #loading the whole result into the driver first (yield_per for Core statements needs SQLAlchemy 1.4.40)
+        result = db.session.execute(stmt.execution_options(stream_results=True))
+        parts = [np.array(part, dtype=np.float64) for part in result.partitions(100000)]
+        parts.append(np.array(shards.rows(['gps_lat', 'gps_lon', 'signal_strength'], map_id, bbox, **filters),
+                              dtype=np.float64).reshape(-1, 3))
+        parts.append(np.column_stack(archive.columns(map_id, ['gps_lat', 'gps_lon', 'signal_strength'], bbox, **filters))
+                     .astype(np.float64))
+        points = np.concatenate([part.reshape(-1, 3) for part in parts])
+        return points[:, 0], points[:, 1], points[:, 2]
+
+    def version(self, map_id):
+        """
+        Changes whenever discoveries are added to or removed from the map (used for caching)
+        """
+        from server import db
+        from server.models import Discovery, WardrivingMap
+        from server.sharding import shards
+
+        count, last = db.session.query(func.count(Discovery.id), func.max(Discovery.id)) \
+            .filter(Discovery.map_id == map_id).one()
+        archived, = db.session.query(WardrivingMap.archived).filter(WardrivingMap.id == map_id).one()
+        return (count, last, shards.version(map_id), archived)
+
+
+class ColumnarStorage():
+    """
+    Append-only Parquet files per map (STORAGE_DIRECTORY/map_<id>/), read with DuckDB
+    """
+    name = 'columnar'
+
+    def __init__(self, directory, flush_rows=10000, flush_interval=5.0):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._lock = Lock()
+        #only one flush at a time, so the files of a process are written in order
+        self._flush_lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+        #DuckDB connections must not be shared by threads, but cursors of one in-memory DB are cheap
+        self._db = duckdb.connect() if duckdb is not None else None
+        self._local = local()
+
+    def path(self, map_id):
+        return os.path.join(self.directory, f'map_{int(map_id)}')
+
+    def _files(self, map_id, prefix='part'):
+        path = self.path(map_id)
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(path, name) for name in names if name.startswith(prefix + '-') and name.endswith('.parquet'))
+
+    def _cursor(self):
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self._local.cursor = self._db.cursor()
+        return cursor
+
+    ################################## ingest ######################################################
+
+    def add(self, rows):
+        """
+        Buffer the rows (see STORAGE_COLUMNS) of committed discoveries; they are written by a background thread
+        """
+        if not rows:
+            return
+        with self._lock:
+            self._pending.extend(rows)
+            n = len(self._pending)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='columnar-mirror', daemon=True)
+                self._thread.start()
+                #whatever is still waiting is written when the process exits
+                atexit.register(self.flush)
+        if n >= self.flush_rows:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing the columnar copy of the discoveries failed.')
+
+    def flush(self):
+        """
+        Write all buffered rows now (one file per map)
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            by_map = {}
+            for row in batch:
+                by_map.setdefault(int(row['map_id']), []).append(row)
+            #a map whose file can't be written doesn't keep the others from being written
+            failed, error = [], None
+            for map_id, rows in by_map.items():
+                try:
+                    self.write(map_id, rows)
+                except Exception as e:
+                    failed += rows
+                    error = e
+            if error is not None:
+                #keep the rows and try again next time
+                with self._lock:
+                    self._pending[:0] = failed
+                raise error
+
+    def write(self, map_id, rows, prefix='part', sort=False):
+        """
+        Write rows (dicts) of one map as a new file right away
+        """
+        columns = {column: np.array([row[column] for row in rows], dtype=dtype)
+                   for column, (dtype, _) in STORAGE_COLUMNS.items()}
+        self._write(map_id, columns, prefix, sort)
+
+    def _write(self, map_id, columns, prefix='part', sort=False):
+        os.makedirs(self.path(map_id), exist_ok=True)
+        #the names sort by time, so compact() can tell the files apart that were added while it ran
+        name = f'{prefix}-{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}.parquet'
+        tmp = os.path.join(self.path(map_id), '.' + name + '.tmp')
+        #the same types in every file, even if a batch only contains NULLs in a column.
+        #DuckDB can't scan large object arrays without any value (e.g. client_discovery_id of shard rows)
+        empty = {column for column, values in columns.items() if values.dtype == object and
+                 all(value is None for value in values)}
+        select = ', '.join(f'CAST({"NULL" if column in empty else column} AS {STORAGE_COLUMNS[column][1]}) AS {column}'
+                           for column in columns)
+        columns = {column: values for column, values in columns.items() if column not in empty}
+        #sorted by latitude, the row groups of a file can be skipped by bounding box queries
+        order = ' ORDER BY gps_lat' if sort else ''
+        cursor = self._cursor()
+        view = 'batch_' + uuid.uuid4().hex
+        cursor.register(view, columns)
+        try:
+            cursor.execute(f"COPY (SELECT {select} FROM {view}{order}) TO '{tmp}' (FORMAT parquet)")
+        finally:
+            cursor.unregister(view)
+        os.replace(tmp, os.path.join(self.path(map_id), name))
+
+    def remove(self, map_id, rows=None):
+        """
+        Delete single discoveries (their rows, tombstones) or the whole copy of a map (rows=None)
+        """
+        ids = None if rows is None else {row['id'] for row in rows}
+        with self._lock:
+            self._pending = [row for row in self._pending if int(row['map_id']) != int(map_id) or
+                             (ids is not None and row['id'] not in ids)]
+        if rows is None:
+            shutil.rmtree(self.path(map_id), ignore_errors=True)
+        elif rows:
+            self._write(map_id, {column: np.array([row[column] for row in rows], dtype=STORAGE_COLUMNS[column][0])
+                                 for column in TOMBSTONE_COLUMNS}, prefix='deleted')
+
+    def rebuild(self, map_id, chunks):
+        """
+        Replace the copy of a map with the given rows (iterable of lists of row dicts)
+        """
+        self.remove(map_id)
+        for rows in chunks:
+            if rows:
+                self.write(map_id, rows)
+
+    def compact(self, map_id):
+        """
+        Merge all files of the map into one (sorted by latitude, without the deleted discoveries).
+        Returns the number of files merged.
+        NOTE: a read running at the very moment the old files are replaced can see the rows twice or fail,
+        so run this when there is little traffic.
+        """
+        parts, tombstones = self._files(map_id), self._files(map_id, 'deleted')
+        if len(parts) + len(tombstones) <= 1:
+            return 0
+        tmp = os.path.join(self.path(map_id), f'.compact-{uuid.uuid4().hex[:8]}.tmp')
+        query, params = self._query(map_id, ', '.join(STORAGE_COLUMNS), parts=parts, tombstones=tombstones)
+        self._cursor().execute(f"COPY ({query} ORDER BY gps_lat) TO '{tmp}' (FORMAT parquet)", params)
+        #named like the newest merged file, so it keeps its place among the files written in the meantime
+        newest = os.path.basename(parts[-1]) if parts else f'part-{time.time_ns():020d}-{os.getpid()}-0.parquet'
+        os.replace(tmp, os.path.join(self.path(map_id), newest))
+        for path in parts[:-1] + tombstones:
+            os.remove(path)
+        return len(parts) + len(tombstones)
+
+    ################################## reads #######################################################
+
+    def _query(self, map_id, columns, bbox=None, mac=None, parts=None, tombstones=None):
+        """
+        SQL and parameters of a scan over the files of a map; None if there are none
+        """
+        parts = self._files(map_id) if parts is None else parts
+        if not parts:
+            return None, None
+        tombstones = self._files(map_id, 'deleted') if tombstones is None else tombstones
+        conditions, params = [], [parts]
+        if bbox:
+            conditions.append('gps_lat BETWEEN ? AND ? AND gps_lon BETWEEN ? AND ?')
+            params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if mac is not None:
+            conditions.append('access_point_mac = ?')
+            params.append(int(mac))
+        if tombstones:
+            conditions.append('NOT EXISTS (SELECT 1 FROM read_parquet(?) AS t WHERE ' +
+                              ' AND '.join(f't.{column} = d.{column}' for column in TOMBSTONE_COLUMNS) + ')')
+            params.append(tombstones)
+        query = f'SELECT {columns} FROM read_parquet(?) AS d'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return query, params
+
+    def viewport(self, map_id, bbox):
+        query, params = self._query(map_id, ', '.join(STORAGE_COLUMNS), bbox)
+        if query is None:
+            return []
+        cursor = self._cursor().execute(query, params)
+        names = [d[0] for d in cursor.description]
+        return _discoveries([dict(zip(names, row)) for row in cursor.fetchall()])
+
+    def counts(self, map_id, bbox=None):
+        query, params = self._query(map_id, 'access_point_mac', bbox)
+        if query is None:
+            return 0, 0, Counter()
+        count, = self._cursor().execute(f'SELECT count(*) FROM ({query})', params).fetchone()
+        ouis = Counter(dict(self._cursor().execute(
+            f'SELECT access_point_mac >> 24, count(DISTINCT access_point_mac) FROM ({query}) GROUP BY 1', params).fetchall()))
+        return count, sum(ouis.values()), ouis
+
+    def signal_points(self, map_id, bbox=None, mac=None):
+        query, params = self._query(map_id, 'gps_lat, gps_lon, signal_strength', bbox, mac)
+        if query is None:
+            return np.array([]), np.array([]), np.array([])
+        points = self._cursor().execute(query, params).fetchnumpy()
+        return (np.asarray(points['gps_lat'], dtype=np.float64), np.asarray(points['gps_lon'], dtype=np.float64),
+                np.asarray(points['signal_strength'], dtype=np.float64))
+
+    def version(self, map_id):
+        #files are only ever added, replaced or deleted as a whole
+        return tuple(os.path.basename(path) for path in self._files(map_id) + self._files(map_id, 'deleted'))
+
+
+class Storage():
+    """
+    Extension object (used just like 'db'): the backend the endpoints read from, and the mirror the ingest writes to
+    """
+    def __init__(self):
+        self.sql = SQLStorage()
+        self.columnar = None
+        self.reads = self.sql
+
+    def init_app(self, app):
+        #rows waiting for the copy of another app (e.g. in tests) have to go there first
+        if self.columnar is not None:
+            self.columnar.flush()
+        self.columnar, self.reads = None, self.sql
+        if app.config['STORAGE_BACKEND'] == 'columnar':
+            if duckdb is None:
+                raise RuntimeError("STORAGE_BACKEND = 'columnar' needs duckdb (pip install duckdb).")
+            self.columnar = ColumnarStorage(os.path.join(app.root_path, app.config['STORAGE_DIRECTORY']),
+                                            app.config['STORAGE_FLUSH_ROWS'], app.config['STORAGE_FLUSH_INTERVAL'])
+            self.reads = self.columnar
+        app.extensions['storage'] = self
+
+    def viewport(self, visibility, map_id, bbox):
+        """
+        The discoveries of the map within bbox which the user may see (visibility, see server/acl.py),
+        read from the backend of the endpoints
+        """
+        #on a geofenced map, only the part of the viewport within the fence is visible
+        areas = visibility.bboxes(map_id, bbox)
+        return self.reads.viewport(map_id, areas[0]) if areas else []
+
+    def add(self, rows):
+        if self.columnar is not None:
+            self.columnar.add(rows)
+
+    def remove(self, map_id, rows=None):
+        if self.columnar is not None:
+            self.columnar.remove(map_id, rows)
+
+
+storage = Storage()
@@ -0,0 +1,323 @@
+import time
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import bindparam
+
+from server.ingest import update_contributions
+from server.models import Encryption
+from server.oui import oui_of
+from server.search import trigrams
+
+
+"""
+Deterministic synthetic wardriving data for scale tests (flask data synthetic, tests/test_scale.py, benchmarks/scale.py).
+The same seed and sizes always produce exactly the same rows, so timings of different commits are comparable.
+
+- APs are clustered like the buildings of a town: the cluster centers are spread around CENTER, the cluster
+  sizes follow a power law (a few dense city blocks, many small villages) and the APs of a cluster are normally
+  distributed around its center
+- the MAC addresses follow a realistic vendor mix: mostly the big router vendors of the builtin OUI list, some
+  unknown vendors and some randomized (locally administered) MACs of phone hotspots, with matching SSIDs
+- sniffers drive routes through the clusters (more popular clusters are visited more often) with one GPS fix
+  per second; at every fix they see some of the APs nearby with a signal strength falling off with the distance
+  (log-distance path loss plus shadowing noise)
+- an AP next to the road is seen at several consecutive fixes and by later drives, so most APs are discovered
+  many times, like in real maps
+"""
+
+#the synthetic town
+CENTER = (49.4521, 11.0767)
+START = datetime(2021, 6, 1, 8, 0)
+
+METERS_PER_DEGREE = 111320.0
+#size of the grid cells used to find the APs around a GPS fix [m]
+CELL_SIZE = 150.0
+#candidate APs looked at per fix (a scan sees a few dozen APs at most)
+CANDIDATES_PER_FIX = 24
+#path loss model: RSSI = TX_POWER - 10 * PATH_LOSS_EXPONENT * log10(distance) + N(0, SHADOWING)
+TX_POWER = -30.0
+PATH_LOSS_EXPONENT = 2.7
+SHADOWING = 4.0
+MIN_RSSI = -95
+
+#(OUI, weight, SSID pattern); {n} is replaced by a random number, {x} by random hex digits
+VENDORS = [
+    (0x00040E, 6, 'FRITZ!Box 7490'),
+    (0xC80E14, 10, 'FRITZ!Box 7590 {x}'),
+    (0x3810D5, 8, 'FRITZ!Box 7530 {x}'),
+    (0x7CFF4D, 6, 'FRITZ!Box 6660 Cable {x}'),
+    (0xF09FC2, 4, 'Cafe {n}'),
+    (0x24A43C, 3, 'Guest'),
+    (0x00180A, 3, 'eduroam'),
+    (0x001A11, 2, 'Google Wifi {n}'),
+    (0xB827EB, 1, 'raspi-{x}'),
+    (0xDCA632, 1, 'pi-hole'),
+    (0x001788, 1, 'Hue Bridge {n}'),
+    (0x008041, 0.1, 'ROBOTRON'),
+]
+#unknown vendors (random OUIs) and randomized MACs of hotspots
+OTHER_VENDORS = [
+    (None, 30, ['WLAN-{n}', 'Vodafone-{x}', 'o2-WLAN{n}', 'TP-Link_{x}', 'NETGEAR{n}', 'Telekom_FON']),
+    ('random', 8, ['AndroidAP_{n}', 'iPhone {n}', 'DIRECT-{x}-HP Printer', 'Galaxy S{n}']),
+]
+#share of hidden SSIDs
+HIDDEN = 0.04
+
+ENCRYPTIONS = [Encryption.WPA2, Encryption.WPA, Encryption.OPEN, Encryption.WEP]
+ENCRYPTION_WEIGHTS = [0.8, 0.08, 0.08, 0.04]
+CHANNELS = [1, 6, 11, 2, 3, 4, 5, 7, 8, 9, 10, 12, 13, 36, 40, 44, 48, 100, 104, 108, 112, 116]
+CHANNEL_WEIGHTS = [22, 22, 20] + [1.5] * 10 + [3] * 4 + [1] * 5
+
+
+def _normalize(weights):
+    weights = np.asarray(weights, dtype=float)
+    return weights / weights.sum()
+
+
+class SyntheticDataset():
+    """
+    The APs of a synthetic town and the discoveries of sniffers driving through it
+    aps: number of APs, sniffers: number of sniffers, discoveries per AP are roughly discoveries / aps
+    """
+    def __init__(self, aps, sniffers=1, seed=0):
+        self.seed = seed
+        self.n_sniffers = sniffers
+        rng = np.random.default_rng(seed)
+        self._lon_scale = np.cos(np.radians(CENTER[0]))
+
+        #clusters: a few large ones, many small ones
+        n_clusters = max(3, aps // 400)
+        sizes = rng.pareto(1.2, n_clusters) + 1
+        cluster = rng.choice(n_clusters, aps, p=_normalize(sizes))
+        #spread [m] of the cluster centers around the town and of the APs around their cluster center
+        centers = rng.normal(0, 4000, (n_clusters, 2))
+        spread = rng.uniform(60, 400, n_clusters)
+        self.cluster_centers = centers
+        self.cluster_weights = _normalize(np.bincount(cluster, minlength=n_clusters))
+        offsets = centers[cluster] + rng.normal(0, 1, (aps, 2)) * spread[cluster, None]
+        self.lat, self.lon = self._to_degrees(offsets)
+        self._x, self._y = offsets[:, 0], offsets[:, 1]
+
+        self.mac, self.ssid = self._vendor_mix(rng, aps)
+        self.encryption = rng.choice(ENCRYPTIONS, aps, p=_normalize(ENCRYPTION_WEIGHTS)).astype(np.int64)
+        self.channel = rng.choice(CHANNELS, aps, p=_normalize(CHANNEL_WEIGHTS)).astype(np.int64)
+        #some APs are stronger than others (antenna, placement, walls)
+        self.tx_power = TX_POWER + rng.normal(0, 3, aps)
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.mac)
+
+    def _to_degrees(self, offsets):
+        return (CENTER[0] + offsets[:, 1] / METERS_PER_DEGREE,
+                CENTER[1] + offsets[:, 0] / (METERS_PER_DEGREE * self._lon_scale))
+
+    def _vendor_mix(self, rng, n):
+        vendors = VENDORS + OTHER_VENDORS
+        vendor = rng.choice(len(vendors), n, p=_normalize([v[1] for v in vendors]))
+        known = np.array([v[0] if isinstance(v[0], int) else 0 for v in vendors], dtype=np.int64)
+
+        oui = known[vendor]
+        unknown = vendor == len(VENDORS)
+        #random OUIs, but globally administered and unicast
+        oui[unknown] = rng.integers(0, 1 << 24, unknown.sum()) & ~0x030000
+        randomized = vendor == len(VENDORS) + 1
+        oui[randomized] = (rng.integers(0, 1 << 24, randomized.sum()) | 0x020000) & ~0x010000
+
+        #unique MACs: draw the lower half until there are no duplicates left
+        mac = (oui << 24) | rng.integers(0, 1 << 24, n)
+        while True:
+            _, first = np.unique(mac, return_index=True)
+            duplicate = np.setdiff1d(np.arange(n), first)
+            if not len(duplicate):
+                break
+            mac[duplicate] = (oui[duplicate] << 24) | rng.integers(0, 1 << 24, len(duplicate))
+
+        numbers = rng.integers(1, 9999, n)
+        hexes = rng.integers(0, 1 << 16, n)
+        choices = rng.integers(0, 1 << 16, n)
+        hidden = rng.random(n) < HIDDEN
+        ssid = []
+        for i in range(n):
+            if hidden[i]:
+                ssid.append(None)
+                continue
+            pattern = vendors[vendor[i]][2]
+            if isinstance(pattern, list):
+                pattern = pattern[choices[i] % len(pattern)]
+            ssid.append(pattern.format(n=numbers[i], x=f'{hexes[i]:04X}'))
+        return mac, ssid
+
+    ################################## spatial lookup ##############################################
+
+    def _cells(self, x, y):
+        return np.floor(x / CELL_SIZE).astype(np.int64) * (1 << 32) + np.floor(y / CELL_SIZE).astype(np.int64)
+
+    def _build_grid(self):
+        #APs sorted by grid cell; the APs of a cell are a contiguous slice of self._order
+        cells = self._cells(self._x, self._y)
+        self._order = np.argsort(cells, kind='stable')
+        self._cell_keys, self._cell_starts, self._cell_counts = np.unique(cells[self._order], return_index=True,
+                                                                          return_counts=True)
+
+    def _sightings(self, rng, x, y):
+        """
+        The APs seen at the fixes (x, y): (fix index, AP index, RSSI) with one sighting per fix and AP
+        """
+        n = len(x)
+        fix = np.repeat(np.arange(n), CANDIDATES_PER_FIX)
+        #a random cell of the 3x3 cells around the fix, then a random AP of that cell
+        dx = rng.integers(-1, 2, len(fix))
+        dy = rng.integers(-1, 2, len(fix))
+        cells = self._cells(x[fix] + dx * CELL_SIZE, y[fix] + dy * CELL_SIZE)
+        position = np.minimum(np.searchsorted(self._cell_keys, cells), len(self._cell_keys) - 1)
+        found = self._cell_keys[position] == cells
+        pick = rng.random(len(fix))
+        fix, position, pick = fix[found], position[found], pick[found]
+        ap = self._order[self._cell_starts[position] + (pick * self._cell_counts[position]).astype(np.int64)]
+
+        distance = np.maximum(np.hypot(self._x[ap] - x[fix], self._y[ap] - y[fix]), 1.0)
+        rssi = (self.tx_power[ap] - 10 * PATH_LOSS_EXPONENT * np.log10(distance) +
+                rng.normal(0, SHADOWING, len(ap)))
+        seen = rssi >= MIN_RSSI
+        fix, ap, rssi = fix[seen], ap[seen], np.minimum(np.round(rssi[seen]), -20).astype(np.int64)
+        #the same AP drawn twice for a fix is only one sighting
+        _, unique = np.unique(fix * len(self) + ap, return_index=True)
+        return fix[unique], ap[unique], rssi[unique]
+
+    ################################## drives ######################################################
+
+    def _drive(self, rng, started):
+        """
+        One drive along a few clusters: returns the sightings as dict of arrays and the time the drive ended
+        """
+        stops = rng.choice(len(self.cluster_centers), rng.integers(2, 8), p=self.cluster_weights)
+        #drive through the clusters, not exactly through their centers
+        waypoints = self.cluster_centers[stops] + rng.normal(0, 150, (len(stops), 2))
+        speed = rng.uniform(7, 14)
+
+        xs, ys = [], []
+        for a, b in zip(waypoints[:-1], waypoints[1:]):
+            steps = max(1, int(np.hypot(*(b - a)) / speed))
+            t = np.arange(steps) / steps
+            xs.append(a[0] + (b[0] - a[0]) * t)
+            ys.append(a[1] + (b[1] - a[1]) * t)
+        x, y = np.concatenate(xs), np.concatenate(ys)
+        #GPS noise
+        x, y = x + rng.normal(0, 5, len(x)), y + rng.normal(0, 5, len(y))
+
+        fix, ap, rssi = self._sightings(rng, x, y)
+        lat, lon = self._to_degrees(np.column_stack([x[fix], y[fix]]))
+        timestamp = np.datetime64(started, 'us') + (fix * 1000000).astype('timedelta64[us]')
+        sightings = {'ap': ap, 'signal_strength': rssi, 'gps_lat': lat, 'gps_lon': lon, 'timestamp': timestamp,
+                     'sniffer': np.full(len(ap), rng.integers(self.n_sniffers), dtype=np.int64)}
+        return sightings, started + np.timedelta64(len(x), 's')
+
+    def discoveries(self, n, chunk_size=10000):
+        """
+        Generate n discoveries in chunks of (at most) chunk_size: dicts of arrays with the AP index, sniffer index,
+        signal_strength, gps_lat, gps_lon and timestamp (sorted by time). The chunk size doesn't change the data.
+        """
+        rng = np.random.default_rng([self.seed, 1])
+        started = np.datetime64(START, 'us')
+        buffered, size = [], 0
+        while n > 0:
+            sightings, ended = self._drive(rng, started)
+            #the next drive starts some hours later
+            started = ended + np.timedelta64(int(rng.exponential(6 * 3600)), 's')
+            buffered.append(sightings)
+            size += len(sightings['ap'])
+            while size >= min(chunk_size, n) and n > 0:
+                joined = {key: np.concatenate([b[key] for b in buffered]) for key in buffered[0]}
+                take = min(chunk_size, n)
+                yield {key: values[:take] for key, values in joined.items()}
+                n -= take
+                buffered, size = [{key: values[take:] for key, values in joined.items()}], size - take
+
+    def ap_rows(self, indices=None):
+        """
+        Rows of the access_point table for these APs (at their true position)
+        """
+        indices = np.arange(len(self)) if indices is None else indices
+        return [{'mac': mac, 'oui': oui_of(mac), 'last_ssid': self.ssid[i], 't_last_seen': START,
+                 'last_encryption': encryption, 'last_channel': channel, 'gps_lat': lat, 'gps_lon': lon}
+                for i, mac, encryption, channel, lat, lon in zip(
+                    indices.tolist(), self.mac[indices].tolist(), self.encryption[indices].tolist(),
+                    self.channel[indices].tolist(), self.lat[indices].tolist(), self.lon[indices].tolist())]
+
+    def discovery_rows(self, chunk, map_id, sniffer_ids):
+        """
+        Rows of the discovery table for a chunk of discoveries()
+        """
+        ap = chunk['ap']
+        return [{'access_point_mac': mac, 'channel': channel, 'encryption': encryption, 'signal_strength': rssi,
+                 'ssid': self.ssid[i], 'timestamp': timestamp, 'gps_lat': lat, 'gps_lon': lon,
+                 'sniffer_id': sniffer_ids[sniffer], 'map_id': map_id}
+                for i, mac, channel, encryption, rssi, timestamp, lat, lon, sniffer in zip(
+                    ap.tolist(), self.mac[ap].tolist(), self.channel[ap].tolist(), self.encryption[ap].tolist(),
+                    chunk['signal_strength'].tolist(), chunk['timestamp'].astype(object).tolist(),
+                    chunk['gps_lat'].tolist(), chunk['gps_lon'].tolist(), chunk['sniffer'].tolist())]
+
+
+def load(engine, map_id, sniffer_ids, discoveries, aps=None, seed=0, chunk_size=10000, progress=None):
+    """
+    Bulk load a synthetic dataset into the map with SQLAlchemy core (one transaction per chunk):
+    the APs with their search index, the discoveries and the contribution counters of the sniffers.
+    aps: number of APs (default: one per 20 discoveries), progress: called with the number of loaded discoveries
+    Returns the dataset and the timings [s] of the phases; dataset.loaded are the indices of the APs in the DB.
+    """
+    from server.models import AccessPoint, Discovery, SSIDTrigram
+    ap_table, discovery_table, trigram_table = AccessPoint.__table__, Discovery.__table__, SSIDTrigram.__table__
+    timings = {}
+
+    started = time.perf_counter()
+    dataset = SyntheticDataset(aps or max(100, discoveries // 20), len(sniffer_ids), seed)
+    timings['generate_aps'] = time.perf_counter() - started
+
+    #the APs have to exist before their discoveries (foreign key)
+    started = time.perf_counter()
+    for first in range(0, len(dataset), chunk_size):
+        rows = dataset.ap_rows(np.arange(first, min(first + chunk_size, len(dataset))))
+        with engine.begin() as conn:
+            conn.execute(ap_table.insert(), rows)
+            trigram_rows = [{'mac': row['mac'], 'trigram': t} for row in rows for t in trigrams(row['last_ssid'])]
+            if trigram_rows:
+                conn.execute(trigram_table.insert(), trigram_rows)
+    timings['aps'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    #AP index -> row of its latest discovery
+    last_seen = {}
+    loaded = 0
+    for chunk in dataset.discoveries(discoveries, chunk_size):
+        rows = dataset.discovery_rows(chunk, map_id, sniffer_ids)
+        with engine.begin() as conn:
+            conn.execute(discovery_table.insert(), rows)
+            update_contributions(conn, rows)
+        #the chunks are sorted by time, so later rows win
+        for i, row in zip(chunk['ap'].tolist(), rows):
+            last_seen[i] = row
+        loaded += len(rows)
+        if progress:
+            progress(loaded)
+    timings['discoveries'] = time.perf_counter() - started
+
+    #"last seen" of the APs as if every discovery had been applied; APs nobody drove by are removed again
+    started = time.perf_counter()
+    update = ap_table.update().where(ap_table.c.mac == bindparam('b_mac')) \
+        .values(t_last_seen=bindparam('t_last_seen'), gps_lat=bindparam('gps_lat'), gps_lon=bindparam('gps_lon'))
+    rows = [{'b_mac': row['access_point_mac'], 't_last_seen': row['timestamp'], 'gps_lat': row['gps_lat'],
+             'gps_lon': row['gps_lon']} for _, row in sorted(last_seen.items())]
+    for first in range(0, len(rows), chunk_size):
+        with engine.begin() as conn:
+            conn.execute(update, rows[first:first + chunk_size])
+    unseen = [mac for i, mac in enumerate(dataset.mac.tolist()) if i not in last_seen]
+    for first in range(0, len(unseen), chunk_size):
+        with engine.begin() as conn:
+            part = unseen[first:first + chunk_size]
+            conn.execute(trigram_table.delete().where(trigram_table.c.mac.in_(part)))
+            conn.execute(ap_table.delete().where(ap_table.c.mac.in_(part)))
+    timings['finish_aps'] = time.perf_counter() - started
+    dataset.loaded = np.array(sorted(last_seen), dtype=np.int64)
+    return dataset, timings
@@ -0,0 +1,146 @@
+import atexit
+import logging
+from threading import Lock, Event, Thread
+
+from sqlalchemy import bindparam
+
+
+"""
+Write-behind of the "last seen" values of the APs (AP_WRITE_BEHIND):
+most discoveries of a known AP change nothing but t_last_seen and the GPS position of the AP, yet every one of them
+would rewrite its access_point row - ten sniffers reporting the same AP within a second mean ten updates
+of the same row, all of them waiting for each other's locks.
+
+Instead, these values are collected in memory per MAC address (a newer discovery just replaces the waiting values)
+and written every AP_WRITE_BEHIND_INTERVAL seconds with one batched UPDATE. Discoveries that change a tracked
+attribute of the AP (SSID, encryption, channel) and new APs are still written right away, together with the
+change log and the search index. The discoveries themselves are always committed before the response is sent,
+so a crash can only lose the last seconds of "last seen" updates, never a discovery.
+
+If AP_WRITE_BEHIND_READS is set, the API shows the waiting values of this process when it returns APs.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class APWriteBehind():
+    """
+    Extension object buffering the "last seen" updates of the APs (used just like 'db')
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reads = False
+        #mac -> {'t_last_seen': ..., 'gps_lat': ..., 'gps_lon': ...}
+        self._pending = {}
+        self._lock = Lock()
+        #only one flush at a time, so an older batch can never be written after a newer one
+        self._flush_lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+        self._app = None
+
+    def init_app(self, app):
+        #values waiting for the DB of another app (e.g. in tests) have to go there first
+        if self._app is not None:
+            self.flush()
+        self.enabled = app.config['AP_WRITE_BEHIND']
+        self.reads = self.enabled and app.config['AP_WRITE_BEHIND_READS']
+        self.interval = app.config['AP_WRITE_BEHIND_INTERVAL']
+        self.max_pending = app.config['AP_WRITE_BEHIND_MAX_PENDING']
+        self._app = app
+        app.extensions['ap_write_behind'] = self
+
+    def can_defer(self, ap, discovery):
+        """
+        Can the update of this (existing) AP by the discovery be written later?
+        Only if it doesn't change any attribute that is tracked in the change log or indexed.
+        """
+        return (self.enabled and ap.t_last_seen is not None and ap.last_ssid == discovery.ssid and
+                ap.last_encryption == discovery.encryption and ap.last_channel == discovery.channel)
+
+    def submit(self, discovery):
+        """
+        Buffer the "last seen" values of this discovery for its AP. Call this only after the discovery
+        has been committed, and only if can_defer() said so.
+        """
+        values = {'t_last_seen': discovery.timestamp, 'gps_lat': discovery.gps_lat, 'gps_lon': discovery.gps_lon}
+        with self._lock:
+            current = self._pending.get(discovery.access_point_mac)
+            #coalesce: of all discoveries waiting for the same AP, only the latest one is written
+            if current is None or current['t_last_seen'] <= values['t_last_seen']:
+                self._pending[discovery.access_point_mac] = values
+            n = len(self._pending)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='ap-write-behind', daemon=True)
+                self._thread.start()
+                #whatever is still waiting is written when the server shuts down
+                atexit.register(self.flush)
+        if n >= self.max_pending:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing the buffered AP updates failed.')
+
+    def flush(self):
+        """
+        Write all waiting values to the DB now
+        """
+        from server import db
+        from server.models import AccessPoint
+        table = AccessPoint.__table__
+
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+
+            #a discovery that changed the AP might have been written directly since these values were buffered,
+            #so only move t_last_seen forward
+            update = table.update().where(table.c.mac == bindparam('b_mac'),
+                                          table.c.t_last_seen <= bindparam('t_last_seen')) \
+                .values(t_last_seen=bindparam('t_last_seen'), gps_lat=bindparam('gps_lat'), gps_lon=bindparam('gps_lon'))
+            #the same order in every process, so concurrent flushes can't deadlock
+            rows = [dict(values, b_mac=mac) for mac, values in sorted(batch.items())]
+            try:
+                with db.get_engine(self._app).begin() as conn:
+                    conn.execute(update, rows)
+            except Exception:
+                #keep the values (unless newer ones arrived in the meantime) and try again next time
+                with self._lock:
+                    for mac, values in batch.items():
+                        current = self._pending.get(mac)
+                        if current is None or current['t_last_seen'] < values['t_last_seen']:
+                            self._pending[mac] = values
+                raise
+            logger.debug('Wrote the buffered updates of %d APs.', len(rows))
+
+    def pending(self, mac):
+        """
+        The values waiting for this AP (or None)
+        """
+        if not self.reads:
+            return None
+        with self._lock:
+            return self._pending.get(mac)
+
+    def apply(self, output):
+        """
+        Show the waiting values in dumped APs (a dict or a list of them, changed in place)
+        """
+        if not self.reads:
+            return output
+        for ap in output if isinstance(output, list) else [output]:
+            values = self.pending(ap.get('mac'))
+            if values:
+                ap.update(values, t_last_seen=values['t_last_seen'].isoformat())
+        return output
+
+
+ap_buffer = APWriteBehind()
@@ -0,0 +1,146 @@
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from server import create_server, db
+from server.config import DevelopmentConfig
+from server.login import generate_token
+from server.models import User, Sniffer, WardrivingMap
+from server.writebehind import ap_buffer
+
+
+"""
+Fixtures of the test suite, run it from the project directory with 'python -m pytest' (needs 'pip install pytest').
+
+- app / client: a new app with an empty SQLite DB in a temporary directory for every test.
+  Config values can be changed per test with @pytest.mark.config(NAME=value, ...)
+- scale_map: a synthetic map (see server/synthetic.py) for each size of --scale-sizes, created once per session.
+  The default is 10k discoveries, so the suite stays fast; run e.g. --scale-sizes 10000,1000000,10000000 to
+  test the big ones (10M need a few GB of disk and memory) and --scale-output results.ndjson to keep the timings
+  for comparing commits (like benchmarks/scale.py)
+"""
+
+
+def pytest_addoption(parser):
+    parser.addoption('--scale-sizes', default='10000',
+                     help='comma separated numbers of discoveries of the synthetic maps used by the scale tests')
+    parser.addoption('--scale-backend', default='sql', choices=['sql', 'columnar'],
+                     help='storage of the read endpoints in the scale tests (columnar needs duckdb)')
+    parser.addoption('--scale-requests', type=int, default=10, help='requests per endpoint in the scale tests')
+    parser.addoption('--scale-output', help='append the results of the scale tests to this file (JSON lines)')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'config(**values): config values of the app of this test')
+    config.addinivalue_line('markers', 'scale: tests on big synthetic maps (see --scale-sizes)')
+
+
+def pytest_generate_tests(metafunc):
+    #every scale test runs once per size
+    if 'scale_size' in metafunc.fixturenames:
+        sizes = [int(size) for size in metafunc.config.getoption('--scale-sizes').split(',')]
+        metafunc.parametrize('scale_size', sizes, ids=[f'{size}' for size in sizes], scope='session')
+
+
+def make_config(tmp, **values):
+    """
+    Config of a test app whose files (DB, shards, archives, ...) are all in the directory tmp
+    """
+    class TestConfig(DevelopmentConfig):
+        DEBUG = False
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp}/test.db'
+        #absolute paths, so nothing ends up in the server package
+        SHARD_DIRECTORY = f'{tmp}/shards'
+        ARCHIVE_DIRECTORY = f'{tmp}/archives'
+        STORAGE_DIRECTORY = f'{tmp}/columnar'
+        PROFILING_DIRECTORY = f'{tmp}/profiles'
+        RATELIMIT_ENABLED = False
+        PROFILING_SLOW_THRESHOLD = None
+    for name, value in values.items():
+        setattr(TestConfig, name, value)
+    return TestConfig
+
+
+def add_user(name, admin=False, sniffer=False):
+    """
+    Create a user (or sniffer) and return it together with the headers of its requests
+    """
+    cls = Sniffer if sniffer else User
+    user = cls(public_id=str(uuid.uuid4()), name=name, password=generate_password_hash(name), admin=admin)
+    db.session.add(user)
+    db.session.commit()
+    return user, {'x-access-token': generate_token(user)}
+
+
+@pytest.fixture
+def app(request):
+    marker = request.node.get_closest_marker('config')
+    tmp = tempfile.mkdtemp()
+    app = create_server(make_config(tmp, **(marker.kwargs if marker else {})))
+    with app.app_context():
+        db.create_all()
+        yield app
+        #the buffered AP updates belong to this DB, which is removed now
+        ap_buffer.flush()
+        db.session.remove()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def admin(app):
+    return add_user('admin', admin=True)[1]
+
+
+@pytest.fixture
+def sniffer(app):
+    return add_user('sniffer', sniffer=True)
+
+
+@pytest.fixture
+def map_id(app):
+    map = WardrivingMap(title='test')
+    db.session.add(map)
+    db.session.commit()
+    return map.id
+
+
+@pytest.fixture(scope='session')
+def scale_map(request, scale_size):
+    """
+    (app, admin headers, map id, dataset) of a synthetic map with scale_size discoveries
+    """
+    from server import synthetic
+
+    tmp = tempfile.mkdtemp()
+    backend = request.config.getoption('--scale-backend')
+    app = create_server(make_config(tmp, STORAGE_BACKEND=backend))
+    with app.app_context():
+        db.create_all()
+        _, headers = add_user('admin', admin=True)
+        sniffer_ids = [add_user(f'sniffer{i}', sniffer=True)[0].id for i in range(5)]
+        map = WardrivingMap(title=f'scale {scale_size}')
+        db.session.add(map)
+        db.session.commit()
+        map_id = map.id
+
+        dataset, _ = synthetic.load(db.engine, map_id, sniffer_ids, scale_size)
+        if backend == 'columnar':
+            from server.cli import _rebuild_columnar
+            _rebuild_columnar(map_id, 100000)
+        db.session.remove()
+    yield app, headers, map_id, dataset
+    shutil.rmtree(tmp, ignore_errors=True)
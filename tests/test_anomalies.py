@@ -0,0 +1,18 @@
+from server import db
+from server.anomalies import AnomalyDetector, DISPLACED
+from server.models import AnomalyFinding
+
+from test_ingest import discovery
+
+
+def test_displaced_within_one_chunk(client, sniffer, map_id):
+    _, headers = sniffer
+    #the jump (20 km north) is uploaded first, but happened after the usual sightings
+    client.post(f'/maps/{map_id}', json=discovery(lat=49.63, timestamp='2021-06-01T12:00:00'), headers=headers)
+    for hour in range(8, 11):
+        client.post(f'/maps/{map_id}', json=discovery(timestamp=f'2021-06-01T{hour:02d}:00:00'), headers=headers)
+
+    stats = AnomalyDetector(displacement=2000, min_sightings=3).run(db.engine)
+    assert (stats['discoveries'], stats[DISPLACED]) == (4, 1)
+    [finding] = AnomalyFinding.query.filter_by(kind=DISPLACED).all()
+    assert 19000 < finding.distance < 21000 and finding.gps_lat == 49.63
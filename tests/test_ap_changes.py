@@ -0,0 +1,37 @@
+from datetime import datetime
+
+from server import db
+from server.ingest import update_access_points
+from server.models import APChange
+
+from test_ingest import discovery
+
+
+def history(client, headers, mac=0x3810D5000001):
+    response = client.get(f'/aps/{mac}/history', headers=headers)
+    assert response.status_code == 200
+    return [(c['attribute'], c['old_value'], c['new_value']) for c in response.get_json()['changes']]
+
+
+def test_late_upload_is_not_a_change(client, sniffer, map_id):
+    _, headers = sniffer
+    client.post(f'/maps/{map_id}', json=discovery(ssid='old', timestamp='2021-06-01T08:00:00'), headers=headers)
+    client.post(f'/maps/{map_id}', json=discovery(ssid='new', timestamp='2021-06-03T08:00:00'), headers=headers)
+    #a sniffer that was offline uploads a discovery from in between
+    client.post(f'/maps/{map_id}', json=discovery(ssid='old', timestamp='2021-06-02T08:00:00'), headers=headers)
+
+    assert [c[1:] for c in history(client, headers)] == [('old', 'new')]
+    ap = client.get(f'/aps/{0x3810D5000001}', headers=headers).get_json()['ap']
+    assert (ap['last_ssid'], ap['t_last_seen']) == ('new', '2021-06-03T08:00:00')
+
+
+def test_batch_out_of_order(app, sniffer, map_id):
+    user, _ = sniffer
+    batch = [dict(discovery(ssid=ssid, timestamp=timestamp), map_id=map_id, sniffer_id=user.id)
+             for ssid, timestamp in [('new', '2021-06-03T08:00:00'), ('old', '2021-06-01T08:00:00')]]
+    update_access_points(db.engine, batch)
+    #a later batch with a discovery older than the AP's state
+    update_access_points(db.engine, [dict(batch[1], timestamp='2021-06-02T08:00:00')])
+
+    changes = APChange.query.all()
+    assert [(c.old_value, c.new_value, c.timestamp) for c in changes] == [('old', 'new', datetime(2021, 6, 3, 8))]
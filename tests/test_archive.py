@@ -0,0 +1,74 @@
+import shutil
+
+from server import db
+from server.archive import archive
+from server.models import Discovery, WardrivingMap
+
+from test_ingest import discovery, viewport
+
+
+def test_finalize_keeps_discoveries_added_meanwhile(client, admin, sniffer, map_id, monkeypatch):
+    user, headers = sniffer
+    sniffer_id = user.id
+    for i in range(3):
+        client.post(f'/maps/{map_id}', json=discovery(mac=i + 1), headers=headers)
+
+    #another request adds a discovery while the archive is written
+    write = archive._write
+
+    def write_and_add(map_id, rows):
+        write(map_id, rows)
+        with db.engine.begin() as conn:
+            conn.execute(Discovery.__table__.insert(), [dict(discovery(mac=4), map_id=map_id, sniffer_id=sniffer_id,
+                                                              timestamp=rows[0]['timestamp'])])
+    monkeypatch.setattr(archive, '_write', write_and_add)
+
+    response = client.post(f'/maps/{map_id}/finalize', headers=admin)
+    assert (response.status_code, response.get_json()['discoveries']) == (200, 3)
+    assert [d.access_point_mac for d in Discovery.query.all()] == [4]
+    assert sorted(d['access_point_mac'] for d in viewport(client, headers, map_id)) == [1, 2, 3, 4]
+
+
+def test_archive_reactivated_by_another_process(client, admin, sniffer, map_id):
+    _, headers = sniffer
+    client.post(f'/maps/{map_id}', json=discovery(mac=1), headers=headers)
+    assert client.post(f'/maps/{map_id}/finalize', headers=admin).status_code == 200
+    assert len(viewport(client, headers, map_id)) == 1
+
+    #another process moves the discoveries back (without clearing the cache of this one) and one is deleted
+    rows = archive.rows(map_id)
+    shutil.rmtree(archive.path(map_id))
+    with db.engine.begin() as conn:
+        conn.execute(Discovery.__table__.insert(), [dict(row, map_id=map_id) for row in rows])
+        conn.execute(WardrivingMap.__table__.update().values(archived=False))
+    assert len(viewport(client, headers, map_id)) == 1
+    with db.engine.begin() as conn:
+        conn.execute(Discovery.__table__.delete())
+    assert viewport(client, headers, map_id) == []
+
+
+def test_only_admins_finalize(client, sniffer, map_id):
+    _, headers = sniffer
+    assert client.post(f'/maps/{map_id}/finalize', headers=headers).status_code in (401, 403)
+    assert client.post(f'/maps/{map_id}/reactivate', headers=headers).status_code in (401, 403)
+
+
+def test_archived_discoveries_outside_the_map_routes(app, client, admin, sniffer, map_id):
+    user, headers = sniffer
+    sniffer_id = user.id
+    client.post(f'/maps/{map_id}', json=discovery(mac=1), headers=headers)
+    client.post(f'/maps/{map_id}', json=discovery(mac=2), headers=headers)
+    assert client.post(f'/maps/{map_id}/finalize', headers=admin).status_code == 200
+    assert Discovery.query.count() == 0
+
+    assert [d['access_point_mac'] for d in archive.rows(access_point_mac=2)] == [2]
+    assert len(archive.discoveries(sniffer_id=sniffer_id)) == 2
+    assert archive.discoveries(sniffer_id=sniffer_id + 1) == []
+
+    assert len(client.get('/aps/1', headers=headers).get_json()['ap']['discoveries']) == 1
+    assert len(client.get('/aps/*', headers=headers).get_json()['discoveries']) == 2
+    assert len(client.get(f'/users/sniffers/{sniffer_id}', headers=headers).get_json()['sniffer']['discoveries']) == 2
+
+    result = app.test_cli_runner().invoke(args=['data', 'export', '-', '--map', str(map_id)])
+    assert result.exit_code == 0, result.output
+    assert result.output.count('"access_point_mac"') == 2
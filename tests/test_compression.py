@@ -0,0 +1,48 @@
+import gzip
+import json
+
+import pytest
+
+from server.compression import get_decompressor, BodyTooLarge
+
+from test_ingest import discovery, viewport, asgi_request
+
+
+def compressed(data):
+    return gzip.compress(json.dumps(data).encode())
+
+
+def test_compressed_response(client, sniffer, map_id):
+    _, headers = sniffer
+    for i in range(20):
+        client.post(f'/maps/{map_id}', json=discovery(mac=i + 1), headers=headers)
+    response = client.get(f'/maps/{map_id}/aps?lat1=49&lat2=50&lon1=11&lon2=12',
+                          headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+    assert response.headers['Content-Encoding'] == 'gzip' and 'Accept-Encoding' in response.headers['Vary']
+    assert len(json.loads(gzip.decompress(response.data))['discoveries']) == 20
+
+
+def test_compressed_upload(app, client, sniffer, map_id):
+    _, headers = sniffer
+    headers = dict(headers, **{'Content-Encoding': 'gzip', 'Content-Type': 'application/json'})
+    assert client.post(f'/maps/{map_id}', data=compressed(discovery(mac=1)), headers=headers).status_code == 200
+    assert asgi_request(app, 'POST', f'/maps/{map_id}', headers, compressed(discovery(mac=2)))[0] == 200
+    assert sorted(d['access_point_mac'] for d in viewport(client, headers, map_id)) == [1, 2]
+
+
+@pytest.mark.config(DECOMPRESS_MAX_SIZE=10000)
+def test_zip_bomb_and_truncated_uploads(app, client, sniffer, map_id):
+    _, headers = sniffer
+    headers = dict(headers, **{'Content-Encoding': 'gzip', 'Content-Type': 'application/json'})
+    #10 MB of spaces compress to ~10 KB, a single chunk of the body
+    bomb = gzip.compress(b' ' * 10 ** 7)
+    truncated = compressed(discovery())[:-10]
+    for body, status in [(bomb, 413), (truncated, 400), (b'garbage', 400)]:
+        assert client.post(f'/maps/{map_id}', data=body, headers=headers).status_code == status
+        assert asgi_request(app, 'POST', f'/maps/{map_id}', headers, body)[0] == status
+
+    #the decompressor itself never inflates more than the limit
+    decompressor = get_decompressor('gzip', 10000)
+    with pytest.raises(BodyTooLarge):
+        decompressor.decompress(bomb)
+    assert decompressor.size == 10001
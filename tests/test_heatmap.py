@@ -0,0 +1,61 @@
+import base64
+import struct
+import zlib
+
+import numpy as np
+
+from server import db, heatmap
+from server.storage import storage
+
+from test_ingest import discovery
+
+
+def test_rasterize():
+    lat = np.array([0.0, 0.1, 0.9, 1.0, 2.0])
+    lon = np.array([0.0, 0.1, 0.9, 1.0, 0.5])
+    rssi = np.array([-80, -60, -40, -50, -10])
+    grid = heatmap.rasterize(lat, lon, rssi, (0, 0, 1, 1), 2, 2)
+    #row 0 is the north, points on the upper edges belong to the last cell, the last point is outside
+    assert grid[1, 0] == -60 and grid[0, 1] == -40
+    assert np.isnan(grid[0, 0]) and np.isnan(grid[1, 1])
+    assert heatmap.rasterize(lat, lon, rssi, (0, 0, 1, 1), 2, 2, 'mean')[1, 0] == -70
+    assert heatmap.to_int8(grid).tolist() == [[heatmap.NODATA, -40], [-60, heatmap.NODATA]]
+
+
+def test_to_png():
+    grid = np.array([[heatmap.RSSI_MAX, np.nan, heatmap.RSSI_MIN]])
+    png = heatmap.to_png(grid)
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack('>II', png[16:24])
+    assert (width, height) == (3, 1)
+    #the only scanline: filter type and RGBA pixels (empty cells are transparent)
+    length, = struct.unpack('>I', png[33:37])
+    assert png[37:41] == b'IDAT'
+    pixels = zlib.decompress(png[41:41 + length])
+    assert pixels == bytes([0, 255, 0, 0, 200, 0, 0, 255, 0, 0, 0, 255, 200])
+
+
+def test_heatmap_endpoint(client, sniffer, map_id):
+    _, headers = sniffer
+    path = f'/maps/{map_id}/heatmap?bbox=49,11,50,12&resolution=4&format=json'
+    client.post(f'/maps/{map_id}', json=discovery(mac=1, lat=49.1, lon=11.1, signal_strength=-70), headers=headers)
+    data = client.get(path, headers=headers).get_json()['heatmap']
+    assert (data['width'], data['height']) == (4, 6)
+    assert sorted(set(np.frombuffer(base64.b64decode(data['values']), np.int8))) == [heatmap.NODATA, -70]
+
+    #the cached heatmap is replaced as soon as the map changes
+    client.post(f'/maps/{map_id}', json=discovery(mac=2, lat=49.1, lon=11.1, signal_strength=-40), headers=headers)
+    data = client.get(path, headers=headers).get_json()['heatmap']
+    assert -40 in np.frombuffer(base64.b64decode(data['values']), np.int8)
+
+    response = client.get(f'/maps/{map_id}/heatmap?resolution=4', headers=headers)
+    assert response.mimetype == 'image/png' and response.headers['X-Heatmap-Bbox'] == '49.1,11.1,49.1,11.1'
+    assert client.get(f'/maps/{map_id}/heatmap?agg=median', headers=headers).status_code == 400
+
+
+def test_version_uses_map_index(app, map_id):
+    #the version of a map is computed for every heatmap request, it must not scan the discovery table
+    storage.sql.version(map_id)
+    plan = db.session.execute('EXPLAIN QUERY PLAN SELECT count(id), max(id) FROM discovery WHERE map_id = :id',
+                              {'id': map_id}).fetchall()
+    assert 'ix_discovery_map_id' in str(plan)
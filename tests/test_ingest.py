@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+import pytest
+
+from server import db
+from server.models import Discovery
+
+
+def discovery(mac=0x3810D5000001, lat=49.45, lon=11.07, **values):
+    return dict({'access_point_mac': mac, 'channel': 6, 'encryption': 2, 'signal_strength': -60, 'ssid': 'test',
+                 'timestamp': '2021-06-01T08:00:00', 'gps_lat': lat, 'gps_lon': lon}, **values)
+
+
+def viewport(client, headers, map_id, path='/maps/{}/aps?lat1=49&lat2=50&lon1=11&lon2=12'):
+    response = client.get(path.format(map_id), headers=headers)
+    assert response.status_code == 200
+    return response.get_json()['discoveries']
+
+
+def asgi_request(app, method, path, headers, body=None):
+    """
+    Send one request to the ASGI server of the app, returns (status, JSON body)
+    body: sent as JSON unless it is bytes already
+    """
+    pytest.importorskip('aiosqlite')
+    from server.asgi import create_asgi_server
+
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+             'headers': [(k.encode(), v.encode()) for k, v in headers.items()]}
+    if body is not None and not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    messages = [{'type': 'http.request', 'body': body or b''}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        server = create_asgi_server(app)
+        try:
+            await server(scope, receive, send)
+        finally:
+            await server._shutdown()
+    asyncio.run(run())
+    return sent[0]['status'], json.loads(b''.join(m.get('body', b'') for m in sent[1:]))
+
+
+def test_add_discovery(client, sniffer, map_id):
+    _, headers = sniffer
+    response = client.post(f'/maps/{map_id}', json=discovery(), headers=headers)
+    assert response.status_code == 200
+    [d] = viewport(client, headers, map_id)
+    assert d['access_point_mac'] == 0x3810D5000001
+    assert client.get(f'/aps/{0x3810D5000001}', headers=headers).get_json()['ap']['last_ssid'] == 'test'
+
+
+def test_retry_is_not_added_twice(client, sniffer, map_id):
+    _, headers = sniffer
+    for _ in range(2):
+        response = client.post(f'/maps/{map_id}', json=discovery(client_discovery_id='a1'), headers=headers)
+        assert response.status_code == 200
+    assert response.get_json()['message'] == 'Discovery had already been added.'
+    assert Discovery.query.count() == 1
+
+
+def test_concurrent_retry_is_not_an_error(client, sniffer, map_id, monkeypatch):
+    from server import ingest
+    _, headers = sniffer
+    assert client.post(f'/maps/{map_id}', json=discovery(client_discovery_id='a1'), headers=headers).status_code == 200
+
+    #the retry passes the check before the first request has committed, the unique constraint catches it
+    checks = []
+    real_check = ingest._is_duplicate
+
+    def is_duplicate(*args):
+        checks.append(args)
+        return len(checks) > 1 and real_check(*args)
+    monkeypatch.setattr(ingest, '_is_duplicate', is_duplicate)
+    response = client.post(f'/maps/{map_id}', json=discovery(client_discovery_id='a1'), headers=headers)
+    assert (response.status_code, response.get_json()['message']) == (200, 'Discovery had already been added.')
+    assert Discovery.query.count() == 1
+
+
+def test_viewport_needs_coordinates(client, sniffer, map_id):
+    _, headers = sniffer
+    assert client.get(f'/maps/{map_id}/aps?lat1=49&lat2=50&lon1=11', headers=headers).status_code == 400
+    assert client.get(f'/maps/{map_id}/aps?lat1=49&lat2=50&lon1=11&lon2=x', headers=headers).status_code == 400
+
+
+def test_asgi_routes_behave_like_flask(app, client, sniffer, map_id):
+    _, headers = sniffer
+    status, body = asgi_request(app, 'POST', f'/maps/{map_id}', headers, discovery(client_discovery_id='a1'))
+    assert (status, body) == (200, {'message': 'New discovery was added.'})
+    status, body = asgi_request(app, 'POST', f'/maps/{map_id}', headers, discovery(client_discovery_id='a1'))
+    assert (status, body) == (200, {'message': 'Discovery had already been added.'})
+    db.session.remove()
+    assert Discovery.query.count() == 1
+
+    status, body = asgi_request(app, 'GET', f'/maps/{map_id}/aps?lat1=49&lat2=50&lon1=11&lon2=12', headers)
+    assert status == 200
+    assert body['discoveries'] == viewport(client, headers, map_id)
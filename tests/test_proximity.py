@@ -0,0 +1,61 @@
+import pytest
+
+from server import db
+from server.models import WardrivingMap
+from server.acl import acl
+
+from conftest import add_user
+from test_ingest import discovery
+
+
+def test_near_lists_aps_by_distance(client, sniffer, map_id):
+    _, headers = sniffer
+    for mac, lat in [(1, 49.451), (2, 49.45)]:
+        client.post(f'/maps/{map_id}', json=discovery(mac=mac, lat=lat), headers=headers)
+
+    response = client.get('/aps/near?lat=49.45&lon=11.07&radius=1000', headers=headers)
+    assert response.status_code == 200
+    aps = response.get_json()['aps']
+    assert [ap['mac'] for ap in aps] == [2, 1]
+    assert aps[0]['distance'] < 1 and 100 < aps[1]['distance'] < 120
+    #only the APs, like the other AP lists
+    assert 'discoveries' not in aps[0]
+
+
+@pytest.mark.config(MAP_ACL_ENABLED=True)
+def test_unshared_maps_dont_leak(client, sniffer, map_id):
+    user, headers = sniffer
+    other, other_headers = add_user('other', sniffer=True)
+    secret = WardrivingMap(title='secret')
+    db.session.add(secret)
+    db.session.commit()
+    acl.grant(map_id, user.id)
+    acl.grant(secret.id, other.id)
+    #the same AP on the map of the sniffer and on a map it may not see
+    client.post(f'/maps/{map_id}', json=discovery(mac=1), headers=headers)
+    client.post(f'/maps/{secret.id}', json=discovery(mac=1), headers=other_headers)
+    client.post(f'/maps/{secret.id}', json=discovery(mac=2, lat=49.4501), headers=other_headers)
+
+    db.session.remove()
+    for path in ['/aps/near?lat=49.45&lon=11.07', f'/aps/{1}/neighbors', '/aps/near?lat=49.45&lon=11.07&k=5']:
+        response = client.get(path, headers=headers)
+        assert response.status_code == 200
+        aps = response.get_json()['aps']
+        #AP 2 was only found on the secret map, and the discoveries of AP 1 on it aren't listed
+        assert [ap['mac'] for ap in aps] == ([] if 'neighbors' in path else [1])
+        assert all('discoveries' not in ap for ap in aps)
+    #like /aps/<mac>, which only lists the discovery on the map of the sniffer
+    assert len(client.get(f'/aps/{1}', headers=headers).get_json()['ap']['discoveries']) == 1
+
+
+@pytest.mark.config(MAP_ACL_ENABLED=True)
+def test_only_admins_change_aps(client, admin, sniffer, map_id):
+    user, headers = sniffer
+    acl.grant(map_id, user.id)
+    client.post(f'/maps/{map_id}', json=discovery(mac=1), headers=headers)
+    #the AP may also have been found on maps the sniffer can't see
+    assert client.put(f'/aps/{1}', json={'manufacturer': 'x'}, headers=headers).status_code in (401, 403)
+    assert client.delete(f'/aps/{1}', headers=headers).status_code in (401, 403)
+    assert client.get(f'/aps/{1}', headers=headers).status_code == 200
+    #admins get past the permission check (the body is incomplete)
+    assert client.put(f'/aps/{1}', json={'last_ssid': 'renamed'}, headers=admin).status_code == 400
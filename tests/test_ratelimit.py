@@ -0,0 +1,21 @@
+import base64
+
+import pytest
+
+from conftest import add_user
+
+
+def login(client, name, password):
+    auth = base64.b64encode(f'{name}:{password}'.encode()).decode()
+    return client.get('/login', headers={'Authorization': 'Basic ' + auth}).status_code
+
+
+@pytest.mark.config(RATELIMIT_ENABLED=True)
+def test_login_is_limited_per_username(client):
+    add_user('alice')
+    add_user('bob')
+    #guessing the password of alice
+    statuses = [login(client, 'alice', f'guess{i}') for i in range(20)]
+    assert statuses[:10] == [401] * 10 and 429 in statuses
+    #bob logs in from the same IP address
+    assert login(client, 'bob', 'bob') == 200
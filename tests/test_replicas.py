@@ -0,0 +1,68 @@
+import shutil
+import tempfile
+import time
+
+import pytest
+from sqlalchemy import text
+
+from server import create_server, db
+from server.replicas import replicas
+
+from conftest import make_config, add_user
+
+
+@pytest.fixture
+def replica_app():
+    """
+    App with a SQLite copy of its DB as read replica (not updated afterwards, like a replica lagging behind)
+    """
+    tmp = tempfile.mkdtemp()
+    app = create_server(make_config(tmp, SQLALCHEMY_BINDS={'replica': f'sqlite:///{tmp}/replica.db'},
+                                    SQLALCHEMY_REPLICAS=['replica']))
+    with app.app_context():
+        db.create_all()
+        _, headers = add_user('user')
+        shutil.copy(f'{tmp}/test.db', f'{tmp}/replica.db')
+        yield app, headers
+        db.session.remove()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def titles(client, headers, **extra):
+    response = client.get('/maps', headers=dict(headers, **extra))
+    assert response.status_code == 200
+    return [m['title'] for m in response.get_json()['maps']]
+
+
+def test_reads_go_to_the_replica(replica_app):
+    app, headers = replica_app
+    client = app.test_client()
+    assert client.post('/maps', json={'title': 'new'}, headers=headers).status_code == 200
+    #the client that just wrote reads its writes from the primary, in any process (the time is in a cookie)
+    assert titles(client, headers) == ['new']
+    other = app.test_client()
+    assert titles(other, headers) == []
+    assert titles(other, headers, **{'X-Consistency': 'strong'}) == ['new']
+    #writes are never sent to the replica
+    assert client.post('/maps', json={'title': 'second'}, headers=headers).status_code == 200
+
+
+def test_write_window_ends(replica_app, monkeypatch):
+    app, headers = replica_app
+    client = app.test_client()
+    client.post('/maps', json={'title': 'new'}, headers=headers)
+    later = time.time() + app.config['REPLICA_READ_YOUR_WRITES'] + 1
+    monkeypatch.setattr(time, 'time', lambda: later)
+    assert titles(client, headers) == []
+
+
+def test_failed_replica_query_is_retried_on_the_primary(replica_app):
+    app, headers = replica_app
+    client = app.test_client()
+    client.post('/maps', json={'title': 'new'}, headers=headers)
+    with db.get_engine(app, bind='replica').begin() as conn:
+        conn.execute(text('DROP TABLE wardriving_map'))
+
+    #the replica is reachable, but the query fails there
+    assert titles(app.test_client(), headers) == ['new']
+    assert not replicas._status['replica']['healthy']
@@ -0,0 +1,93 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from conftest import ROOT
+
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+#the same requests as the scale benchmark
+from scale import ENDPOINTS
+
+
+"""
+Timings and memory of the read endpoints on synthetic maps (see the scale_map fixture in conftest.py).
+The limits are generous: they catch an endpoint that suddenly scans a whole big map or loads all of it into
+memory, not a few percent. With --scale-output, the measured values are kept for comparing commits.
+"""
+
+pytestmark = pytest.mark.scale
+
+#endpoint -> (p95 latency [ms], peak of the python allocations of one request [MB]) at 10k discoveries
+LIMITS = {
+    'viewport': (1000, 50),
+    'ap': (300, 20),
+    'near': (1000, 30),
+    'search': (300, 20),
+    'stats': (500, 30),
+    'heatmap': (1000, 50),
+    'sniffers': (100, 5),
+}
+#endpoints which read a whole map (or an area of it, which gets denser) grow with its size: their limits are scaled
+#by (size / 10k) ** GROWTH, all others have to stay the same
+GROWTH = {'stats': 1, 'heatmap': 1, 'viewport': 1, 'near': 0.5, 'search': 0.5, 'ap': 0.5}
+
+
+def _limits(endpoint, size):
+    latency, memory = LIMITS[endpoint]
+    factor = max(size / 10000, 1) ** GROWTH.get(endpoint, 0)
+    return latency * factor, memory * factor
+
+
+def _record(config, result):
+    output = config.getoption('--scale-output')
+    if not output:
+        return
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True, capture_output=True,
+                                text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with open(output, 'a') as f:
+        f.write(json.dumps(dict(result, commit=commit, time=datetime.utcnow().isoformat())) + '\n')
+
+
+@pytest.mark.parametrize('endpoint', list(ENDPOINTS))
+def test_endpoint(request, scale_map, scale_size, endpoint):
+    app, headers, map_id, dataset = scale_map
+    client = app.test_client()
+    path = ENDPOINTS[endpoint]
+    rng = np.random.default_rng([0, scale_size])
+
+    #warm up (lazy schemas, caches of the DB), then measure
+    assert client.get(path(dataset, map_id, rng), headers=headers).status_code == 200
+    latencies = []
+    for _ in range(request.config.getoption('--scale-requests')):
+        started = time.perf_counter()
+        response = client.get(path(dataset, map_id, rng), headers=headers)
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, response.get_data(as_text=True)[:200]
+    latencies.sort()
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+
+    #numpy reports its allocations to tracemalloc as well
+    tracemalloc.start()
+    try:
+        assert client.get(path(dataset, map_id, rng), headers=headers).status_code == 200
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+    _record(request.config, {'size': scale_size, 'backend': request.config.getoption('--scale-backend'),
+                             'endpoint': endpoint, 'p50_ms': round(statistics.median(latencies), 2),
+                             'p95_ms': round(p95, 2), 'peak_mb': round(peak, 2)})
+    max_latency, max_memory = _limits(endpoint, scale_size)
+    assert p95 <= max_latency, f'{endpoint}: p95 {p95:.0f} ms > {max_latency:.0f} ms'
+    assert peak <= max_memory, f'{endpoint}: {peak:.1f} MB > {max_memory:.1f} MB'
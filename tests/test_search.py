@@ -0,0 +1,64 @@
+import pytest
+
+from test_ingest import discovery
+
+SSIDS = {1: ('FRITZ!Box 7590', '2021-06-01T08:00:00'), 2: ('FRITZ!Box 7490', '2021-06-01T09:00:00'),
+         3: ('MyFritz', '2021-06-01T10:00:00'), 4: ('Telekom_Hotspot', '2021-06-01T11:00:00'),
+         5: ('Telekom Hotspot', '2021-06-01T07:00:00')}
+
+
+@pytest.fixture
+def search(client, sniffer, map_id):
+    _, headers = sniffer
+    for mac, (ssid, timestamp) in SSIDS.items():
+        response = client.post(f'/maps/{map_id}', json=discovery(mac=mac, ssid=ssid, timestamp=timestamp), headers=headers)
+        assert response.status_code == 200
+
+    def search(q, mode=None, **params):
+        params = dict(params, q=q, **({'mode': mode} if mode else {}))
+        response = client.get('/aps/search', query_string=params, headers=headers)
+        assert response.status_code == 200
+        return response.get_json()
+    return search
+
+
+def macs(result):
+    return [ap['mac'] for ap in result['aps']]
+
+
+def test_prefix(search):
+    #case insensitive, most recently seen first
+    assert macs(search('fritz', 'prefix')) == [2, 1]
+    assert macs(search('FRITZ!Box 75', 'prefix')) == [1]
+    assert macs(search('box', 'prefix')) == []
+
+
+def test_substring(search):
+    assert macs(search('fritz')) == [3, 2, 1]
+    assert macs(search('box 7', 'substring')) == [2, 1]
+    #the wildcards of LIKE are matched literally
+    assert macs(search('m_h')) == [4]
+    assert macs(search('%')) == []
+    #shorter than a trigram
+    assert macs(search('my')) == [3]
+
+
+def test_fuzzy(search):
+    #typos: the best match comes first, regardless of when it was seen
+    assert macs(search('fritzbox 7590', 'fuzzy'))[0] == 1
+    assert macs(search('telecom hotspot', 'fuzzy')) == [5, 4]
+
+
+def test_pagination(search):
+    first = search('fritz', per_page=2)
+    assert (macs(first), first['page'], first['has_next']) == ([3, 2], 1, True)
+    second = search('fritz', per_page=2, page=2)
+    assert (macs(second), second['page'], second['has_next']) == ([1], 2, False)
+    exact = search('fritz', per_page=3)
+    assert (macs(exact), exact['has_next']) == ([3, 2, 1], False)
+
+
+def test_invalid_parameters(client, sniffer):
+    _, headers = sniffer
+    for params in [{}, {'q': ' '}, {'q': 'fritz', 'mode': 'regex'}, {'q': 'fritz', 'page': 'x'}]:
+        assert client.get('/aps/search', query_string=params, headers=headers).status_code == 400
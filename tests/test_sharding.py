@@ -0,0 +1,129 @@
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from server import db
+from server.models import WardrivingMap, Discovery
+from server.sharding import shards, shard_file, _writer_main
+
+from test_ingest import discovery, viewport, asgi_request
+
+pytestmark = pytest.mark.config(INGEST_MODE='sharded', SHARD_WRITERS=1)
+
+
+@pytest.fixture(autouse=True)
+def writers(app):
+    yield
+    shards.stop()
+
+
+def wait_for(condition, timeout=20):
+    #the writer processes work in the background
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+def test_discoveries_are_written_by_the_writer(client, sniffer, map_id):
+    _, headers = sniffer
+    response = client.post(f'/maps/{map_id}', json=discovery(), headers=headers)
+    #queued, not written yet
+    assert response.status_code == 202
+    wait_for(lambda: len(viewport(client, headers, map_id)) == 1)
+
+
+def test_retry_is_not_added_twice(client, sniffer, map_id):
+    user, headers = sniffer
+    #both are queued before the writer has stored the first one
+    values = dict(discovery(client_discovery_id='a1'), timestamp=datetime(2021, 6, 1, 8))
+    for _ in range(2):
+        shards.submit(map_id, Discovery(**values), user.id)
+    wait_for(lambda: len(viewport(client, headers, map_id)) == 1)
+
+    response = client.post(f'/maps/{map_id}', json=discovery(client_discovery_id='a1'), headers=headers)
+    assert (response.status_code, response.get_json()['message']) == (200, 'Discovery had already been added.')
+    shards.stop()
+    assert len(viewport(client, headers, map_id)) == 1
+    assert client.get(f'/aps/{discovery()["access_point_mac"]}', headers=headers).status_code == 200
+
+
+def test_deleted_map_loses_its_shard(app, client, admin, sniffer, map_id):
+    _, headers = sniffer
+    for i in range(3):
+        assert client.post(f'/maps/{map_id}', json=discovery(mac=i + 1), headers=headers).status_code == 202
+    wait_for(lambda: len(viewport(client, headers, map_id)) == 3)
+
+    assert client.delete(f'/maps/{map_id}', headers=admin).status_code == 200
+    wait_for(lambda: not os.path.exists(shard_file(shards.shard_dir, map_id)))
+
+    #SQLite reuses the id of the deleted map
+    map = WardrivingMap(title='new')
+    db.session.add(map)
+    db.session.commit()
+    assert map.id == map_id
+    assert viewport(client, headers, map.id) == []
+
+
+def test_failed_batch_is_kept_and_can_be_retried(app, client, admin, sniffer, map_id):
+    user, headers = sniffer
+    item = dict(discovery(), map_id=map_id, sniffer_id=user.id)
+    #a writer whose main DB doesn't have the tables fails to write the batch
+    os.makedirs(shards.shard_dir, exist_ok=True)
+    jobs = queue.Queue()
+    jobs.put(item)
+    jobs.put(None)
+    _writer_main(jobs, shards.shard_dir, f'sqlite:///{shards.shard_dir}/empty.db', 10)
+
+    [failed] = client.get('/shards', headers=admin).get_json()['failed']
+    assert failed['discoveries'] == 1 and failed['maps'] == [map_id]
+    assert 'no such table' in failed['error']
+    assert viewport(client, headers, map_id) == []
+
+    assert client.post('/shards/retry', headers=admin).status_code == 200
+    wait_for(lambda: len(viewport(client, headers, map_id)) == 1)
+    assert client.get('/shards', headers=admin).get_json()['failed'] == []
+    assert client.get('/shards', headers=headers).status_code in (401, 403)
+
+
+def test_async_ingest_doesnt_block_the_event_loop(app, client, sniffer, map_id, monkeypatch):
+    from server import ingest
+    _, headers = sniffer
+    #the duplicate check reads the shard, and submitting may wait for the queue of the writer
+    threads = []
+    is_duplicate = ingest._is_duplicate
+
+    def recording(*args):
+        threads.append(threading.current_thread().name)
+        return is_duplicate(*args)
+    monkeypatch.setattr(ingest, '_is_duplicate', recording)
+
+    status, body = asgi_request(app, 'POST', f'/maps/{map_id}', headers, discovery(client_discovery_id='a1'))
+    assert status == 202
+    assert threads and all(name.startswith('wsgi') for name in threads)
+    wait_for(lambda: len(viewport(client, headers, map_id)) == 1)
+    status, body = asgi_request(app, 'POST', f'/maps/{map_id}', headers, discovery(client_discovery_id='a1'))
+    assert (status, body['message']) == (200, 'Discovery had already been added.')
+
+
+def test_writers_survive_a_forked_worker(client, sniffer, map_id):
+    import multiprocessing
+    user, headers = sniffer
+    shards.start()
+
+    def submit(mac):
+        shards.submit(map_id, Discovery(**dict(discovery(mac=mac), timestamp=datetime(2021, 6, 1, 8))), user.id)
+
+    def worker():
+        submit(1)
+    #like a gunicorn worker: forked after the writers were started, multiprocessing cleans up when it exits
+    process = multiprocessing.get_context('fork').Process(target=worker)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    submit(2)
+    wait_for(lambda: len(viewport(client, headers, map_id)) == 2)
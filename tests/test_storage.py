@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import pytest
+
+from server.models import Discovery
+from server.storage import ColumnarStorage, storage
+
+from test_ingest import discovery, viewport
+
+pytest.importorskip('duckdb')
+
+
+def row(id, map_id, mac=1, **values):
+    return dict({'id': id, 'access_point_mac': mac, 'channel': 6, 'encryption': 2, 'signal_strength': -60,
+                 'ssid': 'test', 'timestamp': datetime(2021, 6, 1, 8), 'gps_lat': 49.45, 'gps_lon': 11.07,
+                 'client_discovery_id': None, 'sniffer_id': 1, 'map_id': map_id}, **values)
+
+
+def test_flush_keeps_the_rows_of_every_failed_map(app, tmp_path, monkeypatch):
+    columnar = ColumnarStorage(str(tmp_path))
+    columnar._pending = [row(1, 1), row(2, 2), row(3, 3)]
+    write = columnar.write
+
+    def write_some(map_id, rows, *args):
+        if map_id != 2:
+            raise OSError('disk full')
+        write(map_id, rows, *args)
+    monkeypatch.setattr(columnar, 'write', write_some)
+    with pytest.raises(OSError):
+        columnar.flush()
+    assert sorted(r['id'] for r in columnar._pending) == [1, 3]
+
+    monkeypatch.setattr(columnar, 'write', write)
+    columnar.flush()
+    assert columnar._pending == []
+    assert [[d.id for d in columnar.viewport(map_id, (49, 11, 50, 12))] for map_id in (1, 2, 3)] == [[1], [2], [3]]
+
+
+def test_tombstone_only_hides_the_deleted_discovery(app, tmp_path):
+    columnar = ColumnarStorage(str(tmp_path))
+    columnar.write(1, [row(1, 1), row(2, 1)])
+    columnar.remove(1, [row(2, 1)])
+    assert [d.id for d in columnar.viewport(1, (49, 11, 50, 12))] == [1]
+
+    #SQLite gives the id of the deleted discovery to the next one
+    columnar.write(1, [row(2, 1, mac=5, timestamp=datetime(2021, 6, 2))])
+    assert sorted((d.id, d.access_point_mac) for d in columnar.viewport(1, (49, 11, 50, 12))) == [(1, 1), (2, 5)]
+    columnar.compact(1)
+    assert sorted((d.id, d.access_point_mac) for d in columnar.viewport(1, (49, 11, 50, 12))) == [(1, 1), (2, 5)]
+
+
+@pytest.mark.config(STORAGE_BACKEND='columnar')
+def test_deleted_discovery_id_reused(client, sniffer, map_id):
+    _, headers = sniffer
+    client.post(f'/maps/{map_id}', json=discovery(mac=1), headers=headers)
+    client.post(f'/maps/{map_id}', json=discovery(mac=2), headers=headers)
+    assert client.delete('/aps/2/2', headers=headers).status_code == 200
+    client.post(f'/maps/{map_id}', json=discovery(mac=3, timestamp='2021-06-02T08:00:00'), headers=headers)
+    assert Discovery.query.get(2).access_point_mac == 3
+
+    storage.columnar.flush()
+    assert sorted(d['access_point_mac'] for d in viewport(client, headers, map_id)) == [1, 3]
@@ -0,0 +1,55 @@
+import base64
+
+from server import db
+from server.passwords import passwords
+
+from conftest import add_user
+
+
+def login(client, name, password):
+    auth = base64.b64encode(f'{name}:{password}'.encode()).decode()
+    return client.get('/login', headers={'Authorization': 'Basic ' + auth})
+
+
+def test_refresh_token(client, admin):
+    add_user('sniffer1', sniffer=True)
+    tokens = login(client, 'sniffer1', 'sniffer1').get_json()
+    response = client.post('/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 200
+    assert client.get('/users/me', headers={'x-access-token': response.get_json()['token']}).status_code == 200
+
+    #access and refresh tokens can't be used for each other
+    assert client.post('/refresh', json={'refresh_token': tokens['token']}).status_code == 401
+    assert client.get('/users/me', headers={'x-access-token': tokens['refresh_token']}).status_code == 401
+    #an access token alone can't be renewed forever
+    assert 'token' not in client.get('/refresh', headers={'x-access-token': tokens['token']}).get_json()
+
+
+def test_refresh_token_invalid_after_password_change(client, admin):
+    user, _ = add_user('sniffer1', sniffer=True)
+    refresh_token = login(client, 'sniffer1', 'sniffer1').get_json()['refresh_token']
+    assert client.put(f'/users/{user.public_id}', json={'password': 'new'}, headers=admin).status_code == 200
+    assert client.post('/refresh', headers={'x-refresh-token': refresh_token}).status_code == 401
+    assert login(client, 'sniffer1', 'new').status_code == 200
+
+
+def test_login_cache(client, monkeypatch):
+    user, _ = add_user('alice')
+    hashed = []
+    run = passwords._run
+
+    def counting(fn, *args):
+        hashed.append(fn)
+        return run(fn, *args)
+    monkeypatch.setattr(passwords, '_run', counting)
+
+    assert [login(client, 'alice', 'alice').status_code for _ in range(3)] == [200] * 3
+    assert len(hashed) == 1
+    #wrong passwords are never cached
+    assert [login(client, 'alice', 'wrong').status_code for _ in range(2)] == [401] * 2
+    assert len(hashed) == 3
+    #a new password invalidates the cached login
+    user.password = passwords.generate('other')
+    db.session.commit()
+    assert login(client, 'alice', 'alice').status_code == 401
+    assert login(client, 'alice', 'other').status_code == 200
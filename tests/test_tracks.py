@@ -0,0 +1,61 @@
+from server import polyline
+from server.models import Track
+
+
+def upload(client, headers, map_id, fixes, track=None):
+    return client.post(f'/maps/{map_id}/tracks', json={'fixes': fixes, 'track': track}, headers=headers)
+
+
+def points(client, headers, map_id, track):
+    response = client.get(f'/maps/{map_id}/tracks/{track}?format=points&tolerance=0', headers=headers)
+    return response.get_json()['track']['points']
+
+
+def test_polyline_roundtrip():
+    #the example of the Google documentation
+    points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    assert polyline.encode(points) == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    assert polyline.decode(polyline.encode(points)) == points
+    assert polyline.decode_numbers(polyline.encode_numbers([0, -1, 31, -32, 1 << 20])) == [0, -1, 31, -32, 1 << 20]
+    assert polyline.decode_deltas(polyline.encode_deltas([5, 3, 3, 100])) == [5, 3, 3, 100]
+
+
+def test_track_simplified(client, sniffer, map_id):
+    _, headers = sniffer
+    #a straight line with a spike of ~100 m in the middle: the points on the straight parts are not stored
+    fixes = [[49.45, 11.07 + i * 0.001, 1622534400 + i] for i in range(11)]
+    fixes[5][0] += 0.001
+    response = upload(client, headers, map_id, fixes)
+    assert response.status_code == 200
+    track = response.get_json()['track']['id']
+    assert [p[2] for p in points(client, headers, map_id, track)] == [0, 4, 5, 6, 10]
+    response = client.get(f'/maps/{map_id}/tracks/{track}?format=points&tolerance=1000', headers=headers)
+    assert [p[2] for p in response.get_json()['track']['points']] == [0, 10]
+
+
+def test_older_fixes_are_merged_by_time(client, sniffer, map_id):
+    _, headers = sniffer
+    later = [[49.45, 11.08, '2021-06-01T10:00:10+02:00'], [49.46, 11.09, '2021-06-01T10:00:20+02:00']]
+    track = upload(client, headers, map_id, later).get_json()['track']['id']
+    earlier = [[49.43, 11.06, '2021-06-01T08:00:00'], [49.44, 11.07, '2021-06-01T08:00:05']]
+    assert upload(client, headers, map_id, earlier, track).status_code == 200
+
+    assert [p[2] for p in points(client, headers, map_id, track)] == [0, 5, 10, 20]
+    assert [p[0] for p in points(client, headers, map_id, track)] == [49.43, 49.44, 49.45, 49.46]
+    stored = Track.query.get(track)
+    assert (stored.t_start.hour, stored.t_end.hour, stored.n_points) == (8, 8, 4)
+
+    #a gap between two uploads can be filled
+    between = [[49.445, 11.075, '2021-06-01T08:00:07'], [49.447, 11.077, '2021-06-01T08:00:08']]
+    assert upload(client, headers, map_id, between, track).status_code == 200
+    assert [p[2] for p in points(client, headers, map_id, track)] == [0, 5, 7, 8, 10, 20]
+
+
+def test_overlapping_fixes_are_rejected(client, sniffer, map_id):
+    _, headers = sniffer
+    fixes = [[49.45 + i * 0.01, 11.07, 1622534400 + i * 10] for i in range(3)]
+    track = upload(client, headers, map_id, fixes).get_json()['track']['id']
+    #the same upload again, and fixes within it (the middle one of the straight line is not even stored)
+    assert upload(client, headers, map_id, fixes, track).status_code == 409
+    assert upload(client, headers, map_id, [[49.0, 11.0, 1622534405]], track).status_code == 409
+    assert len(points(client, headers, map_id, track)) == 2
@@ -0,0 +1,65 @@
+from server import db
+from server.archive import archive
+from server.models import Discovery, UploadSession
+
+from conftest import add_user
+from test_ingest import discovery
+
+
+def open_session(client, headers, map_id):
+    response = client.post('/uploads', json={'map_id': map_id}, headers=headers)
+    assert response.status_code == 200
+    return response.get_json()['session']['public_id']
+
+
+def put(client, headers, session_id, n, *macs):
+    return client.put(f'/uploads/{session_id}/{n}', headers=headers,
+                      json={'discoveries': [discovery(mac=mac, client_discovery_id=f'd{mac}') for mac in macs]})
+
+
+def test_upload_session(client, sniffer, map_id):
+    _, headers = sniffer
+    session_id = open_session(client, headers, map_id)
+    assert put(client, headers, session_id, 0, 1, 2).get_json()['added'] == 2
+    #the acknowledgement got lost: sending it again does nothing
+    response = put(client, headers, session_id, 0, 1, 2)
+    assert (response.status_code, response.get_json()['message']) == (200, 'Chunk had already been received.')
+    #chunks have to arrive in order
+    assert put(client, headers, session_id, 2, 5).status_code == 409
+
+    #resume after the last chunk; discoveries that were already sent are skipped
+    session = client.get(f'/uploads/{session_id}', headers=headers).get_json()['session']
+    assert session['last_chunk'] == 0
+    response = put(client, headers, session_id, 1, 2, 3)
+    assert (response.get_json()['added'], response.get_json()['duplicates']) == (1, 1)
+
+    response = client.post(f'/uploads/{session_id}/commit', headers=headers)
+    session = response.get_json()['session']
+    assert (session['committed'], session['n_discoveries'], session['n_duplicates']) == (True, 3, 1)
+    assert put(client, headers, session_id, 2, 4).status_code == 409
+    assert Discovery.query.count() == 3
+
+
+def test_upload_session_of_another_sniffer(client, sniffer, map_id):
+    _, headers = sniffer
+    session_id = open_session(client, headers, map_id)
+    _, other = add_user('other', sniffer=True)
+    assert put(client, other, session_id, 0, 1).status_code == 403
+
+
+def test_same_chunk_at_the_same_time(client, sniffer, map_id, monkeypatch):
+    _, headers = sniffer
+    session_id = open_session(client, headers, map_id)
+
+    #another request stores chunk 0 after this one has checked the session, but before it stores the chunk
+    ensure_writable = archive.ensure_writable
+
+    def concurrent_request(map):
+        with db.engine.begin() as conn:
+            conn.execute(UploadSession.__table__.update().values(last_chunk=0))
+        return ensure_writable(map)
+    monkeypatch.setattr(archive, 'ensure_writable', concurrent_request)
+
+    response = client.put(f'/uploads/{session_id}/0', json={'discoveries': [discovery()]}, headers=headers)
+    assert (response.status_code, response.get_json()['message']) == (200, 'Chunk had already been received.')
+    assert Discovery.query.count() == 0
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+import pytest
+
+from server import db
+from server.models import Discovery
+from server.storage import storage, row_of
+
+from test_ingest import discovery
+
+AVM = 0x3810D5000000
+RASPBERRY = 0xB827EB000000
+
+
+def post_discoveries(client, headers, map_id):
+    for mac in [AVM + 1, AVM + 2, AVM + 1, RASPBERRY + 1, 0x000001]:
+        assert client.post(f'/maps/{map_id}', json=discovery(mac=mac), headers=headers).status_code == 200
+
+
+def test_aps_by_vendor(client, sniffer, map_id):
+    _, headers = sniffer
+    post_discoveries(client, headers, map_id)
+
+    def macs(vendor):
+        return sorted(ap['mac'] for ap in client.get(f'/aps?vendor={vendor}', headers=headers).get_json()['aps'])
+    #case insensitive part of the name, across all OUIs of the vendor
+    assert macs('avm') == [AVM + 1, AVM + 2]
+    assert macs('Raspberry Pi') == [RASPBERRY + 1]
+    assert macs('nobody') == []
+    assert len(macs('')) == 4
+
+
+@pytest.mark.parametrize('backend', [pytest.param('sql', marks=pytest.mark.config(STORAGE_BACKEND='sql')),
+                                     pytest.param('columnar', marks=pytest.mark.config(STORAGE_BACKEND='columnar'))])
+def test_map_stats(backend, client, admin, sniffer, map_id):
+    user, headers = sniffer
+    post_discoveries(client, headers, map_id)
+
+    expected = {'discoveries': 5, 'aps': 4, 'vendors': [
+        {'oui': '3810D5', 'vendor': 'AVM Audiovisuelles Marketing und Computersysteme GmbH', 'aps': 2},
+        {'oui': '000000', 'vendor': None, 'aps': 1},
+        {'oui': 'B827EB', 'vendor': 'Raspberry Pi Foundation', 'aps': 1}]}
+
+    def stats():
+        if storage.columnar:
+            storage.columnar.flush()
+        output = client.get(f'/maps/{map_id}/stats', headers=headers).get_json()['stats']
+        output['vendors'].sort(key=lambda v: (-v['aps'], v['oui']))
+        return output
+    assert stats() == expected
+
+    #archived discoveries plus one in the DB of an AP that is in the archive as well
+    assert client.post(f'/maps/{map_id}/finalize', headers=admin).status_code == 200
+    with db.engine.begin() as conn:
+        conn.execute(Discovery.__table__.insert(), [dict(discovery(mac=AVM + 1), map_id=map_id, sniffer_id=user.id,
+                                                          timestamp=datetime(2021, 6, 2))])
+    storage.add([row_of(Discovery.query.one())])
+    assert stats() == dict(expected, discoveries=6)
@@ -0,0 +1,83 @@
+import pytest
+
+from server.models import AccessPoint
+from server.writebehind import ap_buffer
+
+from test_ingest import discovery
+
+MAC = 0x3810D5000001
+
+#no flush in the background while a test runs
+pytestmark = pytest.mark.config(AP_WRITE_BEHIND_INTERVAL=3600)
+
+
+def post(client, headers, map_id, timestamp, lat, **values):
+    response = client.post(f'/maps/{map_id}', json=discovery(timestamp=timestamp, lat=lat, **values), headers=headers)
+    assert response.status_code == 200
+
+
+def stored():
+    ap = AccessPoint.query.get(MAC)
+    return ap.t_last_seen.isoformat(), ap.gps_lat
+
+
+def shown(client, headers):
+    ap = client.get(f'/aps/{MAC}', headers=headers).get_json()['ap']
+    return ap['t_last_seen'], ap['gps_lat']
+
+
+def test_latest_discovery_is_written(client, sniffer, map_id):
+    _, headers = sniffer
+    #the new AP is written right away, the known one only buffered
+    post(client, headers, map_id, '2021-06-01T08:00:00', 49.1)
+    post(client, headers, map_id, '2021-06-01T10:00:00', 49.3)
+    #arrives late: older than the one waiting, so it doesn't replace it
+    post(client, headers, map_id, '2021-06-01T09:00:00', 49.2)
+    assert stored() == ('2021-06-01T08:00:00', 49.1)
+    assert ap_buffer.pending(MAC)['gps_lat'] == 49.3
+
+    ap_buffer.flush()
+    assert ap_buffer.pending(MAC) is None
+    assert stored() == ('2021-06-01T10:00:00', 49.3)
+
+
+def test_flush_doesnt_overwrite_newer_values(client, sniffer, map_id):
+    _, headers = sniffer
+    post(client, headers, map_id, '2021-06-01T08:00:00', 49.1)
+    post(client, headers, map_id, '2021-06-01T09:00:00', 49.2)
+    #a new SSID is written right away, bypassing the buffer
+    post(client, headers, map_id, '2021-06-01T11:00:00', 49.4, ssid='renamed')
+    assert stored() == ('2021-06-01T11:00:00', 49.4)
+    assert ap_buffer.pending(MAC) is not None
+
+    ap_buffer.flush()
+    assert stored() == ('2021-06-01T11:00:00', 49.4)
+
+
+def test_api_shows_waiting_values(client, sniffer, map_id):
+    _, headers = sniffer
+    post(client, headers, map_id, '2021-06-01T08:00:00', 49.1)
+    post(client, headers, map_id, '2021-06-01T10:00:00', 49.3)
+    assert stored() == ('2021-06-01T08:00:00', 49.1)
+    assert shown(client, headers) == ('2021-06-01T10:00:00', 49.3)
+    [ap] = client.get('/aps', headers=headers).get_json()['aps']
+    assert (ap['t_last_seen'], ap['gps_lat']) == ('2021-06-01T10:00:00', 49.3)
+
+
+@pytest.mark.config(AP_WRITE_BEHIND_READS=False)
+def test_api_shows_stored_values_without_reads(client, sniffer, map_id):
+    _, headers = sniffer
+    post(client, headers, map_id, '2021-06-01T08:00:00', 49.1)
+    post(client, headers, map_id, '2021-06-01T10:00:00', 49.3)
+    assert shown(client, headers) == ('2021-06-01T08:00:00', 49.1)
+    ap_buffer.flush()
+    assert shown(client, headers) == ('2021-06-01T10:00:00', 49.3)
+
+
+@pytest.mark.config(AP_WRITE_BEHIND=False)
+def test_disabled(client, sniffer, map_id):
+    _, headers = sniffer
+    post(client, headers, map_id, '2021-06-01T08:00:00', 49.1)
+    post(client, headers, map_id, '2021-06-01T10:00:00', 49.3)
+    assert ap_buffer.pending(MAC) is None
+    assert stored() == ('2021-06-01T10:00:00', 49.3)